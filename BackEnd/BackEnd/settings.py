@@ -132,6 +132,27 @@ STATIC_URL = 'static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Uploads are stored once per distinct content under media/cas/ and
+# reference counted, see marketplace.storage
+STORAGES = {
+    'default': {
+        'BACKEND': 'marketplace.storage.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
+# How marketplace.media hands file bodies to the client. OFFLOAD is None
+# (Django streams the file), 'x-accel-redirect' (nginx, with an internal
+# location at INTERNAL_PREFIX aliased to MEDIA_ROOT) or 'x-sendfile'
+# (Apache mod_xsendfile). Media URLs are routed through Django when DEBUG
+# is on or an offload is configured.
+MEDIA_SERVING = {
+    'OFFLOAD': None,
+    'INTERNAL_PREFIX': '/protected-media/',
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -167,6 +188,66 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 20,
 }
 
+# Product view counter: set BUFFERED to coalesce views in memory and flush
+# them with one bulk write every FLUSH_INTERVAL_MS or FLUSH_MAX_EVENTS views
+VIEW_COUNTER = {
+    'BUFFERED': False,
+    'FLUSH_INTERVAL_MS': 1000,
+    'FLUSH_MAX_EVENTS': 500,
+}
+
+# Serialized product cache. Use 'marketplace.cache.RedisBackend' with
+# OPTIONS {'url': 'redis://...'} to share entries between workers
+PRODUCT_CACHE = {
+    'BACKEND': 'marketplace.cache.LocMemLRUBackend',
+    'OPTIONS': {
+        'max_entries': 5000,
+        'timeout': 300,
+    },
+}
+
+# Precomputed product rankings, see marketplace.rankings. SIZE products are
+# kept per ranking; trending weighs a unit sold like SALE_WEIGHT views and
+# halves the weight of activity every HALF_LIFE_DAYS; top-rated pulls products
+# with fewer than about MIN_VOTES ratings towards the catalog average.
+RANKINGS = {
+    'SIZE': 50,
+    'TRENDING_DAYS': 14,
+    'HALF_LIFE_DAYS': 3,
+    'SALE_WEIGHT': 10,
+    'MIN_VOTES': 5,
+    'CACHE_TIMEOUT': 300,
+}
+
+# "Customers also bought", see marketplace.recommendations. SIZE related
+# products are kept per product; an order counts PURCHASE_WEIGHT and a
+# wishlist WISHLIST_WEIGHT, and a pair needs MIN_SUPPORT of shared weight
+# (one order or two wishlists by default) to be listed.
+RECOMMENDATIONS = {
+    'SIZE': 12,
+    'PURCHASE_WEIGHT': 1.0,
+    'WISHLIST_WEIGHT': 0.5,
+    'MIN_SUPPORT': 1,
+    'CHUNK_SIZE': 1000,
+}
+
+# Product image variants: WebP renditions generated on a thread pool after
+# upload. A (width, height) size is center-cropped, (width, None) keeps the
+# aspect ratio. Set ASYNC to False to generate them inside the request.
+PRODUCT_IMAGES = {
+    'VARIANTS': {
+        'thumb': (150, 150),
+        'small': (320, None),
+        'medium': (640, None),
+        'large': (1280, None),
+    },
+    'QUALITY': 80,
+    'WORKERS': 2,
+    'ASYNC': True,
+    # Threads writing the files of a multi-image upload
+    'UPLOAD_WORKERS': 4,
+}
+
 # Simple JWT configuration
 from datetime import timedelta
 
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from .models import Customer, StoreOwner, Product, ProductImage, ProductRating, Cart, Order, OrderItem, Comment
+from .models import Customer, StoreOwner, Product, ProductImage, ProductRating, StoreRating, Cart, Order, OrderItem, Comment
 
 
 @admin.register(Customer)
@@ -140,6 +140,16 @@ class ProductRatingAdmin(admin.ModelAdmin):
     readonly_fields = ('created_at', 'updated_at')
 
 
+@admin.register(StoreRating)
+class StoreRatingAdmin(admin.ModelAdmin):
+    list_display = ('rater', 'store_owner', 'kind', 'rating', 'created_at')
+    list_filter = ('kind', 'rating', 'created_at')
+    search_fields = ('rater__phone', 'store_owner__phone', 'store_owner__store_name')
+    ordering = ('-created_at',)
+    # Aggregates are kept by StoreOwner.rate, so rows are not edited here
+    readonly_fields = ('rater', 'store_owner', 'kind', 'rating', 'created_at', 'updated_at')
+
+
 @admin.register(Cart)
 class CartAdmin(admin.ModelAdmin):
     list_display = ('user_id', 'created_at', 'updated_at')
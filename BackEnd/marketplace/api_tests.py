@@ -2,11 +2,20 @@ from django.test import TestCase
 from django.core.exceptions import ValidationError
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
+from marketplace.rankings import rankings
+from marketplace.recommendations import recommendations
+from marketplace.checkout import ILLEGAL_OPERATION
 from marketplace.models import (
     Customer, StoreOwner, Product, ProductImage, ProductRating,
     Cart, Order, OrderItem, Comment, Wishlist, WishlistItem
 )
+import json
+from unittest import mock
+from pymongo.errors import OperationFailure
+from datetime import timedelta
 from decimal import Decimal
+from django.utils import timezone
+from django.core.files.uploadedfile import SimpleUploadedFile
 
 
 # ========== API Tests ==========
@@ -121,6 +130,30 @@ class StoreOwnerAPITestCase(APITestCase):
         response = self.client.get(f'/api/store-owners/{self.store_owner.phone}/statistics/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_store_owner_analytics_api(self):
+        """Test the analytics range query over hourly buckets"""
+        self.client.force_authenticate(user=self.store_owner)
+        self.store_owner.increment_sales(Decimal('120.00'))
+        response = self.client.get(
+            f'/api/store-owners/{self.store_owner.phone}/analytics/',
+            {'granularity': 'hour', 'top': 5},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['series']), 48)
+        self.assertEqual(response.data['totals']['orders'], 1)
+        self.assertEqual(response.data['top_products'], [])
+
+        response = self.client.get(
+            f'/api/store-owners/{self.store_owner.phone}/analytics/', {'granularity': 'week'},
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        for value in ('2026-02-30', '2026-13-01T00:00'):
+            response = self.client.get(
+                f'/api/store-owners/{self.store_owner.phone}/analytics/', {'start': value},
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
 
 class ProductAPITestCase(APITestCase):
     """Test Product API endpoints"""
@@ -188,6 +221,165 @@ class ProductAPITestCase(APITestCase):
         response = self.client.get(f'/api/products/{self.product.id}/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_list_products_cursor_pagination_api(self):
+        """Test keyset pagination walks the product feed without overlap"""
+        extra = Product.objects.create(
+            store_owner=self.store_owner,
+            title='Second Product',
+            description='Second Description',
+            sku='TEST-SKU-002',
+            price=Decimal('120.00'),
+            stock=10,
+            category='women'
+        )
+        response = self.client.get('/api/products/', {'pagination': 'cursor', 'page_size': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['id'], str(extra.id))
+        self.assertIsNotNone(response.data['next'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['id'], str(self.product.id))
+        extra.delete()
+
+    def test_filter_products_with_facets_api(self):
+        """Test listing filters and facet counts come back together"""
+        red = Product.objects.create(
+            store_owner=self.store_owner,
+            title='Red Shirt',
+            sku='TEST-SKU-004',
+            price=Decimal('80.00'),
+            compare_price=Decimal('100.00'),
+            stock=5,
+            category='men',
+            sizes=['M', 'L'],
+            colors=['red']
+        )
+        blue = Product.objects.create(
+            store_owner=self.store_owner,
+            title='Blue Shirt',
+            sku='TEST-SKU-005',
+            price=Decimal('200.00'),
+            stock=0,
+            category='men',
+            sizes=['M'],
+            colors=['blue']
+        )
+        response = self.client.get('/api/products/', {'colors': 'red', 'sizes': 'M'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(response.data['results'][0]['id'], str(red.id))
+        # The color facet ignores the color filter itself
+        colors = {row['value']: row['count'] for row in response.data['facets']['colors']}
+        self.assertEqual(colors, {'red': 1, 'blue': 1})
+
+        response = self.client.get('/api/products/', {'in_stock': 'false'})
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(response.data['results'][0]['id'], str(blue.id))
+
+        response = self.client.get('/api/products/', {'min_price': 'cheap'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        red.delete()
+        blue.delete()
+
+    def test_search_products_api(self):
+        """Test search ranks matches and normalizes Arabic letters"""
+        extra = Product.objects.create(
+            store_owner=self.store_owner,
+            title='پیراهن مردانه',
+            description='پیراهن نخی',
+            sku='TEST-SKU-003',
+            price=Decimal('80.00'),
+            stock=5,
+            category='men',
+            colors=['آبی']
+        )
+        # Arabic yeh in the query still finds the Persian title
+        response = self.client.get('/api/products/search/', {'q': 'پيراهن'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total'], 1)
+        self.assertEqual(response.data['results'][0]['id'], str(extra.id))
+
+        response = self.client.get('/api/products/search/suggest/', {'q': 'پیر'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('پیراهن', response.data['suggestions'])
+
+        extra.status = 'inactive'
+        extra.save()
+        response = self.client.get('/api/products/search/', {'q': 'پیراهن'})
+        self.assertEqual(response.data['total'], 0)
+        extra.delete()
+
+    def test_bulk_import_and_export_products_api(self):
+        """Test CSV import upserts by SKU and export streams the catalog"""
+        self.client.force_authenticate(user=self.store_owner)
+        upload = SimpleUploadedFile('products.csv', (
+            'sku,title,description,price,stock,category,sizes\n'
+            'TEST-SKU-001,Renamed Product,,,7,,\n'
+            'BULK-001,Bulk Product,Bulk Description,90.00,3,kids,S|M\n'
+            'BULK-002,Broken Product,Description,-5,3,kids,\n'
+        ).encode('utf-8'), content_type='text/csv')
+        response = self.client.post('/api/products/import/', {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['created'], response.data['updated'], response.data['failed']), (1, 1, 1))
+        self.assertEqual(response.data['errors'][0]['line'], 4)
+
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.title, self.product.stock), ('Renamed Product', 7))
+        created = Product.objects.get(store_owner=self.store_owner, sku='BULK-001')
+        self.assertEqual(created.sizes, ['S', 'M'])
+        self.assertEqual(created.rating['count'], 0)
+
+        response = self.client.get('/api/products/export/', {'format_type': 'ndjson'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 2)
+        created.delete()
+
+    def test_store_products_streaming_api(self):
+        """Test streamed store products keep the regular response shape"""
+        response = self.client.get(f'/api/products/store/{self.store_owner.id}/', {'stream': 'json'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(data['total_products'], 1)
+        self.assertEqual(data['products'][0]['id'], str(self.product.id))
+
+        response = self.client.get(f'/api/products/store/{self.store_owner.id}/', {'stream': 'ndjson'})
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(json.loads(lines[0])['id'], str(self.product.id))
+
+        response = self.client.get(f'/api/products/store/{self.store_owner.id}/', {'stream': 'xml'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_product_rankings_api(self):
+        """Test precomputed rankings and the ?ordering= sort of the product list"""
+        other = Product.objects.create(
+            store_owner=self.store_owner, title='Bestseller', description='Description',
+            sku='TEST-SKU-002', price=Decimal('80.00'), stock=5, category='men'
+        )
+        Product.objects.filter(pk=other.pk).update(sales_count=5)
+        rankings.refresh(full=True)
+
+        response = self.client.get('/api/products/rankings/bestsellers/', {'category': 'men'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['scope'], 'category:men')
+        self.assertEqual([row['id'] for row in response.data['results']], [str(other.id)])
+        self.assertEqual(response.data['results'][0]['score'], 5)
+
+        # Products nobody rated stay out of top_rated
+        response = self.client.get('/api/products/rankings/top_rated/')
+        self.assertEqual(response.data['results'], [])
+
+        response = self.client.get('/api/products/rankings/cheapest/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        response = self.client.get('/api/products/', {'ordering': 'price_asc'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get('/api/products/', {'ordering': 'random'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        other.delete()
+
 
 class CartAPITestCase(APITestCase):
     """Test Cart API endpoints"""
@@ -255,6 +447,32 @@ class CartAPITestCase(APITestCase):
         response = self.client.post('/api/carts/remove-item/', {'product_id': str(self.product.id)}, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_cart_item_operations_return_cart_state_api(self):
+        """Test repeated adds bump the quantity in place and updates return the new line"""
+        self.client.force_authenticate(user=self.customer)
+        cart_item_data = {
+            'product_id': str(self.product.id),
+            'quantity': 2
+        }
+        response = self.client.post(f'/api/carts/{self.cart.id}/add-item/', cart_item_data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.post(f'/api/carts/{self.cart.id}/add-item/', cart_item_data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['items']), 1)
+        self.assertEqual(response.data['items'][0]['quantity'], 4)
+
+        response = self.client.patch(
+            f'/api/carts/{self.cart.id}/update-item/{self.product.id}/',
+            {'quantity': 1, 'color': 'blue'},
+            format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['item']['quantity'], 1)
+        self.assertEqual(response.data['item']['color'], 'blue')
+
+        response = self.client.post(f'/api/carts/{self.cart.id}/remove-item/{self.product.id}/')
+        self.assertEqual(response.data['items'], [])
+
 
 class OrderAPITestCase(APITestCase):
     """Test Order API endpoints"""
@@ -319,6 +537,55 @@ class OrderAPITestCase(APITestCase):
         response = self.client.post('/api/orders/', order_data, format='json')
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
+    def test_create_order_from_cart_items_api(self):
+        """Test checkout decrements stock and creates order items"""
+        self.client.force_authenticate(user=self.customer)
+        order_data = {
+            'cart_items': [{'product_id': str(self.product.id), 'quantity': 3}],
+            'payment_method': 'card',
+            'shipping_address': {}
+        }
+        response = self.client.post('/api/orders/', order_data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 47)
+        self.assertEqual(self.product.sales_count, 3)
+        order = Order.objects.get(id=response.data['data']['id'])
+        self.assertEqual(order.items.count(), 1)
+        self.assertEqual(order.total_amount, Decimal('300.00'))
+        order.delete()
+
+    def test_create_order_rejects_overselling_api(self):
+        """Test checkout refuses quantities above stock"""
+        self.client.force_authenticate(user=self.customer)
+        order_data = {
+            'cart_items': [{'product_id': str(self.product.id), 'quantity': 51}],
+            'payment_method': 'card'
+        }
+        response = self.client.post('/api/orders/', order_data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 50)
+
+    def test_checkout_without_transaction_undoes_failed_writes(self):
+        """Test the standalone-server checkout gives stock back and drops its orders on failure"""
+        self.client.force_authenticate(user=self.customer)
+        order_data = {
+            'cart_items': [{'product_id': str(self.product.id), 'quantity': 3}],
+            'payment_method': 'card'
+        }
+        orders = Order.objects.count()
+        no_transactions = OperationFailure("Transaction numbers are only allowed on a replica set", code=ILLEGAL_OPERATION)
+        with mock.patch('pymongo.client_session.ClientSession.with_transaction', side_effect=no_transactions), \
+                mock.patch('marketplace.checkout.write_updates', side_effect=OperationFailure("write failed")):
+            with self.assertRaises(OperationFailure):
+                self.client.post('/api/orders/', order_data, format='json')
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 50)
+        self.assertEqual(self.product.sales_count, 0)
+        self.assertEqual(Order.objects.count(), orders)
+        self.assertFalse(OrderItem.objects.filter(product=self.product).exists())
+
     def test_update_order_status_api(self):
         """Test updating order status"""
         self.client.force_authenticate(user=self.store_owner)
@@ -385,6 +652,34 @@ class WishlistAPITestCase(APITestCase):
         response = self.client.post('/api/wishlists/me/add/', add_data, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_related_products_api(self):
+        """Test related products from order and wishlist co-occurrence"""
+        order = Order.objects.create(
+            user=self.customer, store=self.store_owner,
+            total_amount=Decimal('300.00'), payment_method='online'
+        )
+        for product in (self.product1, self.product2):
+            OrderItem.objects.create(
+                order=order, product=product, title=product.title,
+                price=product.price, quantity=1
+            )
+        self.wishlist.add_product(self.product1.id)
+        self.wishlist.add_product(self.product2.id)
+        recommendations.refresh(full=True)
+
+        response = self.client.get(f'/api/products/{self.product1.id}/related/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['id'] for row in response.data['results']], [str(self.product2.id)])
+        self.assertEqual(response.data['results'][0]['score'], 1.0)
+
+        # Cancelled orders leave the wishlist, which alone is below MIN_SUPPORT
+        order.status = Order.Status.CANCELLED
+        order.save()
+        recommendations.refresh()
+        response = self.client.get(f'/api/products/{self.product1.id}/related/')
+        self.assertEqual(response.data['results'], [])
+        order.delete()
+
     def test_remove_from_wishlist_api(self):
         """Test removing product from wishlist"""
         self.client.force_authenticate(user=self.customer)
@@ -402,6 +697,31 @@ class WishlistAPITestCase(APITestCase):
         response = self.client.delete('/api/wishlists/me/clear/', format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_wishlist_items_api(self):
+        """Test paginated wishlist items, newest first"""
+        self.client.force_authenticate(user=self.customer)
+        added_at = timezone.now()
+        WishlistItem.objects.create(wishlist=self.wishlist, product=self.product1, added_at=added_at - timedelta(minutes=1))
+        WishlistItem.objects.create(wishlist=self.wishlist, product=self.product2, added_at=added_at)
+        response = self.client.get('/api/wishlists/me/items/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(response.data['results'][0]['product']['id'], str(self.product2.id))
+
+    def test_check_many_wishlist_api(self):
+        """Test checking several products at once"""
+        self.client.force_authenticate(user=self.customer)
+        self.wishlist.add_product(self.product1.id)
+        response = self.client.get(
+            f'/api/wishlists/me/check-many/?product_ids={self.product1.id},{self.product2.id},invalid'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], {
+            str(self.product1.id): True,
+            str(self.product2.id): False,
+            'invalid': False,
+        })
+
 
 class CommentAPITestCase(APITestCase):
     """Test Comment API endpoints"""
@@ -447,6 +767,46 @@ class CommentAPITestCase(APITestCase):
         response = self.client.get('/api/comments/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_product_comments_thread_api(self):
+        """Test product comments come back as paged reply trees"""
+        reply = Comment.objects.create(
+            product=self.product,
+            author=self.store_owner,
+            content='Thanks!',
+            parent=self.comment
+        )
+        nested = Comment.objects.create(
+            product=self.product,
+            author=self.customer,
+            content='You are welcome',
+            parent=reply
+        )
+        newer = Comment.objects.create(
+            product=self.product,
+            author=self.customer,
+            content='Still great'
+        )
+        response = self.client.get(f'/api/comments/product/{self.product.id}/', {'page': 2, 'page_size': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_comments'], 2)
+        thread = response.data['comments'][0]
+        self.assertEqual(thread['id'], str(self.comment.id))
+        self.assertEqual(thread['replies'][0]['author']['full_name'], 'Jane Smith')
+        self.assertEqual(thread['replies'][0]['replies'][0]['id'], str(nested.id))
+
+        response = self.client.get(f'/api/comments/product/{self.product.id}/', {'collapsed': 'true'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        collapsed = {c['id']: c for c in response.data['comments']}
+        self.assertNotIn('replies', collapsed[str(self.comment.id)])
+        self.assertEqual(collapsed[str(self.comment.id)]['reply_count'], 1)
+
+        response = self.client.get(f'/api/comments/{self.comment.id}/thread/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['replies'][0]['replies'][0]['id'], str(nested.id))
+        newer.delete()
+        nested.delete()
+        reply.delete()
+
     def test_retrieve_comment_api(self):
         """Test retrieving comment via API"""
         response = self.client.get(f'/api/comments/{self.comment.id}/')
@@ -546,3 +906,48 @@ class CategoryAPITestCase(APITestCase):
         """Test listing categories via API"""
         response = self.client.get('/api/categories/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_stores_by_category_api(self):
+        """Test stores are grouped, counted and ordered via API"""
+        small_store = StoreOwner.objects.create_store_owner(
+            phone="09191111111",
+            password="storepass123",
+            store_name="Small Store"
+        )
+        big_store = StoreOwner.objects.create_store_owner(
+            phone="09192222222",
+            password="storepass123",
+            store_name="Big Store"
+        )
+        Product.objects.create(
+            store_owner=small_store, title="Shirt", sku="SMALL-001",
+            price=Decimal("10.00"), stock=5, category="men", status="active"
+        )
+        for i in range(2):
+            Product.objects.create(
+                store_owner=big_store, title=f"Shirt {i}", sku=f"BIG-00{i}",
+                price=Decimal("10.00"), stock=5, category="men", status="active"
+            )
+        Product.objects.create(
+            store_owner=big_store, title="Dress", sku="BIG-100",
+            price=Decimal("10.00"), stock=5, category="women", status="active"
+        )
+
+        response = self.client.get('/api/categories/men/stores/', {'page_size': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_stores'], 2)
+        self.assertEqual(len(response.data['stores']), 1)
+        self.assertEqual(response.data['stores'][0]['store_name'], "Big Store")
+        self.assertEqual(response.data['stores'][0]['products_count'], 2)
+
+        response = self.client.get('/api/categories/men/stores/', {'ordering': 'unknown'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(f'/api/categories/men/stores/{big_store.id}/products/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_products'], 2)
+        self.assertNotIn('facets', response.data)
+
+        response = self.client.get(f'/api/categories/men/stores/{big_store.id}/products/', {'max_price': '5'})
+        self.assertEqual(response.data['total_products'], 0)
+        self.assertIn('facets', response.data)
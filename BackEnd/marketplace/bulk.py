@@ -0,0 +1,257 @@
+import csv
+import io
+import json
+
+from django.utils import timezone
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .cache import product_cache
+from .models import Product
+from .mongo import column, get_collection, get_connection
+from .ratings import empty_rating
+from .search import search_index
+from .serializers import ProductImportSerializer
+from .stats import count_active_products
+
+
+FORMATS = ('csv', 'ndjson')
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+# Columns read on import, in CSV order
+IMPORT_FIELDS = (
+    'sku', 'title', 'description', 'price', 'compare_price', 'stock',
+    'category', 'sizes', 'colors', 'tags', 'status',
+)
+EXPORT_FIELDS = ('id', *IMPORT_FIELDS, 'views', 'sales_count', 'created_at', 'updated_at')
+
+# sizes, colors and tags are written as one CSV cell joined with this
+LIST_FIELDS = ('sizes', 'colors', 'tags')
+LIST_SEPARATOR = '|'
+
+
+def format_for(filename, default='csv'):
+    """Guess the import format from a file name"""
+    if filename and filename.lower().endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    if filename and filename.lower().endswith('.csv'):
+        return 'csv'
+    return default
+
+
+def read_rows(stream, fmt):
+    """
+    Yield (line number, row) from a CSV or NDJSON byte stream without reading
+    it whole. Rows that are not valid JSON objects are yielded as None.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, {
+                name: [item.strip() for item in value.split(LIST_SEPARATOR) if item.strip()]
+                if name in LIST_FIELDS else value
+                for name, value in row.items()
+                if name in IMPORT_FIELDS and value not in (None, '')
+            }
+        return
+
+    for number, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield number, row if isinstance(row, dict) else None
+
+
+class ProductImporter:
+    """
+    Imports rows for one store owner in batches. Per batch: one `$in` query
+    finds which SKUs already exist under unique_sku_per_store_owner, every
+    row is validated with ProductImportSerializer (partially for existing
+    SKUs), and all rows are written with one unordered bulk_write of upserts
+    keyed on (store_owner, sku). Search entries and cached payloads of the
+    written products are refreshed once per batch.
+    """
+    # Row errors kept in the report; the rest are only counted
+    error_limit = 100
+
+    def __init__(self, store_owner, batch_size=500, update_existing=True):
+        self.store_owner = store_owner
+        self.batch_size = batch_size
+        self.update_existing = update_existing
+        self.created = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors = []
+        self._seen_skus = set()
+
+    def run(self, rows):
+        """Import (line number, row) pairs and return the report"""
+        batch = []
+        for line, row in rows:
+            batch.append((line, row))
+            if len(batch) >= self.batch_size:
+                self._import_batch(batch)
+                batch = []
+        if batch:
+            self._import_batch(batch)
+        return self.report()
+
+    def report(self):
+        return {
+            'created': self.created,
+            'updated': self.updated,
+            'failed': self.failed,
+            'errors': self.errors,
+        }
+
+    def _fail(self, line, errors):
+        self.failed += 1
+        if len(self.errors) < self.error_limit:
+            self.errors.append({'line': line, 'errors': errors})
+
+    def _existing(self, skus):
+        """Map SKUs that already exist for this store owner to their product ids"""
+        if not skus:
+            return {}
+        pk = column(Product, 'pk')
+        cursor = get_collection(Product).find(
+            {column(Product, 'store_owner'): self.store_owner.pk, 'sku': {'$in': list(skus)}},
+            projection={pk: 1, 'sku': 1},
+        )
+        return {doc['sku']: doc[pk] for doc in cursor}
+
+    def _validate(self, batch, existing):
+        rows = []
+        for line, row in batch:
+            if row is None:
+                self._fail(line, {'non_field_errors': ["سطر باید یک شیء JSON معتبر باشد"]})
+                continue
+            sku = str(row.get('sku') or '').strip()
+            serializer = ProductImportSerializer(data=row, partial=sku in existing)
+            if not serializer.is_valid():
+                self._fail(line, serializer.errors)
+                continue
+            if sku in self._seen_skus:
+                self._fail(line, {'sku': ["این کد محصول در همین فایل تکرار شده است"]})
+                continue
+            if sku in existing and not self.update_existing:
+                self._fail(line, {'sku': ["این کد محصول قبلاً برای این فروشگاه استفاده شده است"]})
+                continue
+            self._seen_skus.add(sku)
+            rows.append((line, sku, serializer.validated_data))
+        return rows
+
+    def _insert_defaults(self, values, now, connection):
+        """Model defaults for the fields a new row did not set"""
+        defaults = {}
+        for field in Product._meta.concrete_fields:
+            if field.primary_key or field.name in ('store_owner', 'sku') or field.column in values:
+                continue
+            if field.name == 'created_at':
+                defaults[field.column] = now
+            elif field.name == 'rating':
+                defaults[field.column] = empty_rating()
+            else:
+                defaults[field.column] = field.get_db_prep_save(field.get_default(), connection)
+        return defaults
+
+    def _import_batch(self, batch):
+        existing = self._existing({
+            str(row.get('sku') or '').strip() for _, row in batch if row is not None
+        } - {''})
+        rows = self._validate(batch, existing)
+        if not rows:
+            return
+
+        connection = get_connection(Product)
+        owner_key = column(Product, 'store_owner')
+        now = timezone.now()
+        operations = []
+        for _, sku, data in rows:
+            values = {
+                Product._meta.get_field(name).column:
+                    Product._meta.get_field(name).get_db_prep_save(value, connection)
+                for name, value in data.items() if name != 'sku'
+            }
+            values[column(Product, 'updated_at')] = now
+            operations.append(UpdateOne(
+                {owner_key: self.store_owner.pk, 'sku': sku},
+                {'$set': values, '$setOnInsert': self._insert_defaults(values, now, connection)},
+                upsert=True,
+            ))
+
+        try:
+            result = get_collection(Product).bulk_write(operations, ordered=False).bulk_api_result
+        except BulkWriteError as e:
+            # A concurrent write took the SKU between the `$in` check and the upsert
+            result = e.details
+        failed = {error['index'] for error in result.get('writeErrors', [])}
+        upserted = {entry['index']: entry['_id'] for entry in result.get('upserted', [])}
+
+        product_ids = []
+        matched = []
+        for index, (line, sku, _) in enumerate(rows):
+            if index in failed:
+                self._fail(line, {'sku': ["این کد محصول قبلاً برای این فروشگاه استفاده شده است"]})
+            elif index in upserted:
+                self.created += 1
+                product_ids.append(upserted[index])
+            else:
+                self.updated += 1
+                matched.append(sku)
+        # Rows created concurrently after the `$in` check were updated, look their ids up
+        unknown = [sku for sku in matched if sku not in existing]
+        existing.update(self._existing(unknown))
+        product_ids += [existing[sku] for sku in matched if sku in existing]
+
+        products = Product.objects.in_bulk(product_ids)
+        search_index.index_products(products.values())
+        for product_id in product_ids:
+            product_cache.invalidate(product_id)
+        # Upserts bypass Product.save, recount once per batch
+        count_active_products(self.store_owner.pk)
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return LIST_SEPARATOR.join(str(item) for item in value)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+class _Echo:
+    """File-like object whose write returns the line, so csv.writer can feed a generator"""
+
+    def write(self, value):
+        return value
+
+
+def export_rows(queryset, chunk_size=1000):
+    """Yield one dict per product, reading the queryset in chunks"""
+    return queryset.order_by('pk').values(*EXPORT_FIELDS).iterator(chunk_size=chunk_size)
+
+
+def export_stream(queryset, fmt, chunk_size=1000):
+    """Yield the encoded export of a queryset line by line"""
+    rows = export_rows(queryset, chunk_size)
+    if fmt == 'csv':
+        writer = csv.writer(_Echo())
+        # BOM so spreadsheet applications read Persian text as UTF-8
+        yield '\ufeff'.encode('utf-8') + writer.writerow(EXPORT_FIELDS).encode('utf-8')
+        for row in rows:
+            yield writer.writerow([_csv_value(row[name]) for name in EXPORT_FIELDS]).encode('utf-8')
+        return
+
+    for row in rows:
+        yield (json.dumps(row, ensure_ascii=False, default=str) + '\n').encode('utf-8')
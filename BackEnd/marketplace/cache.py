@@ -0,0 +1,155 @@
+import calendar
+import copy
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.apps import apps
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from rest_framework.utils.encoders import JSONEncoder
+
+from .mongo import column, get_collection
+
+
+class LocMemLRUBackend:
+    """
+    In-process LRU cache with per-entry expiry.
+    Values are stored and returned as deep copies, like a serializing
+    backend, so callers can edit what they get without touching the entry.
+    """
+
+    def __init__(self, max_entries=5000, timeout=300):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+        return copy.deepcopy(value)
+
+    def set(self, key, value, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        expires_at = time.monotonic() + timeout if timeout else None
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisBackend:
+    """
+    Redis cache storing JSON values.
+    Any client exposing redis-py's get/set/delete can be passed in instead,
+    e.g. a local stand-in for development and tests.
+    """
+
+    def __init__(self, client=None, url='redis://localhost:6379/0', prefix='marketplace:', timeout=300):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.timeout = timeout
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            return None
+        return json.loads(raw)
+
+    def set(self, key, value, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        self.client.set(self.prefix + key, json.dumps(value, cls=JSONEncoder), ex=timeout or None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+class ProductCache:
+    """
+    Read-through cache for serialized Product representations.
+    Each product has one entry holding its payload together with the
+    product's updated_at stamp, so a stale payload is never served for a
+    newer row. Raw writes (images, ratings, sales) bump updated_at as well,
+    through touch() or in their own update, so caches of other processes
+    miss too. View counts are the exception: they change too often to
+    version on and are read live by the callers.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @classmethod
+    def from_settings(cls):
+        options = getattr(settings, 'PRODUCT_CACHE', {})
+        backend_class = import_string(options.get('BACKEND', 'marketplace.cache.LocMemLRUBackend'))
+        return cls(backend_class(**options.get('OPTIONS', {})))
+
+    @staticmethod
+    def key(product_id):
+        return f"product:{product_id}"
+
+    @staticmethod
+    def version(updated_at):
+        # Millisecond precision, the resolution Mongo stores dates with
+        if not updated_at:
+            return None
+        return calendar.timegm(updated_at.utctimetuple()) * 1000 + updated_at.microsecond // 1000
+
+    def get(self, product_id, updated_at=None, base_url=''):
+        """Return the cached payload, or None on a miss or version mismatch"""
+        entry = self.backend.get(self.key(product_id))
+        if not entry or entry.get('base_url') != base_url:
+            return None
+        if updated_at is not None and entry.get('version') != self.version(updated_at):
+            return None
+        return entry['data']
+
+    def set(self, product, data, base_url=''):
+        self.backend.set(self.key(product.pk), {
+            'version': self.version(product.updated_at),
+            'base_url': base_url,
+            'data': data,
+        })
+
+    def invalidate(self, product_id):
+        self.backend.delete(self.key(product_id))
+
+    def touch(self, *product_ids):
+        """
+        Bump updated_at of products changed without Product.save (images,
+        sales) and drop their entries. Invalidating only reaches this
+        process's cache; the new stamp makes every other one miss too.
+        """
+        product = apps.get_model('marketplace', 'Product')
+        get_collection(product).update_many(
+            {column(product, 'pk'): {'$in': list(product_ids)}},
+            {'$set': {column(product, 'updated_at'): timezone.now()}},
+        )
+        for product_id in product_ids:
+            self.invalidate(product_id)
+
+
+product_cache = ProductCache.from_settings()
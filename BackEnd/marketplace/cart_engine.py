@@ -0,0 +1,116 @@
+from django.utils import timezone
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from .models import Cart
+from .mongo import column, get_collection
+
+
+# Fields of a cart line that update_item may change
+EDITABLE_FIELDS = ('quantity', 'color', 'size')
+
+
+class CartEngine:
+    """
+    Applies cart item operations server-side, one atomic update each:
+    `$inc` through an array filter for quantities, `$push`/`$pull` for
+    adding and removing lines, and upsert to create the cart on first add.
+    Every operation returns the updated cart from the same round trip, so
+    concurrent requests never overwrite each other's lines.
+    """
+    max_attempts = 3
+
+    def __init__(self, customer_id, cart_id=None):
+        self.customer_id = customer_id
+        self.cart_id = cart_id
+
+    @property
+    def collection(self):
+        return get_collection(Cart)
+
+    def _filter(self, **extra):
+        query = {column(Cart, 'user_id'): self.customer_id}
+        if self.cart_id is not None:
+            query[column(Cart, 'pk')] = self.cart_id
+        query.update(extra)
+        return query
+
+    def _to_cart(self, doc):
+        if doc is None:
+            return None
+        return Cart(
+            id=doc[column(Cart, 'pk')],
+            user_id_id=doc[column(Cart, 'user_id')],
+            items=doc.get('items', []),
+            created_at=doc.get('created_at'),
+            updated_at=doc.get('updated_at'),
+        )
+
+    def _update(self, query, update, **kwargs):
+        update.setdefault('$set', {})['updated_at'] = timezone.now()
+        return self._to_cart(self.collection.find_one_and_update(
+            query, update, return_document=ReturnDocument.AFTER, **kwargs,
+        ))
+
+    def get(self):
+        return self._to_cart(self.collection.find_one(self._filter()))
+
+    def add_item(self, item):
+        """
+        Add a line or bump its quantity. Returns (cart, created) where created
+        tells whether a new line was pushed; cart is None if the cart is missing.
+        """
+        product_id = item['product_id']
+        for _ in range(self.max_attempts):
+            cart = self._update(
+                self._filter(**{'items.product_id': product_id}),
+                {'$inc': {'items.$[line].quantity': item.get('quantity', 1)}},
+                array_filters=[{'line.product_id': product_id}],
+            )
+            if cart is not None:
+                return cart, False
+
+            try:
+                cart = self._update(
+                    self._filter(**{'items.product_id': {'$ne': product_id}}),
+                    {'$push': {'items': item}, '$setOnInsert': {'created_at': timezone.now()}},
+                    # Only "me" carts are created on demand
+                    upsert=self.cart_id is None,
+                )
+            except DuplicateKeyError:
+                # The cart exists and another request pushed this product first
+                continue
+            if cart is not None:
+                return cart, True
+            if not self.collection.count_documents(self._filter(), limit=1):
+                return None, False
+            # Another request pushed this product between the two updates
+        raise RuntimeError("Cart item could not be added after concurrent updates")
+
+    def update_item(self, product_id, changes):
+        """Set quantity/color/size of one line; None if the line does not exist"""
+        fields = {
+            f'items.$[line].{field}': value
+            for field, value in changes.items() if field in EDITABLE_FIELDS
+        }
+        if not fields:
+            return self._to_cart(self.collection.find_one(self._filter(**{'items.product_id': product_id})))
+        return self._update(
+            self._filter(**{'items.product_id': product_id}),
+            {'$set': fields},
+            array_filters=[{'line.product_id': product_id}],
+        )
+
+    def remove_item(self, product_id):
+        """Pull one line; None if the line does not exist"""
+        return self._update(
+            self._filter(**{'items.product_id': product_id}),
+            {'$pull': {'items': {'product_id': product_id}}},
+        )
+
+    def clear(self):
+        return self._update(self._filter(), {'$set': {'items': []}})
+
+
+def find_line(cart, product_id):
+    return next((item for item in cart.items if item.get('product_id') == product_id), None)
@@ -0,0 +1,53 @@
+from .models import Product, StoreOwner
+from .mongo import column, get_collection
+
+
+STORE_ORDERINGS = {
+    'products_count': {'products_count': -1, 'store.store_rating.average': -1, '_id': 1},
+    'rating': {'store.store_rating.average': -1, 'store.store_rating.count': -1, 'products_count': -1, '_id': 1},
+}
+
+
+def stores_by_category(category, ordering='products_count', page=1, page_size=20):
+    """
+    Return (stores, total) for approved stores with active products in a category.
+    One aggregation groups the products by store, joins store metadata with
+    `$lookup`, sorts, and pages with `$facet` so the total comes back in the
+    same round trip.
+    """
+    store_pk = column(StoreOwner, 'pk')
+    pipeline = [
+        {'$match': {'category': category, 'status': Product.Status.ACTIVE}},
+        {'$group': {'_id': f"${column(Product, 'store_owner')}", 'products_count': {'$sum': 1}}},
+        {'$lookup': {
+            'from': StoreOwner._meta.db_table,
+            'localField': '_id',
+            'foreignField': store_pk,
+            'pipeline': [
+                {'$match': {'seller_status': StoreOwner.SellerStatus.APPROVED}},
+                {'$project': {'store_name': 1, 'store_rating': 1, 'store_logo': 1}},
+            ],
+            'as': 'store',
+        }},
+        {'$unwind': '$store'},
+        {'$sort': STORE_ORDERINGS[ordering]},
+        {'$facet': {
+            'stores': [{'$skip': (page - 1) * page_size}, {'$limit': page_size}],
+            'total': [{'$count': 'count'}],
+        }},
+    ]
+    result = next(get_collection(Product).aggregate(pipeline), {})
+    total = result['total'][0]['count'] if result.get('total') else 0
+
+    logo_storage = StoreOwner._meta.get_field('store_logo').storage
+    stores = []
+    for row in result.get('stores', []):
+        store = row['store']
+        stores.append({
+            'id': str(row['_id']),
+            'store_name': store.get('store_name'),
+            'store_rating': store.get('store_rating') or {'average': 0, 'count': 0},
+            'store_logo': logo_storage.url(store['store_logo']) if store.get('store_logo') else None,
+            'products_count': row['products_count'],
+        })
+    return stores, total
@@ -0,0 +1,229 @@
+from collections import OrderedDict
+from decimal import Decimal
+
+from bson import ObjectId
+from bson.decimal128 import Decimal128
+from bson.errors import InvalidId
+from django.utils import timezone
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+from .cache import product_cache
+from .models import Order, OrderItem, Product
+from .mongo import column, get_client, get_collection
+from .stats import merge_updates, sales_updates, write_updates
+
+
+# Server error code for "transactions need a replica set or mongos"
+ILLEGAL_OPERATION = 20
+
+
+class CheckoutError(Exception):
+    """Raised when a cart cannot be turned into orders"""
+
+
+class CheckoutPipeline:
+    """
+    Turns cart items into one order per store in a constant number of round trips:
+    1. fetch every product with one `$in` query
+    2. decrement stock with conditional `$inc` (stock >= qty) in one bulk_write
+    3. insert all orders and order items with insert_many
+    4. bump store sales counters and analytics buckets with one bulk_write each
+    Steps 2-4 run inside one Mongo session transaction, so a cart either
+    checks out completely or not at all and stock can never go negative.
+    """
+
+    def __init__(self, customer, shipping_address=None, payment_method=None,
+                 status=Order.Status.PENDING, tracking_number=None):
+        self.customer = customer
+        self.shipping_address = shipping_address
+        self.payment_method = payment_method
+        self.status = status
+        self.tracking_number = tracking_number
+
+    def run(self, cart_items):
+        """Check out the cart items and return the created orders"""
+        quantities = self._collect_quantities(cart_items)
+        products = self._fetch_products(quantities)
+        plan = self._plan_orders(products, quantities)
+
+        client = get_client(Order)
+        try:
+            with client.start_session() as session:
+                session.with_transaction(lambda s: self._write(plan, quantities, s))
+        except OperationFailure as e:
+            if e.code != ILLEGAL_OPERATION:
+                raise
+            # Standalone server: no transactions, fall back to compensating writes
+            self._write_without_transaction(plan, quantities)
+
+        # Raw writes bypass Product.save, so drop the payloads holding the old stock
+        for product_id in quantities:
+            product_cache.invalidate(product_id)
+
+        order_ids = [order['_id'] for order in plan]
+        orders = Order.objects.in_bulk(order_ids)
+        return [orders[order_id] for order_id in order_ids if order_id in orders]
+
+    # Planning
+
+    def _collect_quantities(self, cart_items):
+        """Merge cart lines into {product ObjectId: quantity}"""
+        quantities = OrderedDict()
+        for item in cart_items:
+            product_id = item.get('product_id')
+            try:
+                key = ObjectId(str(product_id))
+                quantity = int(item.get('quantity', 1))
+            except (InvalidId, TypeError, ValueError):
+                raise CheckoutError(f"محصول با شناسه {product_id} یافت نشد")
+            if quantity <= 0:
+                raise CheckoutError("تعداد باید بزرگ‌تر از صفر باشد")
+            quantities[key] = quantities.get(key, 0) + quantity
+        return quantities
+
+    def _fetch_products(self, quantities):
+        products = Product.objects.in_bulk(list(quantities))
+        for product_id, quantity in quantities.items():
+            product = products.get(product_id)
+            if product is None or product.status != Product.Status.ACTIVE:
+                raise CheckoutError(f"محصول با شناسه {product_id} یافت نشد")
+            if product.stock < quantity:
+                raise CheckoutError(f"محصول {product.title} موجود نیست یا موجودی کافی ندارد")
+        return products
+
+    def _plan_orders(self, products, quantities):
+        """Group cart lines into one order plan per store"""
+        now = timezone.now()
+        orders = OrderedDict()
+        for product_id, quantity in quantities.items():
+            product = products[product_id]
+            store_id = product.store_owner_id
+            if store_id not in orders:
+                orders[store_id] = {
+                    '_id': ObjectId(),
+                    'store_id': store_id,
+                    'total_amount': Decimal('0'),
+                    'items': [],
+                }
+            order = orders[store_id]
+            total = product.price * quantity
+            order['items'].append({
+                'product_id': product_id,
+                'title': product.title,
+                'price': product.price,
+                'quantity': quantity,
+                'total': total,
+            })
+            order['total_amount'] += total
+
+        for order in orders.values():
+            order['created_at'] = now
+        return list(orders.values())
+
+    def _order_documents(self, plan):
+        order_documents, item_documents = [], []
+        for order in plan:
+            order_documents.append({
+                column(Order, 'pk'): order['_id'],
+                column(Order, 'user'): self.customer.pk,
+                column(Order, 'store'): order['store_id'],
+                'total_amount': Decimal128(order['total_amount']),
+                'shipping_address': self.shipping_address or {},
+                'status': self.status,
+                'payment_method': self.payment_method,
+                'tracking_number': self.tracking_number,
+                'created_at': order['created_at'],
+                'updated_at': order['created_at'],
+            })
+            for item in order['items']:
+                item_documents.append({
+                    column(OrderItem, 'pk'): ObjectId(),
+                    column(OrderItem, 'order'): order['_id'],
+                    column(OrderItem, 'product'): item['product_id'],
+                    'title': item['title'],
+                    'price': Decimal128(item['price']),
+                    'quantity': item['quantity'],
+                    'total': Decimal128(item['total']),
+                })
+        return order_documents, item_documents
+
+    def _stock_filter(self, product_id, quantity):
+        return {
+            column(Product, 'pk'): product_id,
+            'status': Product.Status.ACTIVE,
+            'stock': {'$gte': quantity},
+        }
+
+    def _stock_change(self, quantity):
+        return {
+            '$inc': {'stock': -quantity, 'sales_count': quantity},
+            '$set': {'updated_at': timezone.now()},
+        }
+
+    def _store_updates(self, plan):
+        return merge_updates(*(
+            sales_updates(
+                order['store_id'], 1, order['total_amount'], order['created_at'],
+                [(item['product_id'], item['quantity'], item['total']) for item in order['items']],
+            )
+            for order in plan
+        ))
+
+    # Writing
+
+    def _write(self, plan, quantities, session):
+        stock_updates = [
+            UpdateOne(self._stock_filter(product_id, quantity), self._stock_change(quantity))
+            for product_id, quantity in quantities.items()
+        ]
+        result = get_collection(Product).bulk_write(stock_updates, session=session)
+        if result.matched_count != len(stock_updates):
+            # Raising aborts the transaction and rolls back every decrement
+            raise CheckoutError("برخی محصولات موجودی کافی ندارند")
+
+        order_documents, item_documents = self._order_documents(plan)
+        get_collection(Order).insert_many(order_documents, session=session)
+        get_collection(OrderItem).insert_many(item_documents, session=session)
+        write_updates(self._store_updates(plan), session=session)
+
+    def _write_without_transaction(self, plan, quantities):
+        """Same writes as _write, undoing stock decrements and orders if any step fails"""
+        products = get_collection(Product)
+        decremented = []
+        for product_id, quantity in quantities.items():
+            result = products.update_one(
+                self._stock_filter(product_id, quantity),
+                self._stock_change(quantity),
+            )
+            if not result.matched_count:
+                self._restore_stock(decremented)
+                raise CheckoutError("برخی محصولات موجودی کافی ندارند")
+            decremented.append((product_id, quantity))
+
+        order_documents, item_documents = self._order_documents(plan)
+        try:
+            get_collection(Order).insert_many(order_documents)
+            get_collection(OrderItem).insert_many(item_documents)
+            write_updates(self._store_updates(plan))
+        except Exception:
+            # Store counters a failed write_updates applied in part are fixed by reconcile_store_stats
+            get_collection(OrderItem).delete_many({
+                column(OrderItem, 'pk'): {'$in': [doc[column(OrderItem, 'pk')] for doc in item_documents]},
+            })
+            get_collection(Order).delete_many({
+                column(Order, 'pk'): {'$in': [doc[column(Order, 'pk')] for doc in order_documents]},
+            })
+            self._restore_stock(decremented)
+            raise
+
+    def _restore_stock(self, decremented):
+        """Give back the (product_id, quantity) stock decrements of a failed checkout"""
+        if decremented:
+            get_collection(Product).bulk_write([
+                UpdateOne(
+                    {column(Product, 'pk'): product_id},
+                    {'$inc': {'stock': quantity, 'sales_count': -quantity}},
+                )
+                for product_id, quantity in decremented
+            ])
@@ -0,0 +1,133 @@
+import atexit
+import logging
+import threading
+from collections import defaultdict
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import PyMongoError
+
+from .mongo import column, get_collection
+from .rollups import view_bucket_updates, write_bucket_updates
+
+
+logger = logging.getLogger(__name__)
+
+
+class ViewCounter:
+    """
+    Product view counter built on Mongo `$inc`.
+    In direct mode every hit is one atomic `$inc`. In buffered mode hits are
+    coalesced per product in memory and written with a single `bulk_write`
+    every `flush_interval_ms` or `flush_max_events` hits, whichever is first.
+    Views of products whose store is given also go to the hourly and daily
+    analytics buckets, in the same round of writes.
+    """
+
+    def __init__(self, buffered=False, flush_interval_ms=1000, flush_max_events=500):
+        self.buffered = buffered
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_max_events = flush_max_events
+        self._pending = defaultdict(int)
+        self._owners = {}
+        self._events = 0
+        self._lock = threading.Lock()
+        self._timer = None
+
+    @classmethod
+    def from_settings(cls):
+        options = getattr(settings, 'VIEW_COUNTER', {})
+        return cls(
+            buffered=options.get('BUFFERED', False),
+            flush_interval_ms=options.get('FLUSH_INTERVAL_MS', 1000),
+            flush_max_events=options.get('FLUSH_MAX_EVENTS', 500),
+        )
+
+    @property
+    def model(self):
+        return apps.get_model('marketplace', 'Product')
+
+    def increment(self, product_id, amount=1, store_owner_id=None):
+        """
+        Count views for a product.
+        Returns the stored view count in direct mode, None when buffered.
+        """
+        if not self.buffered:
+            doc = get_collection(self.model).find_one_and_update(
+                {column(self.model, 'pk'): product_id},
+                {'$inc': {'views': amount}},
+                projection={'views': 1},
+                return_document=ReturnDocument.AFTER,
+            )
+            if doc and store_owner_id is not None:
+                write_bucket_updates(view_bucket_updates({(store_owner_id, product_id): amount}))
+            return doc['views'] if doc else None
+
+        with self._lock:
+            self._pending[product_id] += amount
+            if store_owner_id is not None:
+                self._owners[product_id] = store_owner_id
+            self._events += 1
+            flush_now = self._events >= self.flush_max_events
+            if not flush_now and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self._flush_on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+        if flush_now:
+            self.flush()
+        return None
+
+    def pending(self, product_id):
+        """Views counted for a product that are not written yet"""
+        with self._lock:
+            return self._pending.get(product_id, 0)
+
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        except PyMongoError:
+            logger.exception("Flushing buffered product views failed")
+        finally:
+            # Each timer runs on a new thread with its own connection; close it with the thread
+            connections.close_all()
+
+    def flush(self):
+        """Write all buffered views with one bulk_write, return products touched"""
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(int)
+            owners, self._owners = self._owners, {}
+            self._events = 0
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not pending:
+            return 0
+
+        pk = column(self.model, 'pk')
+        operations = [
+            UpdateOne({pk: product_id}, {'$inc': {'views': count}})
+            for product_id, count in pending.items()
+        ]
+        try:
+            get_collection(self.model).bulk_write(operations, ordered=False)
+        except PyMongoError:
+            # Put the counts back so the next flush retries them
+            with self._lock:
+                for product_id, count in pending.items():
+                    self._pending[product_id] += count
+                self._owners.update(owners)
+            raise
+
+        views = {(owners[product_id], product_id): count for product_id, count in pending.items() if product_id in owners}
+        try:
+            write_bucket_updates(view_bucket_updates(views))
+        except PyMongoError:
+            # The totals are written; retrying would count them twice
+            logger.exception("Writing %d product views to analytics buckets failed", len(views))
+        return len(operations)
+
+
+view_counter = ViewCounter.from_settings()
+atexit.register(view_counter.flush)
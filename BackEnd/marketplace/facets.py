@@ -0,0 +1,171 @@
+from decimal import Decimal, InvalidOperation
+
+from bson.decimal128 import Decimal128
+from rest_framework.exceptions import ParseError
+
+from .models import Product
+from .mongo import column, get_collection
+
+
+TRUE_VALUES = ('true', '1', 'yes')
+FALSE_VALUES = ('false', '0', 'no')
+
+# Values returned per array facet (sizes, colors, tags)
+FACET_LIMIT = 50
+
+ARRAY_FACETS = ('sizes', 'colors', 'tags')
+
+
+class ProductFilter:
+    """
+    Product listing filters (price range, sizes, colors, tags, stock, discount)
+    translated to Mongo clauses. Each clause is keyed by the facet it belongs to,
+    so facet counts can be computed disjunctively: every facet is counted with
+    all filters applied except its own.
+    """
+    params = ('min_price', 'max_price', *ARRAY_FACETS, 'in_stock', 'on_sale', 'min_discount')
+
+    def __init__(self, query_params):
+        self.query_params = query_params
+        self.clauses = {}
+        self._parse()
+
+    @classmethod
+    def is_requested(cls, query_params):
+        return 'facets' in query_params or any(param in query_params for param in cls.params)
+
+    # Parsing
+
+    def _decimal(self, name):
+        value = self.query_params.get(name)
+        if value in (None, ''):
+            return None
+        try:
+            return Decimal(value)
+        except InvalidOperation:
+            raise ParseError(f'{name} must be a number')
+
+    def _boolean(self, name):
+        value = self.query_params.get(name)
+        if value in (None, ''):
+            return None
+        if value.lower() in TRUE_VALUES:
+            return True
+        if value.lower() in FALSE_VALUES:
+            return False
+        raise ParseError(f'{name} must be true or false')
+
+    def _values(self, name):
+        values = []
+        for raw in self.query_params.getlist(name):
+            values += [value.strip() for value in raw.split(',') if value.strip()]
+        return values
+
+    def _parse(self):
+        price = {}
+        min_price, max_price = self._decimal('min_price'), self._decimal('max_price')
+        if min_price is not None:
+            price['$gte'] = Decimal128(min_price)
+        if max_price is not None:
+            price['$lte'] = Decimal128(max_price)
+        if price:
+            self.clauses['price'] = {'price': price}
+
+        for field in ARRAY_FACETS:
+            values = self._values(field)
+            if values:
+                # Any of the selected values; served by the field's multikey index
+                self.clauses[field] = {field: {'$in': values}}
+
+        in_stock = self._boolean('in_stock')
+        if in_stock is not None:
+            self.clauses['in_stock'] = {'stock': {'$gt': 0}} if in_stock else {'stock': 0}
+
+        discounted = {'$gt': ['$compare_price', '$price']}
+        on_sale = self._boolean('on_sale')
+        min_discount = self._decimal('min_discount')
+        sale = []
+        if on_sale is not None:
+            sale.append({'$expr': discounted if on_sale else {'$not': [discounted]}})
+        if min_discount is not None:
+            # (compare_price - price) / compare_price * 100 >= min_discount
+            sale.append({'$expr': {'$and': [discounted, {'$gte': [
+                {'$multiply': [{'$subtract': ['$compare_price', '$price']}, 100]},
+                {'$multiply': ['$compare_price', Decimal128(min_discount)]},
+            ]}]}})
+        if sale:
+            self.clauses['on_sale'] = {'$and': sale}
+
+    # Querying
+
+    def match(self, exclude=None):
+        clauses = [clause for key, clause in self.clauses.items() if key != exclude]
+        return {'$and': clauses} if clauses else {}
+
+    def _facet_pipelines(self):
+        pipelines = {}
+        for field in ARRAY_FACETS:
+            pipelines[field] = [
+                {'$match': self.match(exclude=field)},
+                {'$unwind': f'${field}'},
+                {'$group': {'_id': f'${field}', 'count': {'$sum': 1}}},
+                {'$sort': {'count': -1, '_id': 1}},
+                {'$limit': FACET_LIMIT},
+            ]
+        pipelines['in_stock'] = [
+            {'$match': self.match(exclude='in_stock')},
+            {'$group': {'_id': {'$gt': ['$stock', 0]}, 'count': {'$sum': 1}}},
+        ]
+        pipelines['on_sale'] = [
+            {'$match': self.match(exclude='on_sale')},
+            {'$group': {'_id': {'$gt': ['$compare_price', '$price']}, 'count': {'$sum': 1}}},
+        ]
+        pipelines['price'] = [
+            {'$match': self.match(exclude='price')},
+            {'$group': {'_id': None, 'min': {'$min': '$price'}, 'max': {'$max': '$price'}}},
+        ]
+        return pipelines
+
+    def aggregate(self, base_match, page=1, page_size=None, sort=None):
+        """
+        Run the filtered listing and every facet count in one `$facet` aggregation.
+        Returns (product ids in listing order, total, facets); newest first
+        unless a `$sort` document is given.
+        """
+        pk = column(Product, 'pk')
+        results = [
+            {'$match': self.match()},
+            {'$sort': sort or {'created_at': -1, pk: -1}},
+        ]
+        if page_size:
+            results += [{'$skip': (page - 1) * page_size}, {'$limit': page_size}]
+        results.append({'$project': {pk: 1}})
+
+        pipeline = [
+            {'$match': base_match},
+            {'$facet': {
+                'results': results,
+                'total': [{'$match': self.match()}, {'$count': 'count'}],
+                **self._facet_pipelines(),
+            }},
+        ]
+        result = next(get_collection(Product).aggregate(pipeline), {})
+        ids = [row[pk] for row in result.get('results', [])]
+        total = result['total'][0]['count'] if result.get('total') else 0
+        return ids, total, self._format_facets(result)
+
+    def _format_facets(self, result):
+        facets = {
+            field: [{'value': row['_id'], 'count': row['count']} for row in result.get(field, [])]
+            for field in ARRAY_FACETS
+        }
+        for flag in ('in_stock', 'on_sale'):
+            counts = {bool(row['_id']): row['count'] for row in result.get(flag, [])}
+            facets[flag] = {'true': counts.get(True, 0), 'false': counts.get(False, 0)}
+
+        price = (result.get('price') or [{}])[0]
+        facets['price'] = {
+            bound: str(price[bound].to_decimal()) if isinstance(price.get(bound), Decimal128) else price.get(bound)
+            for bound in ('min', 'max')
+        }
+        return facets
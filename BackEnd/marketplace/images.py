@@ -0,0 +1,181 @@
+import atexit
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+from PIL import Image, ImageOps
+
+from .cache import product_cache
+
+
+logger = logging.getLogger(__name__)
+
+# name: (width, height); a height of None keeps the aspect ratio
+DEFAULT_VARIANTS = {
+    'thumb': (150, 150),
+    'small': (320, None),
+    'medium': (640, None),
+    'large': (1280, None),
+}
+
+
+class ImageProcessor:
+    """
+    Generates resized WebP variants of product images.
+    Fixed-size variants are center-cropped; width-only ones keep the aspect
+    ratio and are skipped when wider than the original. Work runs on a small
+    thread pool so uploads return as soon as the original is stored; the
+    variant paths are then written to ProductImage.variants and the
+    product's cached payload is dropped.
+    """
+
+    def __init__(self, variants=None, quality=80, workers=2, run_async=True, upload_workers=4):
+        self.variants = variants or DEFAULT_VARIANTS
+        self.quality = quality
+        self.workers = workers
+        self.run_async = run_async
+        self.upload_workers = upload_workers
+        self._executor = None
+        self._upload_executor = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        options = getattr(settings, 'PRODUCT_IMAGES', {})
+        return cls(
+            variants=options.get('VARIANTS'),
+            quality=options.get('QUALITY', 80),
+            workers=options.get('WORKERS', 2),
+            run_async=options.get('ASYNC', True),
+            upload_workers=options.get('UPLOAD_WORKERS', 4),
+        )
+
+    @property
+    def model(self):
+        return apps.get_model('marketplace', 'ProductImage')
+
+    def _pool(self, attribute, workers, prefix):
+        with self._lock:
+            if getattr(self, attribute) is None:
+                setattr(self, attribute, ThreadPoolExecutor(max_workers=workers, thread_name_prefix=prefix))
+                atexit.register(getattr(self, attribute).shutdown)
+            return getattr(self, attribute)
+
+    @property
+    def executor(self):
+        return self._pool('_executor', self.workers, 'image-variants')
+
+    @property
+    def upload_executor(self):
+        # Separate from the variant pool so uploads never queue behind resizing
+        return self._pool('_upload_executor', self.upload_workers, 'image-uploads')
+
+    def store_uploads(self, field, instances, files):
+        """
+        Write uploaded files to the field's storage concurrently and point each
+        instance's field at its stored name. Blocks until every write is done.
+        """
+        def store(instance, file):
+            name = field.generate_filename(instance, file.name)
+            return field.storage.save(name, file, max_length=field.max_length)
+
+        if len(files) == 1:
+            names = [store(instances[0], files[0])]
+        else:
+            names = list(self.upload_executor.map(store, instances, files))
+        for instance, name in zip(instances, names):
+            setattr(instance, field.attname, name)
+
+    def submit(self, image_id):
+        """Queue variant generation for an image; runs inline when ASYNC is off"""
+        if not self.run_async:
+            return self.process(image_id)
+        return self.executor.submit(self._run, image_id)
+
+    def _run(self, image_id):
+        try:
+            return self.process(image_id)
+        except Exception:
+            logger.exception("Generating variants for product image %s failed", image_id)
+        finally:
+            # Worker threads hold their own connections
+            close_old_connections()
+
+    def render(self, source, size):
+        """Return WebP bytes of one variant and its final (width, height)"""
+        width, height = size
+        if height:
+            resized = ImageOps.fit(source, (width, height), Image.Resampling.LANCZOS)
+        else:
+            resized = source.copy()
+            resized.thumbnail((width, resized.height), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        resized.save(buffer, 'WEBP', quality=self.quality, method=4)
+        return buffer.getvalue(), resized.size
+
+    def variant_name(self, image, name):
+        return f"products/variants/{image.pk}/{name}.webp"
+
+    def process(self, image_id):
+        """Generate and store every variant of one image, return the variants map"""
+        image = self.model.objects.filter(pk=image_id).first()
+        if image is None or not image.image:
+            return None
+
+        with image.image.open('rb') as original:
+            source = ImageOps.exif_transpose(Image.open(original))
+            source.load()
+        if source.mode not in ('RGB', 'RGBA'):
+            source = source.convert('RGBA' if 'transparency' in source.info else 'RGB')
+
+        # Regenerating releases the previous renditions first
+        self.delete_variants(image)
+        variants = {}
+        for name, size in self.variants.items():
+            if not size[1] and size[0] > source.width:
+                # The original already serves this width
+                continue
+            data, (width, height) = self.render(source, size)
+            variants[name] = {
+                'name': default_storage.save(self.variant_name(image, name), ContentFile(data)),
+                'width': width,
+                'height': height,
+                'cropped': bool(size[1]),
+            }
+
+        self.model.objects.filter(pk=image.pk).update(variants=variants)
+        product_cache.touch(image.product_id)
+        return variants
+
+    def delete_variants(self, image):
+        for variant in (image.variants or {}).values():
+            default_storage.delete(variant['name'])
+
+
+image_processor = ImageProcessor.from_settings()
+
+
+def variant_urls(image, request=None):
+    """Map of variant name to URL, absolute when a request is given"""
+    urls = {}
+    for name, variant in (image.variants or {}).items():
+        url = default_storage.url(variant['name'])
+        urls[name] = request.build_absolute_uri(url) if request else url
+    return urls
+
+
+def srcset(image, request=None):
+    """`srcset` attribute value built from the width-only variants"""
+    urls = variant_urls(image, request)
+    candidates = sorted(
+        (variant['width'], urls[name])
+        for name, variant in (image.variants or {}).items()
+        if not variant.get('cropped')
+    )
+    return ', '.join(f"{url} {width}w" for width, url in candidates)
@@ -0,0 +1,139 @@
+from collections import defaultdict
+
+from .models import BaseUser, Comment, Product, ProductImage, StoreOwner, WishlistItem
+
+
+class ProductLoader:
+    """
+    Batch loader for the relations ProductSerializer renders.
+    Fetches images and store owners for a whole page of products with one
+    `$in` query per relation, then serves them from in-memory maps.
+    """
+
+    def __init__(self, products):
+        self.products = [product for product in products if product is not None]
+        self._product_ids = {product.pk for product in self.products}
+        self._images = None
+        self._store_owners = None
+
+    def has(self, product):
+        """Check if the product belongs to this loader's batch"""
+        return product.pk in self._product_ids
+
+    def _load_images(self):
+        self._images = {pk: [] for pk in self._product_ids}
+        if not self._product_ids:
+            return
+        images = ProductImage.objects.filter(
+            product_id__in=list(self._product_ids)
+        ).order_by('-is_primary', 'created_at')
+        for image in images:
+            self._images.setdefault(image.product_id, []).append(image)
+
+    def _load_store_owners(self):
+        self._store_owners = {}
+        store_owner_field = Product._meta.get_field('store_owner')
+        missing_ids = set()
+        for product in self.products:
+            # Reuse store owners already fetched through select_related
+            if store_owner_field.is_cached(product):
+                self._store_owners[product.store_owner_id] = product.store_owner
+            else:
+                missing_ids.add(product.store_owner_id)
+        missing_ids -= set(self._store_owners)
+        if missing_ids:
+            self._store_owners.update(StoreOwner.objects.in_bulk(list(missing_ids)))
+
+    def images_for(self, product):
+        """Get images of a product ordered primary first"""
+        if self._images is None:
+            self._load_images()
+        return self._images.get(product.pk, [])
+
+    def store_owner_for(self, product):
+        """Get the store owner of a product"""
+        if self._store_owners is None:
+            self._load_store_owners()
+        return self._store_owners.get(product.store_owner_id) or product.store_owner
+
+
+class CommentThreadLoader:
+    """
+    Loads the reply trees of a page of top-level comments in constant queries:
+    one for every reply under the page's roots (via Comment.root), one `$in`
+    for the authors and one for the products. Relations are attached to the
+    comment objects so the serializer renders the whole tree without further
+    lookups. With load_replies=False only authors and products are loaded,
+    for collapsed listings.
+    """
+
+    def __init__(self, roots, product=None, load_replies=True):
+        self.roots = list(roots)
+        self.comments = {comment.pk: comment for comment in self.roots}
+        self.children = defaultdict(list)
+        if not self.roots:
+            return
+
+        if load_replies:
+            self._load_replies()
+
+        product_ids = {comment.product_id for comment in self.roots}
+        authors = BaseUser.objects.in_bulk(list({c.author_id for c in self.comments.values()}))
+        products = {product.pk: product} if product is not None else Product.objects.in_bulk(list(product_ids))
+        for comment in self.comments.values():
+            if comment.author_id in authors:
+                comment.author = authors[comment.author_id]
+            if comment.product_id in products:
+                comment.product = products[comment.product_id]
+            if comment.parent_id in self.comments:
+                comment.parent = self.comments[comment.parent_id]
+
+    def _load_replies(self):
+        # A reply of a reply has the same root, so one query covers every depth
+        root_ids = [comment.root_id or comment.pk for comment in self.roots]
+        replies = Comment.objects.filter(root_id__in=root_ids).order_by('created_at')
+        for reply in replies:
+            reply = self.comments.setdefault(reply.pk, reply)
+            self.children[reply.parent_id].append(reply)
+
+    def replies_for(self, comment):
+        """Get direct replies of a comment, oldest first"""
+        return self.children.get(comment.pk, [])
+
+
+class WishlistLoader:
+    """
+    Batch loader for wishlist items. Fetches the items of a page of wishlists
+    with one `$in` query (newest first), their products with one more, and
+    leaves images to a ProductLoader over those products. A page of items
+    that is already loaded can be passed directly as `items`.
+    """
+
+    def __init__(self, wishlists=(), items=None):
+        self._wishlist_ids = {wishlist.pk for wishlist in wishlists}
+        if items is None:
+            items = WishlistItem.objects.filter(
+                wishlist_id__in=list(self._wishlist_ids)
+            ).order_by('-added_at', '-id') if self._wishlist_ids else []
+        self.items = list(items)
+        self._items = defaultdict(list)
+        for item in self.items:
+            self._items[item.wishlist_id].append(item)
+
+        product_ids = list({item.product_id for item in self.items})
+        products = Product.objects.in_bulk(product_ids) if product_ids else {}
+        for item in self.items:
+            if item.product_id in products:
+                item.product = products[item.product_id]
+        self.products = ProductLoader(products.values())
+
+    def has(self, wishlist):
+        """Check if the wishlist belongs to this loader's batch"""
+        return wishlist.pk in self._wishlist_ids
+
+    def items_for(self, wishlist):
+        """Get items of a wishlist, most recently added first"""
+        return self._items.get(wishlist.pk, [])
+
+    def images_for(self, product):
+        return self.products.images_for(product)
@@ -0,0 +1,35 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from marketplace.bulk import FORMATS, export_stream
+from marketplace.models import Product, StoreOwner
+
+
+class Command(BaseCommand):
+    help = "Export products as CSV or NDJSON without loading the catalog into memory"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--store-owner', help="Phone number of the store owner, all products if omitted")
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--output', default='-', help="File to write, or - for stdout")
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Products read per batch")
+
+    def handle(self, *args, **options):
+        queryset = Product.objects.all()
+        if options['store_owner']:
+            try:
+                store_owner = StoreOwner.objects.get(phone=options['store_owner'])
+            except StoreOwner.DoesNotExist:
+                raise CommandError(f"Store owner {options['store_owner']} not found")
+            queryset = queryset.filter(store_owner=store_owner)
+
+        chunks = export_stream(queryset, options['format'], chunk_size=options['chunk_size'])
+        if options['output'] == '-':
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+        else:
+            with open(options['output'], 'wb') as stream:
+                for chunk in chunks:
+                    stream.write(chunk)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.images import image_processor
+from marketplace.models import ProductImage
+
+
+class Command(BaseCommand):
+    help = "Generate resized WebP variants for product images"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Regenerate images that already have variants")
+
+    def handle(self, *args, **options):
+        processed = 0
+        for image in ProductImage.objects.only('pk', 'variants').iterator(chunk_size=500):
+            if image.variants and not options['all']:
+                continue
+            if image_processor.process(image.pk) is not None:
+                processed += 1
+        self.stdout.write(self.style.SUCCESS(f"Generated variants for {processed} images"))
@@ -0,0 +1,40 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from marketplace.bulk import FORMATS, ProductImporter, format_for, read_rows
+from marketplace.models import StoreOwner
+
+
+class Command(BaseCommand):
+    help = "Create or update a store owner's products from a CSV or NDJSON file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('store_owner', help="Phone number of the store owner")
+        parser.add_argument('path', help="File to import, or - for stdin")
+        parser.add_argument('--format', choices=FORMATS, help="Defaults to the file extension, else csv")
+        parser.add_argument('--batch-size', type=int, default=500, help="Rows validated and written per batch")
+        parser.add_argument('--no-update', action='store_true', help="Reject rows whose SKU already exists")
+
+    def handle(self, *args, **options):
+        try:
+            store_owner = StoreOwner.objects.get(phone=options['store_owner'])
+        except StoreOwner.DoesNotExist:
+            raise CommandError(f"Store owner {options['store_owner']} not found")
+
+        path = options['path']
+        fmt = options['format'] or format_for(path)
+        importer = ProductImporter(
+            store_owner, batch_size=options['batch_size'], update_existing=not options['no_update'],
+        )
+        if path == '-':
+            report = importer.run(read_rows(sys.stdin.buffer, fmt))
+        else:
+            with open(path, 'rb') as stream:
+                report = importer.run(read_rows(stream, fmt))
+
+        for error in report['errors']:
+            self.stderr.write(f"line {error['line']}: {error['errors']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {report['created']}, updated {report['updated']}, failed {report['failed']}"
+        ))
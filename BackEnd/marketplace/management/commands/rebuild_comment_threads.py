@@ -0,0 +1,53 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from pymongo import UpdateOne
+
+from marketplace.models import Comment
+from marketplace.mongo import column, get_collection
+
+
+class Command(BaseCommand):
+    help = "Recompute root pointers, reply counts, thread totals and last reply times of all comments"
+
+    def handle(self, *args, **options):
+        comments = {
+            comment.pk: comment
+            for comment in Comment.objects.only('id', 'parent', 'created_at').iterator(chunk_size=1000)
+        }
+
+        replies = defaultdict(list)
+        for comment in comments.values():
+            if comment.parent_id in comments:
+                replies[comment.parent_id].append(comment.created_at)
+
+        def find_root(comment):
+            seen = set()
+            while comment.parent_id in comments and comment.pk not in seen:
+                seen.add(comment.pk)
+                comment = comments[comment.parent_id]
+            return comment.pk
+
+        roots = {comment.pk: find_root(comment) for comment in comments.values()}
+        thread = defaultdict(list)
+        for comment_id, root_id in roots.items():
+            if root_id != comment_id:
+                thread[root_id].append(comments[comment_id].created_at)
+
+        pk = column(Comment, 'pk')
+        updates = []
+        for comment in comments.values():
+            root_id = roots[comment.pk]
+            children = replies.get(comment.pk, [])
+            descendants = thread.get(comment.pk, [])
+            updates.append(UpdateOne({pk: comment.pk}, {'$set': {
+                column(Comment, 'root'): root_id if root_id != comment.pk else None,
+                'reply_count': len(children),
+                'last_reply_at': max(children) if children else None,
+                'thread_reply_count': len(descendants),
+                'thread_last_reply_at': max(descendants) if descendants else None,
+            }}))
+
+        for start in range(0, len(updates), 1000):
+            get_collection(Comment).bulk_write(updates[start:start + 1000], ordered=False)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt threads for {len(updates)} comments"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.cache import product_cache
+from marketplace.ratings import rebuild_ratings
+
+
+class Command(BaseCommand):
+    help = "Recompute product rating aggregates and histograms from individual ratings"
+
+    def handle(self, *args, **options):
+        product_ids = rebuild_ratings()
+        for product_id in product_ids:
+            product_cache.invalidate(product_id)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt ratings for {len(product_ids)} products"))
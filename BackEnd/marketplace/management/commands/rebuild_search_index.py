@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.search import search_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the product search index from all active products"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="Products read and written per batch")
+
+    def handle(self, *args, **options):
+        indexed = search_index.rebuild(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} products"))
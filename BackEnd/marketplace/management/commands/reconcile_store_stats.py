@@ -0,0 +1,29 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from marketplace.models import StoreOwner
+from marketplace.rollups import rebuild_buckets
+from marketplace.stats import reconcile
+
+
+class Command(BaseCommand):
+    help = "Recompute store statistics and analytics buckets from products and orders (run periodically)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--store-owner', help="Phone number of the store owner, all stores if omitted")
+        parser.add_argument('--days', type=int, default=7, help="Days of hourly/daily buckets to rebuild, 0 for all history")
+
+    def handle(self, *args, **options):
+        store_owner_ids = None
+        if options['store_owner']:
+            try:
+                store_owner_ids = [StoreOwner.objects.get(phone=options['store_owner']).pk]
+            except StoreOwner.DoesNotExist:
+                raise CommandError(f"Store owner {options['store_owner']} not found")
+
+        fixed = reconcile(store_owner_ids)
+        since = timezone.now() - timedelta(days=options['days'] - 1) if options['days'] > 0 else None
+        buckets = rebuild_buckets(since, store_owner_ids)
+        self.stdout.write(self.style.SUCCESS(f"Corrected {fixed} stores, rebuilt {buckets} analytics buckets"))
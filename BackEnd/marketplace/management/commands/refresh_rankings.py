@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.rankings import rankings
+
+
+class Command(BaseCommand):
+    help = "Refresh the precomputed product rankings touched since the last run (run every few minutes)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help="Recompute every score and ranking")
+
+    def handle(self, *args, **options):
+        written = rankings.refresh(full=options['full'])
+        self.stdout.write(self.style.SUCCESS(f"Rewrote {written} rankings"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.recommendations import recommendations
+
+
+class Command(BaseCommand):
+    help = "Refresh the related products of orders and wishlists changed since the last run"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full', action='store_true',
+            help="Recompute every product (also picks up products removed from wishlists)",
+        )
+
+    def handle(self, *args, **options):
+        written = recommendations.refresh(full=options['full'])
+        self.stdout.write(self.style.SUCCESS(f"Rewrote {written} product recommendations"))
@@ -0,0 +1,170 @@
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseRedirect
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+from .storage import IMMUTABLE_CACHE_CONTROL, is_immutable
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Files outside the content-addressed store can change under the same URL
+MUTABLE_CACHE_CONTROL = 'public, max-age=0, must-revalidate'
+
+
+class RangeFile:
+    """Read-only view of `length` bytes of a file starting at `start`"""
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.remaining = length
+        file.seek(start)
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def get_etag(name, stat):
+    # Blob names are their content hash; other files change with mtime and size
+    if is_immutable(name):
+        return '"%s"' % os.path.splitext(os.path.basename(name))[0]
+    return '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+
+
+def parse_range(header, size):
+    """
+    Return (start, end) inclusive for a single `bytes=` range, None when the
+    header is absent or not a single byte range, or False if unsatisfiable.
+    """
+    match = RANGE_RE.match(header or '')
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # Suffix range: the last N bytes
+        start = max(size - int(last), 0)
+        end = size - 1
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+def range_applies(request, etag, last_modified):
+    """If-Range: only honour Range when the client's copy is still current"""
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    since = parse_http_date_safe(if_range)
+    return since is not None and int(last_modified) <= since
+
+
+def offload(response, name, path):
+    """Hand the body over to the web server when MEDIA_SERVING configures it"""
+    options = getattr(settings, 'MEDIA_SERVING', {})
+    mode = options.get('OFFLOAD')
+    if mode == 'x-accel-redirect':
+        response['X-Accel-Redirect'] = options.get('INTERNAL_PREFIX', '/protected-media/') + name
+    elif mode == 'x-sendfile':
+        response['X-Sendfile'] = path
+    else:
+        return False
+    return True
+
+
+def media_response(request, name, storage=None, filename=None):
+    """
+    Serve a stored file without reading it into memory.
+    Answers conditional requests (If-None-Match / If-Modified-Since) with 304,
+    single byte ranges with 206, and otherwise streams the whole file with
+    FileResponse, which uses the server's wsgi.file_wrapper (sendfile) when
+    available, or lets nginx/Apache send it via X-Accel-Redirect/X-Sendfile.
+    """
+    storage = storage or default_storage
+    try:
+        path = storage.path(name)
+    except NotImplementedError:
+        # Remote storages serve their own files
+        return HttpResponseRedirect(storage.url(name))
+    except SuspiciousFileOperation:
+        raise Http404('File not found')
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404('File not found')
+    if not os.path.isfile(path):
+        raise Http404('File not found')
+
+    etag = get_etag(name, stat)
+    last_modified = stat.st_mtime
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': IMMUTABLE_CACHE_CONTROL if is_immutable(name) else MUTABLE_CACHE_CONTROL,
+        'Accept-Ranges': 'bytes',
+    }
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=int(last_modified))
+    if not_modified is not None:
+        for header, value in headers.items():
+            not_modified[header] = value
+        return not_modified
+
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    disposition = f'inline; filename="{filename}"' if filename else None
+
+    response = HttpResponse(content_type=content_type)
+    if offload(response, name, path):
+        # The web server handles Range itself
+        response.headers.update(headers)
+        if disposition:
+            response['Content-Disposition'] = disposition
+        return response
+
+    byte_range = None
+    if 'HTTP_RANGE' in request.META and range_applies(request, etag, last_modified):
+        byte_range = parse_range(request.META['HTTP_RANGE'], stat.st_size)
+    if byte_range is False:
+        response = HttpResponse(status=416, content_type=content_type)
+        response['Content-Range'] = f'bytes */{stat.st_size}'
+        return response
+
+    if byte_range:
+        start, end = byte_range
+        length = end - start + 1
+        response = FileResponse(RangeFile(open(path, 'rb'), start, length), status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+    else:
+        length = stat.st_size
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    response['Content-Length'] = str(length)
+    response.headers.update(headers)
+    if disposition:
+        response['Content-Disposition'] = disposition
+    return response
+
+
+def serve_media(request, path):
+    """Serve anything under MEDIA_URL"""
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponse(status=405, headers={'Allow': 'GET, HEAD'})
+    return media_response(request, path.lstrip('/'))
@@ -1,3 +1,4 @@
+from bson import ObjectId
 from django.db import models
 from django_mongodb_backend.fields import ObjectIdAutoField
 from django.contrib.auth.base_user import AbstractBaseUser, BaseUserManager
@@ -5,6 +6,13 @@ from django.contrib.auth.models import PermissionsMixin
 from django.core.validators import RegexValidator, MinLengthValidator, MaxLengthValidator, MinValueValidator, MaxValueValidator
 from django.utils import timezone
 from datetime import timedelta
+from .cache import product_cache
+from .counters import view_counter
+from .ratings import apply_rating_change, apply_store_rating_change, empty_histogram, empty_rating, rebuild_ratings, record_store_rating
+from .search import INDEXED_FIELDS, search_index
+from .images import image_processor
+from .mongo import column, get_collection
+from . import stats
 
 
 phone_validator = RegexValidator(
@@ -140,7 +148,7 @@ class BaseUser(AbstractBaseUser, PermissionsMixin):
         return f"{self.first_name} {self.last_name}".strip()
 
     def has_profile_image(self):
-        return self.image is not None
+        return bool(self.image)
 
     def get_profile_image_info(self):
         if not self.image:
@@ -375,6 +383,9 @@ class StoreOwner(BaseUser):
         verbose_name_plural = "Store Owners"
 
 
+    # Written only through atomic updates (see marketplace.stats and marketplace.ratings)
+    COUNTER_FIELDS = ("active_products_count", "total_sales", "total_revenue", "seller_rating", "store_rating")
+
     def __str__(self):
         return f"{self.store_name} - {self.full_name}"
 
@@ -395,13 +406,19 @@ class StoreOwner(BaseUser):
             self.working_hours = {}
         if not self.payment_settings:
             self.payment_settings = {}
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            # Counters are maintained with $inc; a profile save must not write back stale copies
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTER_FIELDS
+            ]
         super().save(*args, **kwargs)
 
     
     # Store Logo Methods
     def has_store_logo(self):
         """Check if store has a logo"""
-        return self.store_logo is not None
+        return bool(self.store_logo)
 
     def get_store_logo_info(self):
         """Get store logo metadata"""
@@ -429,47 +446,67 @@ class StoreOwner(BaseUser):
         return self
     
     # Rating Methods
+    def rate(self, rater, kind, value):
+        """
+        Record `rater`'s seller or store rating; posting again replaces it.
+        Returns True when it is the rater's first rating of this kind.
+        """
+        aggregate, created = record_store_rating(rater.pk, self.pk, kind, value)
+        if aggregate is not None:
+            setattr(self, f"{kind}_rating", aggregate)
+        return created
+
     def update_seller_rating(self, new_rating):
-        """Update seller rating with new rating value"""
-        current = self.seller_rating or {"average": 0, "count": 0}
-        count = current.get("count", 0)
-        average = current.get("average", 0)
-        
-        new_count = count + 1
-        new_average = ((average * count) + new_rating) / new_count
-        
-        self.seller_rating = {
-            "average": round(new_average, 2),
-            "count": new_count
-        }
-        self.save(update_fields=["seller_rating"])
-    
+        """Add an anonymous seller rating to the aggregate"""
+        self.seller_rating = apply_store_rating_change(self.pk, 'seller', added=new_rating)
+
     def update_store_rating(self, new_rating):
-        """Update store rating with new rating value"""
-        current = self.store_rating or {"average": 0, "count": 0}
-        count = current.get("count", 0)
-        average = current.get("average", 0)
-        
-        new_count = count + 1
-        new_average = ((average * count) + new_rating) / new_count
-        
-        self.store_rating = {
-            "average": round(new_average, 2),
-            "count": new_count
-        }
-        self.save(update_fields=["store_rating"])
-    
+        """Add an anonymous store rating to the aggregate"""
+        self.store_rating = apply_store_rating_change(self.pk, 'store', added=new_rating)
+
     # Statistics Methods
     def increment_sales(self, amount):
-        """Increment total sales and revenue"""
-        self.total_sales += 1
-        self.total_revenue += amount
-        self.save(update_fields=["total_sales", "total_revenue"])
+        """Count one sale of `amount` with an atomic $inc, daily bucket included"""
+        stats.record_sale(self.pk, amount)
+        self.refresh_from_db(fields=["total_sales", "total_revenue"])
+
+    def update_active_products_count(self):
+        """Recount active products, for repairs; status changes keep it current"""
+        self.active_products_count = stats.count_active_products(self.pk)
+
+
+class MediaBlob(models.Model):
+    """
+    One file of the content-addressed media storage and the number of
+    file fields referencing it. Maintained by ContentAddressedStorage.
+    """
+    id = ObjectIdAutoField(primary_key=True)
+
+    name = models.CharField(
+        max_length=255,
+        unique=True,
+        help_text="مسیر فایل در فضای ذخیره‌سازی"
+    )
+    sha256 = models.CharField(
+        max_length=64,
+        help_text="هش محتوای فایل"
+    )
+    size = models.PositiveBigIntegerField(
+        default=0,
+        help_text="حجم فایل (بایت)"
+    )
+    refs = models.IntegerField(
+        default=0,
+        help_text="تعداد ارجاع‌ها به فایل"
+    )
+    created_at = models.DateTimeField(default=timezone.now)
 
-    def update_active_products_count(self, count):
-        """Update active products count"""
-        self.active_products_count = count
-        self.save(update_fields=["active_products_count"])
+    class Meta:
+        verbose_name = "Media Blob"
+        verbose_name_plural = "Media Blobs"
+
+    def __str__(self):
+        return f"{self.name} ({self.refs} refs)"
 
 
 class ProductImage(models.Model):
@@ -492,6 +529,11 @@ class ProductImage(models.Model):
         default=False,
         help_text="آیا تصویر اصلی محصول است"
     )
+    variants = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="نسخه‌های تغییر اندازه‌یافته تصویر (name, width, height)"
+    )
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -623,12 +665,26 @@ class Product(models.Model):
         default=0,
         help_text="تعداد فروش"
     )
+    # Ranking scores, written by marketplace.rankings
+    trending_score = models.FloatField(
+        default=0,
+        help_text="امتیاز پرطرفدار بودن (بازدید و فروش اخیر)"
+    )
+    rated_score = models.FloatField(
+        default=0,
+        help_text="امتیاز بیزی برای مرتب‌سازی بر اساس امتیاز"
+    )
 
     # Rating system
     rating = models.JSONField(
         default=dict,
         blank=True,
-        help_text="امتیاز محصول (average, count)"
+        help_text="امتیاز محصول (average, count, sum)"
+    )
+    rating_histogram = models.JSONField(
+        default=empty_histogram,
+        blank=True,
+        help_text="تعداد امتیازها به تفکیک ستاره"
     )
 
     created_at = models.DateTimeField(auto_now_add=True)
@@ -648,18 +704,84 @@ class Product(models.Model):
             models.Index(fields=['store_owner', 'category']),
             models.Index(fields=['status']),
             models.Index(fields=['category']),
+            # Covers the per-category store grouping on the home page
+            models.Index(fields=['category', 'status', 'store_owner']),
+            # Listing filters; sizes, colors and tags are arrays so these are multikey
+            models.Index(fields=['status', 'sizes']),
+            models.Index(fields=['status', 'colors']),
+            models.Index(fields=['status', 'tags']),
+            models.Index(fields=['status', 'price']),
+            # Keyset pagination on (created_at, _id)
+            models.Index(fields=['status', '-created_at', '-id']),
+            # ?ordering= on the listing; views has none so view $incs stay cheap
+            models.Index(fields=['status', '-sales_count', '-id']),
+            models.Index(fields=['status', '-trending_score', '-id']),
+            models.Index(fields=['status', '-rated_score', '-id']),
+            models.Index(fields=['store_owner', '-created_at', '-id']),
         ]
         verbose_name = "Product"
         verbose_name_plural = "Products"
 
+    # Written only through atomic updates; full saves leave them alone
+    COUNTER_FIELDS = ("views", "sales_count", "rating", "rating_histogram", "trending_score", "rated_score")
+
     def __str__(self):
         return f"{self.title} - {self.sku}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Status as loaded, to spot status changes on save
+        instance._saved_status = instance.__dict__.get("status")
+        return instance
+
     def save(self, *args, **kwargs):
         # Initialize rating if empty
         if not self.rating:
-            self.rating = {"average": 0, "count": 0}
+            self.rating = empty_rating()
+        if not self.rating_histogram:
+            self.rating_histogram = empty_histogram()
+        adding = self._state.adding
+        update_fields = kwargs.get("update_fields")
+        old_status = None
+        if not adding and (update_fields is None or "status" in update_fields) \
+                and self.status != getattr(self, "_saved_status", None):
+            old_status = stats.transition_status(Product, self.pk, self.status)
+        if not adding and update_fields is None:
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTER_FIELDS
+            ]
         super().save(*args, **kwargs)
+        if adding:
+            stats.adjust_active_products(self.store_owner_id, stats.active_delta(None, self.status))
+        elif old_status is not None:
+            stats.adjust_active_products(self.store_owner_id, stats.active_delta(old_status, self.status))
+        self._saved_status = self.status
+        product_cache.invalidate(self.pk)
+        # Counter-only saves (sales, rating) leave the search entry untouched
+        if update_fields is None or set(update_fields) & set(INDEXED_FIELDS):
+            search_index.index_product(self)
+
+    def delete(self, *args, **kwargs):
+        product_id = self.pk
+        images = list(self.images.all())
+        # Before the cascade removes the search document holding the tokens to decrement
+        search_index.unindex_product(product_id)
+        # Remove the row atomically first: only the delete that removed it sees
+        # its stored status, so a concurrent or repeated delete counts once
+        removed = get_collection(Product).find_one_and_delete(
+            {column(Product, 'pk'): product_id}, projection={'status': 1},
+        )
+        result = super().delete(*args, **kwargs)
+        if removed is not None:
+            stats.adjust_active_products(self.store_owner_id, stats.active_delta(removed['status'], None))
+        # Rows go with the cascade, the files' references are released here
+        for image in images:
+            image.image.delete(save=False)
+            image_processor.delete_variants(image)
+        product_cache.invalidate(product_id)
+        return result
 
     # Product Properties
     @property
@@ -683,36 +805,48 @@ class Product(models.Model):
     def add_image(self, images, is_primary=False):
         """Add image(s) to the product. Can handle single image or list of images."""
         if isinstance(images, list):
-            added_images = []
-            for i, image in enumerate(images):
-                added = self._add_single_image(image, is_primary if i == 0 else False)
-                added_images.append(added)
-            return added_images
-        else:
-            return self._add_single_image(images, is_primary)
-
-    def _add_single_image(self, image, is_primary=False):
-        """Add a single image file to the product"""
+            return self.add_images(images, is_primary)
+        return self.add_images([images], is_primary)[0]
+
+    def add_images(self, files, is_primary=False):
+        """
+        Add several image files in one batch: files are written concurrently,
+        the rows go in with one bulk insert and the primary image is decided
+        once. With is_primary the first file replaces the current primary,
+        otherwise it becomes primary only if the product has none.
+        """
+        if not files:
+            return []
         if is_primary:
             ProductImage.objects.filter(product=self, is_primary=True).update(is_primary=False)
-        product_image = ProductImage.objects.create(
-            product=self,
-            image=image,
-            is_primary=is_primary or not self.images.exists()  # First image is primary by default
-        )
-        return product_image
+        else:
+            is_primary = not self.images.filter(is_primary=True).exists()
+
+        images = [
+            ProductImage(id=ObjectId(), product=self, is_primary=is_primary and index == 0)
+            for index in range(len(files))
+        ]
+        image_processor.store_uploads(ProductImage._meta.get_field('image'), images, files)
+        ProductImage.objects.bulk_create(images)
+
+        for image in images:
+            image_processor.submit(image.pk)
+        product_cache.touch(self.pk)
+        return images
 
     def remove_image(self, image_id):
         """Remove an image by its ID"""
         try:
             product_image = ProductImage.objects.get(id=image_id, product=self)
             product_image.image.delete(save=False)  # Delete the file
+            image_processor.delete_variants(product_image)
             product_image.delete()
             # If we removed the primary image, make the first remaining image primary
             if product_image.is_primary and self.images.exists() and not self.images.filter(is_primary=True).exists():
                 first_image = self.images.first()
                 first_image.is_primary = True
                 first_image.save()
+            product_cache.touch(self.pk)
             return product_image
         except ProductImage.DoesNotExist:
             return None
@@ -733,27 +867,25 @@ class Product(models.Model):
             ProductImage.objects.filter(product=self, is_primary=True).update(is_primary=False)
             img.is_primary = True
             img.save()
+            product_cache.touch(self.pk)
             return True
         except ProductImage.DoesNotExist:
             return False
 
     # Rating Methods
     def update_rating(self):
-        """Recalculate product rating based on all individual ratings"""
-        ratings = self.ratings.all()
-        if ratings:
-            ratings_list = [r.rating for r in ratings]
-            average = sum(ratings_list) / len(ratings_list)
-            count = len(ratings_list)
-        else:
-            average = 0
-            count = 0
-
-        self.rating = {
-            "average": round(float(average), 2),
-            "count": count
-        }
-        self.save(update_fields=["rating"])
+        """Recalculate product rating from all individual ratings with one aggregation"""
+        rebuild_ratings([self.pk])
+        self.refresh_from_db(fields=["rating", "rating_histogram"])
+        product_cache.invalidate(self.pk)
+
+    def apply_rating(self, added=None, removed=None):
+        """Fold a new, edited or removed rating into the aggregate atomically"""
+        rating, histogram = apply_rating_change(self.pk, added=added, removed=removed)
+        if rating is not None:
+            self.rating = rating
+            self.rating_histogram = histogram
+        product_cache.invalidate(self.pk)
 
     def add_rating(self, customer, rating_value):
         """Add a new rating from a customer"""
@@ -763,20 +895,70 @@ class Product(models.Model):
             product=self,
             rating=rating_value
         )
-        # Recalculate aggregate rating
-        self.update_rating()
+        self.apply_rating(added=rating_value)
         return self
 
     # Analytics Methods
     def increment_views(self):
-        """Increment view count"""
-        self.views += 1
-        self.save(update_fields=["views"])
+        """Increment view count with an atomic $inc (buffered if VIEW_COUNTER is set to)"""
+        views = view_counter.increment(self.pk, store_owner_id=self.store_owner_id)
+        if views is None:
+            # Buffered: report the stored count plus the views not flushed yet
+            views = self.views + view_counter.pending(self.pk)
+        self.views = views
 
     def increment_sales(self):
-        """Increment sales count"""
-        self.sales_count += 1
-        self.save(update_fields=["sales_count"])
+        """Increment sales count with an atomic update"""
+        Product.objects.filter(pk=self.pk).update(
+            sales_count=models.F("sales_count") + 1, updated_at=timezone.now()
+        )
+        self.refresh_from_db(fields=["sales_count", "updated_at"])
+        product_cache.invalidate(self.pk)
+
+class ProductSearchDocument(models.Model):
+    """
+    Search index entry for one active product.
+    tokens holds the distinct normalized terms (multikey index = inverted index)
+    and tf their frequencies, which BM25 ranking reads.
+    """
+    id = ObjectIdAutoField(primary_key=True)
+    product = models.OneToOneField(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='search_document',
+        help_text="محصول"
+    )
+    tokens = models.JSONField(default=list, help_text="واژه‌های نمایه شده")
+    tf = models.JSONField(default=dict, help_text="تعداد تکرار هر واژه")
+    length = models.PositiveIntegerField(default=0, help_text="تعداد کل واژه‌ها")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['tokens']),
+        ]
+        verbose_name = "Product Search Document"
+        verbose_name_plural = "Product Search Documents"
+
+    def __str__(self):
+        return f"Search document for {self.product_id}"
+
+
+class SearchTerm(models.Model):
+    """Indexed term with its document frequency, used for idf and autocomplete"""
+    id = ObjectIdAutoField(primary_key=True)
+    term = models.CharField(max_length=255, unique=True, help_text="واژه")
+    df = models.IntegerField(default=0, help_text="تعداد محصولات شامل واژه")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-df']),
+        ]
+        verbose_name = "Search Term"
+        verbose_name_plural = "Search Terms"
+
+    def __str__(self):
+        return f"{self.term} ({self.df})"
+
 
 class ProductRating(models.Model):
     """
@@ -830,6 +1012,194 @@ class ProductRating(models.Model):
         return f"{self.customer.full_name} rated {self.product.title}: {self.rating}"
 
 
+class StoreRating(models.Model):
+    """
+    One user's rating of a seller or a store. Each user holds at most one
+    rating per store owner and kind; the StoreOwner seller_rating and
+    store_rating aggregates are kept from these rows.
+    """
+    class Kind(models.TextChoices):
+        SELLER = "seller", "Seller"
+        STORE = "store", "Store"
+
+    id = ObjectIdAutoField(primary_key=True)
+
+    rater = models.ForeignKey(
+        BaseUser,
+        on_delete=models.CASCADE,
+        related_name='store_ratings',
+        help_text="کاربری که امتیاز داده است"
+    )
+    store_owner = models.ForeignKey(
+        StoreOwner,
+        on_delete=models.CASCADE,
+        related_name='received_ratings',
+        help_text="فروشنده مورد امتیاز"
+    )
+    kind = models.CharField(
+        max_length=10,
+        choices=Kind.choices,
+        help_text="نوع امتیاز (فروشنده یا فروشگاه)"
+    )
+    rating = models.DecimalField(
+        max_digits=2,
+        decimal_places=1,
+        validators=[MinValueValidator(0), MaxValueValidator(5)],
+        help_text="امتیاز داده شده (0-5)",
+        error_messages={
+            'min_value': "امتیاز نمی‌تواند کمتر از 0 باشد",
+            'max_value': "امتیاز نمی‌تواند بیشتر از 5 باشد"
+        }
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Store Rating"
+        verbose_name_plural = "Store Ratings"
+        constraints = [
+            models.UniqueConstraint(
+                fields=['rater', 'store_owner', 'kind'],
+                name='unique_rater_store_rating'
+            )
+        ]
+        indexes = [
+            models.Index(fields=['store_owner', 'kind']),
+        ]
+
+    def __str__(self):
+        return f"{self.rater_id} rated {self.kind} {self.store_owner_id}: {self.rating}"
+
+
+class StatsBucket(models.Model):
+    """
+    Rollup counters of one store, or of one of its products, over one hour
+    or day starting at `start`. Views, checkout and order status changes
+    `$inc` the buckets of the moment they happened (an order's are those of
+    when it was placed), so dashboards read a few buckets per range instead
+    of scanning orders. Store-level buckets have no product.
+    """
+    class Granularity(models.TextChoices):
+        HOUR = "hour", "Hour"
+        DAY = "day", "Day"
+
+    id = ObjectIdAutoField(primary_key=True)
+
+    store_owner = models.ForeignKey(
+        StoreOwner,
+        on_delete=models.CASCADE,
+        related_name='stats_buckets',
+        help_text="فروشگاه"
+    )
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='stats_buckets',
+        help_text="محصول (خالی برای کل فروشگاه)"
+    )
+    granularity = models.CharField(
+        max_length=10,
+        choices=Granularity.choices,
+        default=Granularity.DAY,
+        help_text="بازه زمانی"
+    )
+    start = models.DateTimeField(help_text="شروع بازه")
+    views = models.IntegerField(default=0, help_text="تعداد بازدیدها")
+    orders = models.IntegerField(default=0, help_text="تعداد سفارش‌ها")
+    units = models.IntegerField(default=0, help_text="تعداد اقلام فروخته شده")
+    revenue = models.DecimalField(
+        max_digits=15,
+        decimal_places=2,
+        default=0,
+        help_text="درآمد"
+    )
+
+    class Meta:
+        verbose_name = "Stats Bucket"
+        verbose_name_plural = "Stats Buckets"
+        constraints = [
+            # Also serves range reads of one store's or product's series
+            models.UniqueConstraint(
+                fields=['store_owner', 'product', 'granularity', 'start'],
+                name='unique_stats_bucket'
+            )
+        ]
+        indexes = [
+            # Top products of a store over a range
+            models.Index(fields=['store_owner', 'granularity', 'start']),
+        ]
+
+    @property
+    def conversion(self):
+        """Orders per view in this period"""
+        return round(self.orders / self.views, 4) if self.views else 0
+
+    def __str__(self):
+        return f"{self.store_owner_id} {self.product_id or 'store'} {self.granularity} {self.start:%Y-%m-%d %H:%M}"
+
+
+class ProductRanking(models.Model):
+    """
+    One precomputed product ranking (bestsellers, trending, top_rated,
+    most_viewed) of one scope: "all", "category:<category>" or
+    "store:<store owner id>". entries holds up to RANKINGS['SIZE']
+    {"product": id, "score": value} in rank order. Written by
+    marketplace.rankings, never edited by hand.
+    """
+    id = ObjectIdAutoField(primary_key=True)
+    kind = models.CharField(max_length=20, help_text="نوع رتبه‌بندی")
+    scope = models.CharField(max_length=100, help_text="دامنه (کل، دسته‌بندی یا فروشگاه)")
+    entries = models.JSONField(default=list, help_text="محصولات به ترتیب رتبه")
+    computed_at = models.DateTimeField(help_text="آخرین تغییر رتبه‌بندی")
+    refreshed_at = models.DateTimeField(help_text="آخرین اجرای بازسازی")
+
+    class Meta:
+        verbose_name = "Product Ranking"
+        verbose_name_plural = "Product Rankings"
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'scope'], name='unique_product_ranking')
+        ]
+        indexes = [
+            models.Index(fields=['scope']),
+            models.Index(fields=['refreshed_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} ({self.scope})"
+
+
+class ProductRecommendation(models.Model):
+    """
+    Precomputed "customers also bought" list of one product: up to
+    RECOMMENDATIONS['SIZE'] {"product": id, "score": share} entries, best
+    first, where score is the share of the product's orders and wishlists
+    that also hold the other product. Written by
+    marketplace.recommendations, never edited by hand.
+    """
+    id = ObjectIdAutoField(primary_key=True)
+    product = models.OneToOneField(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='recommendation',
+        help_text="محصول"
+    )
+    related = models.JSONField(default=list, help_text="محصولات مرتبط به ترتیب امتیاز")
+    computed_at = models.DateTimeField(help_text="آخرین تغییر فهرست")
+    refreshed_at = models.DateTimeField(help_text="آخرین اجرای بازسازی")
+
+    class Meta:
+        verbose_name = "Product Recommendation"
+        verbose_name_plural = "Product Recommendations"
+        indexes = [
+            models.Index(fields=['refreshed_at']),
+        ]
+
+    def __str__(self):
+        return f"Recommendations for {self.product_id}"
+
+
 class Cart(models.Model):
     """
     Cart model for storing user carts.
@@ -969,10 +1339,35 @@ class Order(models.Model):
     class Meta:
         verbose_name = "Order"
         verbose_name_plural = "Orders"
+        indexes = [
+            # Keyset pagination on (created_at, _id)
+            models.Index(fields=['user', '-created_at', '-id']),
+            models.Index(fields=['store', '-created_at', '-id']),
+        ]
 
     def __str__(self):
         return f"Order {self.id} by {self.user.full_name}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_status = instance.__dict__.get("status")
+        return instance
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        update_fields = kwargs.get("update_fields")
+        old_status = None
+        if not adding and (update_fields is None or "status" in update_fields) \
+                and self.status != getattr(self, "_saved_status", None):
+            old_status = stats.transition_status(Order, self.pk, self.status)
+        super().save(*args, **kwargs)
+        # Checkout inserts its orders in bulk and counts them itself
+        if adding and self.status != self.Status.CANCELLED:
+            stats.record_sale(self.store_id, self.total_amount, self.created_at)
+        stats.order_status_changed(self, old_status)
+        self._saved_status = self.status
+
     def calculate_total(self):
         """Calculate total amount from order items"""
         total = sum(item.total for item in self.items.all())
@@ -1008,6 +1403,7 @@ class WishlistItem(models.Model):
         verbose_name_plural = "Wishlist Items"
         indexes = [
             models.Index(fields=['added_at']),
+            models.Index(fields=['wishlist', '-added_at', '-id']),
         ]
         # Unique constraint: each product can appear only once per wishlist
         constraints = [
@@ -1053,6 +1449,36 @@ class Comment(models.Model):
         related_name='replies',
         help_text="نظر والد (برای پاسخ‌ها)"
     )
+    root = models.ForeignKey(
+        'self',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='thread_replies',
+        help_text="نظر اصلی گفتگو (برای پاسخ‌ها)"
+    )
+
+    # Thread summary, maintained atomically by save() and delete()
+    reply_count = models.PositiveIntegerField(
+        default=0,
+        help_text="تعداد پاسخ‌های مستقیم"
+    )
+    last_reply_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="زمان آخرین پاسخ"
+    )
+    # Whole-thread summary, kept on the root comment only
+    thread_reply_count = models.PositiveIntegerField(
+        default=0,
+        help_text="تعداد همه پاسخ‌های گفتگو"
+    )
+    thread_last_reply_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="زمان آخرین پاسخ در گفتگو"
+    )
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -1060,14 +1486,71 @@ class Comment(models.Model):
         verbose_name = "Comment"
         verbose_name_plural = "Comments"
         ordering = ['created_at']
+        indexes = [
+            # Keyset pagination on (created_at, _id)
+            models.Index(fields=['product', 'parent', '-created_at', '-id']),
+            # Whole thread in one query
+            models.Index(fields=['root', 'created_at']),
+        ]
 
     def __str__(self):
         return f"Comment by {self.author.full_name} on {self.product.title}"
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        if adding and self.parent_id and not self.root_id:
+            self.root_id = self.parent.root_id or self.parent_id
+        super().save(*args, **kwargs)
+        if adding and self.parent_id:
+            Comment.objects.filter(pk=self.parent_id).update(
+                reply_count=models.F('reply_count') + 1,
+                last_reply_at=self.created_at,
+            )
+            Comment.objects.filter(pk=self.root_id).update(
+                thread_reply_count=models.F('thread_reply_count') + 1,
+                thread_last_reply_at=self.created_at,
+            )
+
+    def subtree_size(self):
+        """This comment plus every reply below it, read from one query over the thread"""
+        if not self.root_id:
+            return 1 + self.thread_reply_count
+        children = {}
+        for pk, parent_id in Comment.objects.filter(root_id=self.root_id).values_list('id', 'parent_id'):
+            children.setdefault(parent_id, []).append(pk)
+        size, pending = 0, [self.pk]
+        while pending:
+            size += 1
+            pending.extend(children.pop(pending.pop(), []))
+        return size
+
+    def delete(self, *args, **kwargs):
+        parent_id, root_id = self.parent_id, self.root_id
+        # Replies below this one go with the cascade and leave the thread too
+        removed = self.subtree_size() if root_id else 0
+        result = super().delete(*args, **kwargs)
+        if parent_id:
+            latest = Comment.objects.filter(parent_id=parent_id).order_by('-created_at').values_list(
+                'created_at', flat=True
+            ).first()
+            Comment.objects.filter(pk=parent_id, reply_count__gt=0).update(
+                reply_count=models.F('reply_count') - 1,
+                last_reply_at=latest,
+            )
+        if root_id:
+            latest = Comment.objects.filter(root_id=root_id).order_by('-created_at').values_list(
+                'created_at', flat=True
+            ).first()
+            Comment.objects.filter(pk=root_id, thread_reply_count__gte=removed).update(
+                thread_reply_count=models.F('thread_reply_count') - removed,
+                thread_last_reply_at=latest,
+            )
+        return result
+
     @property
     def is_reply(self):
         """Check if this comment is a reply"""
-        return self.parent is not None
+        return self.parent_id is not None
 
     def get_replies(self):
         """Get all direct replies to this comment"""
@@ -1155,6 +1638,7 @@ class Wishlist(models.Model):
         try:
             item = self.items.get(product_id=product_id)
             item.delete()
+            self.touch()
             return {'removed': True, 'message': 'Product removed from wishlist'}
         except WishlistItem.DoesNotExist:
             return {'removed': False, 'message': 'Product not found in wishlist'}
@@ -1162,12 +1646,21 @@ class Wishlist(models.Model):
     def clear(self):
         """Instance method to clear wishlist"""
         self.items.all().delete()
+        self.touch()
         return {'cleared': True, 'message': 'Wishlist cleared'}
 
+    def touch(self):
+        """Bump updated_at so removals reach the incremental recommendation refresh"""
+        Wishlist.objects.filter(pk=self.pk).update(updated_at=timezone.now())
+
     def has_product(self, product_id):
         """Instance method to check if product exists in wishlist"""
         return self.items.filter(product_id=product_id).exists()
 
+    def products_in(self, product_ids):
+        """Instance method to get which of the given products are in wishlist, in one query"""
+        return set(self.items.filter(product_id__in=list(product_ids)).values_list('product_id', flat=True))
+
     def get_recent_items(self, days=30):
         """Instance method to get recently added items"""
         cutoff_date = timezone.now() - timedelta(days=days)
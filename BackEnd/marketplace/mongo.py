@@ -0,0 +1,25 @@
+from django.db import connections, router
+
+
+def get_connection(model):
+    """Return the Django connection that stores the model"""
+    return connections[router.db_for_write(model)]
+
+
+def get_collection(model):
+    """Return the raw pymongo collection backing a model"""
+    return get_connection(model).get_collection(model._meta.db_table)
+
+
+def column(model, field_name):
+    """Return the document key a model field is stored under"""
+    if field_name == 'pk':
+        return model._meta.pk.column
+    return model._meta.get_field(field_name).column
+
+
+def get_client(model):
+    """Return the pymongo client behind the model's connection"""
+    connection = get_connection(model)
+    connection.ensure_connection()
+    return connection.connection
@@ -0,0 +1,99 @@
+from decimal import Decimal
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from .models import Product
+
+
+class LineStatus:
+    OK = 'ok'
+    PRICE_CHANGED = 'price_changed'
+    INSUFFICIENT_STOCK = 'insufficient_stock'
+    UNAVAILABLE = 'unavailable'
+
+
+def load_products(product_ids):
+    """Fetch products with one `$in` query, keyed by string id; malformed ids are skipped"""
+    keys = []
+    for product_id in product_ids:
+        try:
+            keys.append(ObjectId(str(product_id)))
+        except (InvalidId, TypeError):
+            continue
+    products = Product.objects.in_bulk(keys) if keys else {}
+    return {str(key): product for key, product in products.items()}
+
+
+def to_decimal(value):
+    return Decimal(str(value)) if value is not None else None
+
+
+class CartPricer:
+    """
+    Revalidates a whole cart against current product data with one query:
+    current price, stock and active status for every line, plus the delta
+    between each line's price_snapshot and the live price.
+    """
+
+    def __init__(self, items, products=None):
+        self.items = list(items or [])
+        self.products = products
+
+    def _products(self):
+        if self.products is None:
+            self.products = load_products(item.get('product_id') for item in self.items)
+        return self.products
+
+    def price_line(self, item, product):
+        quantity = int(item.get('quantity', 0))
+        snapshot = to_decimal(item.get('price_snapshot'))
+        line = dict(item)
+
+        if product is None or product.status != Product.Status.ACTIVE:
+            line.update({
+                'status': LineStatus.UNAVAILABLE,
+                'unit_price': None,
+                'line_total': Decimal('0'),
+                'price_delta': None,
+                'stock': 0,
+            })
+            return line
+
+        if product.stock < quantity:
+            line_status = LineStatus.INSUFFICIENT_STOCK
+        elif snapshot is not None and snapshot != product.price:
+            line_status = LineStatus.PRICE_CHANGED
+        else:
+            line_status = LineStatus.OK
+        line.update({
+            'status': line_status,
+            'title': product.title,
+            'unit_price': product.price,
+            'line_total': product.price * quantity,
+            'price_delta': product.price - snapshot if snapshot is not None else Decimal('0'),
+            'stock': product.stock,
+        })
+        return line
+
+    def price(self):
+        """Return the priced cart: lines, totals at current prices and the change since snapshot"""
+        products = self._products()
+        lines = [self.price_line(item, products.get(str(item.get('product_id')))) for item in self.items]
+
+        total_price = sum((line['line_total'] for line in lines), Decimal('0'))
+        # Lines added without a snapshot are taken at the current price
+        snapshot_total = sum(
+            ((to_decimal(line.get('price_snapshot')) or line['unit_price']) * int(line.get('quantity', 0))
+             for line in lines if line['status'] != LineStatus.UNAVAILABLE),
+            Decimal('0'),
+        )
+        return {
+            'items': lines,
+            'total_items': sum(int(line.get('quantity', 0)) for line in lines),
+            'total_price': total_price,
+            'snapshot_total': snapshot_total,
+            'price_delta': total_price - snapshot_total,
+            'has_changes': any(line['status'] != LineStatus.OK for line in lines),
+            'is_valid': all(line['status'] in (LineStatus.OK, LineStatus.PRICE_CHANGED) for line in lines),
+        }
@@ -0,0 +1,328 @@
+from datetime import timedelta
+
+from bson import ObjectId
+from django.conf import settings
+from django.utils import timezone
+from pymongo import UpdateOne
+
+from .cache import product_cache
+from .models import Product, ProductRanking, StatsBucket
+from .mongo import column, get_collection
+from .rollups import DAY, HOUR, bucket_start
+
+
+KINDS = ('bestsellers', 'trending', 'top_rated', 'most_viewed')
+
+# Product fields each ranking sorts by; trending_score and rated_score are
+# written by RankingEngine.update_scores
+SCORE_FIELDS = {
+    'bestsellers': 'sales_count',
+    'trending': 'trending_score',
+    'top_rated': 'rated_score',
+    'most_viewed': 'views',
+}
+
+# ?ordering= values of the product list: Django order_by fields, newest first by default
+PRODUCT_ORDERINGS = {
+    'newest': ('-created_at', '-id'),
+    'price_asc': ('price', '-id'),
+    'price_desc': ('-price', '-id'),
+    'bestsellers': ('-sales_count', '-id'),
+    'trending': ('-trending_score', '-id'),
+    'top_rated': ('-rated_score', '-id'),
+    'most_viewed': ('-views', '-id'),
+}
+DEFAULT_ORDERING = 'newest'
+
+ALL = 'all'
+
+
+def mongo_sort(ordering):
+    """PRODUCT_ORDERINGS entry as a raw `$sort` document"""
+    sort = {}
+    for name in PRODUCT_ORDERINGS[ordering]:
+        field = name.lstrip('-')
+        sort[column(Product, 'pk' if field == 'id' else field)] = -1 if name.startswith('-') else 1
+    return sort
+
+
+def scope_key(category=None, store_owner_id=None):
+    """Ranking scope: the whole catalog, one category or one store"""
+    if store_owner_id is not None:
+        return f'store:{store_owner_id}'
+    if category:
+        return f'category:{category}'
+    return ALL
+
+
+class RankingEngine:
+    """
+    Precomputed product rankings (bestsellers, trending, top rated, most
+    viewed) for the whole catalog, every category and every store, stored as
+    one ProductRanking document per kind and scope.
+
+    refresh() is incremental: it finds the products touched since the last
+    run (edited, viewed, sold, rated or with a changed trending score) and
+    recomputes only the scopes they belong to, with one `$topN` aggregation
+    per scope dimension. Trending scores are time-decayed views and units
+    sold read from the daily analytics buckets; top-rated uses a Bayesian
+    average that pulls products with few ratings towards the catalog mean.
+    """
+
+    def __init__(self, size=50, trending_days=14, half_life_days=3, sale_weight=10,
+                 min_votes=5, cache_timeout=300):
+        self.size = size
+        self.trending_days = trending_days
+        self.half_life_days = half_life_days
+        self.sale_weight = sale_weight
+        self.min_votes = min_votes
+        self.cache_timeout = cache_timeout
+
+    @classmethod
+    def from_settings(cls):
+        options = getattr(settings, 'RANKINGS', {})
+        return cls(
+            size=options.get('SIZE', 50),
+            trending_days=options.get('TRENDING_DAYS', 14),
+            half_life_days=options.get('HALF_LIFE_DAYS', 3),
+            sale_weight=options.get('SALE_WEIGHT', 10),
+            min_votes=options.get('MIN_VOTES', 5),
+            cache_timeout=options.get('CACHE_TIMEOUT', 300),
+        )
+
+    # Scores
+
+    def trending_scores(self, now):
+        """{product_id: score} from the product day buckets of the trending window"""
+        bucket = StatsBucket
+        product_key = column(bucket, 'product')
+        half_life_ms = self.half_life_days * 24 * 3600 * 1000
+        decay = {'$pow': [0.5, {'$divide': [{'$subtract': [now, '$start']}, half_life_ms]}]}
+        activity = {'$add': [
+            {'$ifNull': ['$views', 0]},
+            {'$multiply': [{'$ifNull': ['$units', 0]}, self.sale_weight]},
+        ]}
+        rows = get_collection(bucket).aggregate([
+            {'$match': {
+                product_key: {'$ne': None},
+                'granularity': DAY,
+                'start': {'$gte': bucket_start(now - timedelta(days=self.trending_days - 1), DAY)},
+            }},
+            {'$group': {'_id': f'${product_key}', 'score': {'$sum': {'$multiply': [activity, decay]}}}},
+        ])
+        return {row['_id']: round(row['score'], 4) for row in rows if row['score'] > 0}
+
+    def catalog_mean_rating(self):
+        """Average of every rating in the catalog, the Bayesian prior"""
+        row = next(get_collection(Product).aggregate([
+            {'$match': {'status': Product.Status.ACTIVE, 'rating.count': {'$gt': 0}}},
+            {'$group': {
+                '_id': None,
+                'sum': {'$sum': {'$ifNull': ['$rating.sum', {'$multiply': ['$rating.average', '$rating.count']}]}},
+                'count': {'$sum': '$rating.count'},
+            }},
+        ]), None)
+        return row['sum'] / row['count'] if row and row['count'] else 0
+
+    def rated_score(self, prior):
+        """Bayesian average (v * R + m * C) / (v + m), 0 for products nobody rated"""
+        count = {'$ifNull': ['$rating.count', 0]}
+        return {'$cond': [{'$gt': [count, 0]}, {'$round': [{'$divide': [
+            {'$add': [{'$multiply': [count, {'$ifNull': ['$rating.average', 0]}]}, self.min_votes * prior]},
+            {'$add': [count, self.min_votes]},
+        ]}, 4]}, 0]}
+
+    def update_scores(self, now):
+        """
+        Write trending_score and rated_score where they changed.
+        Returns the ids of products whose score changed.
+        """
+        collection = get_collection(Product)
+        pk = column(Product, 'pk')
+
+        scores = self.trending_scores(now)
+        current = {
+            doc[pk]: doc['trending_score']
+            for doc in collection.find({'trending_score': {'$gt': 0}}, projection={pk: 1, 'trending_score': 1})
+        }
+        changed = {
+            product_id for product_id in set(scores) | set(current)
+            if scores.get(product_id, 0) != current.get(product_id, 0)
+        }
+        if changed:
+            collection.bulk_write([
+                UpdateOne({pk: product_id}, {'$set': {'trending_score': scores.get(product_id, 0)}})
+                for product_id in changed
+            ], ordered=False)
+
+        # Compared against the stored score, so re-rated and new products and a
+        # moved prior (which shifts every rated product) are all picked up
+        rated = self.rated_score(round(self.catalog_mean_rating(), 2))
+        stale = {'$expr': {'$ne': [{'$ifNull': ['$rated_score', 0]}, rated]}}
+        rescored = [doc[pk] for doc in collection.find(stale, projection={pk: 1})]
+        if rescored:
+            collection.update_many({pk: {'$in': rescored}}, [{'$set': {'rated_score': rated}}])
+            changed.update(rescored)
+        return changed
+
+    # Incremental refresh
+
+    def touched_products(self, since):
+        """Products edited since `since` or with views or sales in the hour buckets since then"""
+        touched = set(Product.objects.filter(updated_at__gte=since).values_list('id', flat=True))
+        product_key = column(StatsBucket, 'product')
+        touched.update(get_collection(StatsBucket).distinct(product_key, {
+            product_key: {'$ne': None},
+            'granularity': HOUR,
+            'start': {'$gte': bucket_start(since, HOUR)},
+        }))
+        return touched
+
+    def scopes_of(self, product_ids):
+        """Scopes whose rankings a change to these products can affect"""
+        product_ids = list(product_ids)
+        if not product_ids:
+            return set()
+        scopes = {ALL}
+        for category, store_owner_id in Product.objects.filter(pk__in=product_ids).values_list('category', 'store_owner_id'):
+            scopes.add(scope_key(category=category))
+            scopes.add(scope_key(store_owner_id=store_owner_id))
+        # Products that moved category or were deactivated still sit in their old lists
+        listed = get_collection(ProductRanking).find(
+            {'entries.product': {'$in': [str(product_id) for product_id in product_ids]}},
+            projection={'scope': 1},
+        )
+        scopes.update(doc['scope'] for doc in listed)
+        return scopes
+
+    def last_refresh(self):
+        doc = get_collection(ProductRanking).find_one({}, sort=[('refreshed_at', 1)], projection={'refreshed_at': 1})
+        return doc['refreshed_at'] if doc else None
+
+    def refresh(self, full=False):
+        """Recompute scores and the rankings they changed; returns the rankings rewritten"""
+        now = timezone.now()
+        since = None if full else self.last_refresh()
+        if since is not None and timezone.is_naive(since):
+            since = timezone.make_aware(since, timezone.utc)
+
+        changed = self.update_scores(now)
+        if since is None:
+            scopes = None
+        else:
+            scopes = self.scopes_of(changed | self.touched_products(since))
+        written = self.compute(scopes, now)
+        # Marks this run for the next incremental refresh
+        get_collection(ProductRanking).update_many({}, {'$set': {'refreshed_at': now}})
+        return written
+
+    def compute(self, scopes, now):
+        """
+        Rebuild the rankings of `scopes` (every scope if None) with one `$topN`
+        aggregation per dimension (catalog, categories, stores), writing only
+        the documents whose entries changed. Returns the number written.
+        """
+        dimensions = {
+            ALL: None,
+            'category': '$category',
+            'store': f"${column(Product, 'store_owner')}",
+        }
+        categories = stores = None
+        if scopes is not None:
+            categories = [scope.split(':', 1)[1] for scope in scopes if scope.startswith('category:')]
+            stores = [scope.split(':', 1)[1] for scope in scopes if scope.startswith('store:')]
+
+        pk = column(Product, 'pk')
+        rankings = {}
+        for dimension, group_key in dimensions.items():
+            match = {'status': Product.Status.ACTIVE}
+            if scopes is not None:
+                if dimension == ALL and ALL not in scopes:
+                    continue
+                if dimension == 'category':
+                    if not categories:
+                        continue
+                    match['category'] = {'$in': categories}
+                if dimension == 'store':
+                    if not stores:
+                        continue
+                    match[column(Product, 'store_owner')] = {'$in': [ObjectId(store) for store in stores]}
+            rows = get_collection(Product).aggregate([
+                {'$match': match},
+                {'$group': {'_id': group_key, **{
+                    kind: {'$topN': {
+                        'n': self.size,
+                        'sortBy': {column(Product, field): -1, pk: -1},
+                        'output': {'product': f'${pk}', 'score': f'${column(Product, field)}'},
+                    }}
+                    for kind, field in SCORE_FIELDS.items()
+                }}},
+            ])
+            for row in rows:
+                scope = ALL if dimension == ALL else scope_key(
+                    **({'category': row['_id']} if dimension == 'category' else {'store_owner_id': row['_id']})
+                )
+                for kind in KINDS:
+                    rankings[(kind, scope)] = [
+                        {'product': str(entry['product']), 'score': entry['score']}
+                        for entry in row[kind] if entry['score']
+                    ]
+
+        # Requested scopes with no active products left get empty lists
+        for scope in scopes or ():
+            for kind in KINDS:
+                rankings.setdefault((kind, scope), [])
+        return self._write(rankings, now)
+
+    def _write(self, rankings, now):
+        collection = get_collection(ProductRanking)
+        existing = {
+            (doc['kind'], doc['scope']): doc.get('entries')
+            for doc in collection.find(
+                {'scope': {'$in': list({scope for _, scope in rankings})}},
+                projection={'kind': 1, 'scope': 1, 'entries': 1},
+            )
+        }
+        operations = [
+            UpdateOne(
+                {'kind': kind, 'scope': scope},
+                {'$set': {'entries': entries, 'computed_at': now}, '$setOnInsert': {'refreshed_at': now}},
+                upsert=True,
+            )
+            for (kind, scope), entries in rankings.items()
+            if existing.get((kind, scope)) != entries and (entries or (kind, scope) in existing)
+        ]
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+        return len(operations)
+
+    # Reading
+
+    def cache_key(self, kind, scope):
+        return f"ranking:{kind}:{scope}"
+
+    def get(self, kind, scope):
+        """Return (entries, computed_at) of a ranking, ([], None) if not computed"""
+        doc = get_collection(ProductRanking).find_one(
+            {'kind': kind, 'scope': scope}, projection={'entries': 1, 'computed_at': 1},
+        )
+        if doc is None:
+            return [], None
+        return doc['entries'], doc['computed_at']
+
+    def cached_payload(self, kind, scope, computed_at, base_url=''):
+        """Serialized ranking cached for this computed_at, or None"""
+        entry = product_cache.backend.get(self.cache_key(kind, scope))
+        if not entry or entry.get('base_url') != base_url or entry.get('version') != computed_at.isoformat():
+            return None
+        return entry['data']
+
+    def cache_payload(self, kind, scope, computed_at, data, base_url=''):
+        product_cache.backend.set(self.cache_key(kind, scope), {
+            'version': computed_at.isoformat(),
+            'base_url': base_url,
+            'data': data,
+        }, timeout=self.cache_timeout)
+
+
+rankings = RankingEngine.from_settings()
@@ -0,0 +1,224 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.apps import apps
+from django.utils import timezone
+from pymongo import ReturnDocument, UpdateOne
+
+from .mongo import column, get_collection, get_connection
+
+
+STARS = ('1', '2', '3', '4', '5')
+
+# StoreRating.kind: the StoreOwner field holding that kind's aggregate
+RATING_FIELDS = {
+    'seller': 'seller_rating',
+    'store': 'store_rating',
+}
+
+
+def empty_rating():
+    return {"average": 0, "count": 0, "sum": 0}
+
+
+def empty_histogram():
+    return {star: 0 for star in STARS}
+
+
+def star_for(value):
+    """Histogram bucket of a rating: the nearest whole star, at least 1"""
+    star = int(Decimal(str(value)).to_integral_value(rounding=ROUND_HALF_UP))
+    return str(min(max(star, 1), 5))
+
+
+def _product_model():
+    return apps.get_model('marketplace', 'Product')
+
+
+def _aggregate_update(field, sum_delta, count_delta, extra=None):
+    """
+    Update pipeline adding the deltas to `field`.sum / `field`.count and
+    recomputing `field`.average from them, all inside one document write.
+    """
+    # Rows written before `sum` existed fall back to average * count
+    current_sum = {'$ifNull': [f'${field}.sum', {'$multiply': [
+        {'$ifNull': [f'${field}.average', 0]}, {'$ifNull': [f'${field}.count', 0]},
+    ]}]}
+    totals = {
+        f'{field}.sum': {'$add': [current_sum, sum_delta]},
+        f'{field}.count': {'$add': [{'$ifNull': [f'${field}.count', 0]}, count_delta]},
+        **(extra or {}),
+    }
+    return [
+        {'$set': totals},
+        {'$set': {f'{field}.average': {'$cond': [
+            {'$gt': [f'${field}.count', 0]},
+            {'$round': [{'$divide': [f'${field}.sum', f'${field}.count']}, 2]},
+            0,
+        ]}}},
+    ]
+
+
+def _deltas(added, removed):
+    sum_delta = 0.0
+    count_delta = 0
+    if added is not None:
+        sum_delta += float(added)
+        count_delta += 1
+    if removed is not None:
+        sum_delta -= float(removed)
+        count_delta -= 1
+    return sum_delta, count_delta
+
+
+def apply_rating_change(product_id, added=None, removed=None):
+    """
+    Fold one rating change into a product's aggregate with a single atomic update.
+    Pass `added` for a new rating, `removed` for a deleted one and both for an edit.
+    Returns the stored (rating, rating_histogram) after the update.
+    """
+    sum_delta, count_delta = _deltas(added, removed)
+    histogram_delta = {}
+    if added is not None:
+        histogram_delta[star_for(added)] = histogram_delta.get(star_for(added), 0) + 1
+    if removed is not None:
+        histogram_delta[star_for(removed)] = histogram_delta.get(star_for(removed), 0) - 1
+
+    histogram = {}
+    for star, delta in histogram_delta.items():
+        if delta:
+            histogram[f'rating_histogram.{star}'] = {
+                '$add': [{'$ifNull': [f'$rating_histogram.{star}', 0]}, delta],
+            }
+
+    product = _product_model()
+    return _unpack(get_collection(product).find_one_and_update(
+        {column(product, 'pk'): product_id},
+        # updated_at versions cached payloads in every process
+        _aggregate_update('rating', sum_delta, count_delta, {**histogram, 'updated_at': '$$NOW'}),
+        projection={'rating': 1, 'rating_histogram': 1},
+        return_document=ReturnDocument.AFTER,
+    ))
+
+
+def apply_store_rating_change(store_owner_id, kind, added=None, removed=None):
+    """
+    Fold one seller or store rating change into the store owner's `seller_rating`
+    or `store_rating` aggregate atomically. Returns the stored aggregate.
+    """
+    store_owner = apps.get_model('marketplace', 'StoreOwner')
+    field = column(store_owner, RATING_FIELDS[kind])
+    sum_delta, count_delta = _deltas(added, removed)
+    doc = get_collection(store_owner).find_one_and_update(
+        {column(store_owner, 'pk'): store_owner_id},
+        _aggregate_update(field, sum_delta, count_delta),
+        projection={field: 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if doc is None:
+        return None
+    return doc.get(field) or empty_rating()
+
+
+def record_store_rating(rater_id, store_owner_id, kind, value):
+    """
+    Create or replace one rater's seller/store rating and fold the change into
+    the aggregate. The rating row is upserted with one find_one_and_update that
+    returns the previous value, so repeated or concurrent posts by the same
+    rater replace their rating instead of adding to the count.
+    Returns (aggregate, created).
+    """
+    rating_model = apps.get_model('marketplace', 'StoreRating')
+    connection = get_connection(rating_model)
+    now = timezone.now()
+    value_field = rating_model._meta.get_field('rating')
+    previous = get_collection(rating_model).find_one_and_update(
+        {
+            column(rating_model, 'rater'): rater_id,
+            column(rating_model, 'store_owner'): store_owner_id,
+            'kind': kind,
+        },
+        {
+            '$set': {
+                'rating': value_field.get_db_prep_save(Decimal(str(value)), connection),
+                column(rating_model, 'updated_at'): now,
+            },
+            '$setOnInsert': {column(rating_model, 'created_at'): now},
+        },
+        projection={'rating': 1},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE,
+    )
+    removed = None if previous is None else Decimal(str(previous['rating']))
+    return apply_store_rating_change(store_owner_id, kind, added=value, removed=removed), previous is None
+
+
+def _unpack(doc):
+    if doc is None:
+        return None, None
+    histogram = empty_histogram()
+    histogram.update(doc.get('rating_histogram') or {})
+    return doc.get('rating') or empty_rating(), histogram
+
+
+def rebuild_ratings(product_ids=None):
+    """
+    Recompute rating and rating_histogram from ProductRating rows with one `$group`
+    aggregation and write them back with one bulk_write. Returns the ids updated.
+    """
+    product = _product_model()
+    rating_model = apps.get_model('marketplace', 'ProductRating')
+    product_key = column(rating_model, 'product')
+
+    pipeline = []
+    if product_ids is not None:
+        pipeline.append({'$match': {product_key: {'$in': list(product_ids)}}})
+    value = {'$toDouble': '$rating'}
+    pipeline += [
+        {'$group': {
+            '_id': {
+                'product': f'${product_key}',
+                'star': {'$toInt': {'$min': [5, {'$max': [1, {'$floor': {'$add': [value, 0.5]}}]}]}},
+            },
+            'sum': {'$sum': value},
+            'count': {'$sum': 1},
+        }},
+        {'$group': {
+            '_id': '$_id.product',
+            'sum': {'$sum': '$sum'},
+            'count': {'$sum': '$count'},
+            'histogram': {'$push': {'k': {'$toString': '$_id.star'}, 'v': '$count'}},
+        }},
+    ]
+
+    pk = column(product, 'pk')
+    now = timezone.now()
+    rebuilt = {}
+    for row in get_collection(rating_model).aggregate(pipeline):
+        histogram = empty_histogram()
+        for bucket in row['histogram']:
+            histogram[bucket['k']] = bucket['v']
+        rebuilt[row['_id']] = UpdateOne({pk: row['_id']}, {'$set': {
+            'rating': {
+                'average': round(row['sum'] / row['count'], 2),
+                'count': row['count'],
+                'sum': row['sum'],
+            },
+            'rating_histogram': histogram,
+            'updated_at': now,
+        }})
+
+    # Products that lost all their ratings go back to zero
+    stale = {'rating.count': {'$gt': 0}}
+    if product_ids is not None:
+        stale[pk] = {'$in': list(product_ids)}
+    for doc in get_collection(product).find(stale, projection={pk: 1}):
+        if doc[pk] not in rebuilt:
+            rebuilt[doc[pk]] = UpdateOne({pk: doc[pk]}, {'$set': {
+                'rating': empty_rating(),
+                'rating_histogram': empty_histogram(),
+                'updated_at': now,
+            }})
+
+    if rebuilt:
+        get_collection(product).bulk_write(list(rebuilt.values()), ordered=False)
+    return list(rebuilt)
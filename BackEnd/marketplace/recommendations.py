@@ -0,0 +1,209 @@
+import numpy as np
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from pymongo import UpdateOne
+from scipy import sparse
+
+from .models import Order, OrderItem, Product, ProductRecommendation, WishlistItem
+from .mongo import column, get_collection
+
+
+class RecommendationEngine:
+    """
+    "Customers also bought" recommendations from order and wishlist
+    co-occurrence, stored as one ProductRecommendation row per product so a
+    request reads a single document through the unique product index.
+
+    Orders (not cancelled) and wishlists are baskets. They become a sparse
+    basket x product incidence matrix, and a chunk of its (weighted)
+    transposed rows times the matrix counts, for every pair, the weighted
+    baskets the two products share. A product's related score is that count divided by
+    the weight of its own baskets: how often the other product comes with it.
+
+    refresh() is incremental: a pair's count only changes when a basket
+    holding both changes, so only products of orders and wishlists changed
+    since the last run are recomputed, from the baskets that contain them.
+    """
+
+    def __init__(self, size=12, purchase_weight=1.0, wishlist_weight=0.5, min_support=1, chunk_size=1000):
+        self.size = size
+        self.purchase_weight = purchase_weight
+        self.wishlist_weight = wishlist_weight
+        self.min_support = min_support
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_settings(cls):
+        options = getattr(settings, 'RECOMMENDATIONS', {})
+        return cls(
+            size=options.get('SIZE', 12),
+            purchase_weight=options.get('PURCHASE_WEIGHT', 1.0),
+            wishlist_weight=options.get('WISHLIST_WEIGHT', 0.5),
+            min_support=options.get('MIN_SUPPORT', 1),
+            chunk_size=options.get('CHUNK_SIZE', 1000),
+        )
+
+    # Baskets
+
+    def order_baskets(self, product_ids=None):
+        """Product ids of every order that is not cancelled, or of those containing product_ids"""
+        match = {'status': {'$ne': Order.Status.CANCELLED}}
+        if product_ids is not None:
+            match[column(Order, 'pk')] = {'$in': get_collection(OrderItem).distinct(
+                column(OrderItem, 'order'), {column(OrderItem, 'product'): {'$in': list(product_ids)}},
+            )}
+        rows = get_collection(Order).aggregate([
+            {'$match': match},
+            {'$lookup': {
+                'from': OrderItem._meta.db_table,
+                'localField': column(Order, 'pk'),
+                'foreignField': column(OrderItem, 'order'),
+                'as': 'items',
+            }},
+            {'$project': {'_id': 0, 'products': f"$items.{column(OrderItem, 'product')}"}},
+        ])
+        return [row['products'] for row in rows if row['products']]
+
+    def wishlist_baskets(self, product_ids=None):
+        """Product ids of every wishlist, or of those containing product_ids"""
+        wishlist, product = column(WishlistItem, 'wishlist'), column(WishlistItem, 'product')
+        pipeline = []
+        if product_ids is not None:
+            pipeline.append({'$match': {wishlist: {'$in': get_collection(WishlistItem).distinct(
+                wishlist, {product: {'$in': list(product_ids)}},
+            )}}})
+        pipeline.append({'$group': {'_id': f'${wishlist}', 'products': {'$push': f'${product}'}}})
+        return [row['products'] for row in get_collection(WishlistItem).aggregate(pipeline)]
+
+    def baskets(self, product_ids=None):
+        """(weight, products) of the order and wishlist baskets"""
+        return [
+            (self.purchase_weight, products) for products in self.order_baskets(product_ids)
+        ] + [
+            (self.wishlist_weight, products) for products in self.wishlist_baskets(product_ids)
+        ]
+
+    # Scoring
+
+    def related(self, product_ids, baskets):
+        """
+        Yield {product_id: [(related_id, score), ...]} for product_ids, one
+        chunk of products at a time, best first and at most `size` each.
+        Products in no basket get an empty list.
+        """
+        index = {}
+        rows, cols, weights = [], [], []
+        for row, (weight, products) in enumerate(baskets):
+            for product_id in set(products):
+                rows.append(row)
+                cols.append(index.setdefault(product_id, len(index)))
+                weights.append(weight)
+        ids = list(index)
+        shape = (len(baskets), len(ids))
+        incidence = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape)
+        # product x basket, each basket weighted by its kind
+        weighted = sparse.csr_matrix((np.array(weights, dtype=float), (rows, cols)), shape=shape).T.tocsr()
+        totals = np.asarray(weighted.sum(axis=1)).ravel()
+
+        active = np.zeros(len(ids), dtype=bool)
+        active_ids = Product.objects.filter(pk__in=ids, status=Product.Status.ACTIVE).values_list('id', flat=True)
+        active[np.array([index[product_id] for product_id in active_ids], dtype=int)] = True
+
+        product_ids = list(product_ids)
+        for start in range(0, len(product_ids), self.chunk_size):
+            chunk = product_ids[start:start + self.chunk_size]
+            result = {product_id: [] for product_id in chunk}
+            targets = [index[product_id] for product_id in chunk if product_id in index]
+            if not targets:
+                yield result
+                continue
+            # Weighted co-occurrence of each target with every product
+            counts = (weighted[targets] @ incidence).tocsr()
+            for position, target in enumerate(targets):
+                lo, hi = counts.indptr[position], counts.indptr[position + 1]
+                others, values = counts.indices[lo:hi], counts.data[lo:hi]
+                keep = (others != target) & (values >= self.min_support) & active[others]
+                others, values = others[keep], values[keep]
+                if len(values) > self.size:
+                    best = np.argpartition(-values, self.size)[:self.size]
+                    others, values = others[best], values[best]
+                order = np.lexsort((others, -values))
+                result[ids[target]] = [
+                    (ids[other], round(float(value / totals[target]), 4))
+                    for other, value in zip(others[order], values[order])
+                ]
+            yield result
+
+    # Incremental refresh
+
+    def touched_products(self, since):
+        """Products of orders and wishlists changed since `since`"""
+        touched = set(OrderItem.objects.filter(order__updated_at__gte=since).values_list('product_id', flat=True))
+        touched.update(WishlistItem.objects.filter(
+            Q(added_at__gte=since) | Q(wishlist__updated_at__gte=since)
+        ).values_list('product_id', flat=True))
+        return touched
+
+    def last_refresh(self):
+        doc = get_collection(ProductRecommendation).find_one(
+            {}, sort=[('refreshed_at', -1)], projection={'refreshed_at': 1},
+        )
+        return doc['refreshed_at'] if doc else None
+
+    def refresh(self, full=False):
+        """Recompute the recommendations changed since the last run; returns the rows rewritten"""
+        now = timezone.now()
+        since = None if full else self.last_refresh()
+        if since is not None and timezone.is_naive(since):
+            since = timezone.make_aware(since, timezone.utc)
+
+        if since is None:
+            baskets = self.baskets()
+            product_ids = {product_id for _, products in baskets for product_id in products}
+            # Products no longer in any basket lose their list
+            product_ids.update(get_collection(ProductRecommendation).distinct(column(ProductRecommendation, 'product')))
+        else:
+            product_ids = self.touched_products(since)
+            if not product_ids:
+                return 0
+            baskets = self.baskets(product_ids)
+
+        return sum(self._write(chunk, now) for chunk in self.related(product_ids, baskets))
+
+    def _write(self, related, now):
+        collection = get_collection(ProductRecommendation)
+        product = column(ProductRecommendation, 'product')
+        existing = {
+            doc[product]: doc.get('related')
+            for doc in collection.find({product: {'$in': list(related)}}, projection={product: 1, 'related': 1})
+        }
+        operations, unchanged = [], []
+        for product_id, entries in related.items():
+            entries = [{'product': str(other), 'score': score} for other, score in entries]
+            if existing.get(product_id) == entries:
+                unchanged.append(product_id)
+            elif entries or product_id in existing:
+                operations.append(UpdateOne(
+                    {product: product_id},
+                    {'$set': {'related': entries, 'computed_at': now, 'refreshed_at': now}},
+                    upsert=True,
+                ))
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+        # Marks this run for the next incremental refresh
+        if unchanged:
+            collection.update_many({product: {'$in': unchanged}}, {'$set': {'refreshed_at': now}})
+        return len(operations)
+
+    # Reading
+
+    def get(self, product_id):
+        """[{"product": id, "score": score}] of one product, best first"""
+        doc = get_collection(ProductRecommendation).find_one(
+            {column(ProductRecommendation, 'product'): product_id}, projection={'related': 1},
+        )
+        return doc['related'] if doc else []
+
+
+recommendations = RecommendationEngine.from_settings()
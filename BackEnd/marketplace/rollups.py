@@ -0,0 +1,344 @@
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from bson.decimal128 import Decimal128
+from django.apps import apps
+from django.conf import settings
+from django.utils import timezone
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .mongo import column, get_collection
+
+
+HOUR = 'hour'
+DAY = 'day'
+GRANULARITIES = (HOUR, DAY)
+
+STEPS = {HOUR: timedelta(hours=1), DAY: timedelta(days=1)}
+
+# Longest series one analytics request may ask for
+MAX_POINTS = {HOUR: 24 * 31, DAY: 366 * 2}
+
+COUNTERS = ('views', 'orders', 'units', 'revenue')
+
+# Counters a rebuild recomputes from orders; views only exist in the buckets
+ORDER_COUNTERS = ('orders', 'units', 'revenue')
+
+CANCELLED = 'cancelled'
+
+DUPLICATE_KEY = 11000
+
+
+def _bucket_model():
+    return apps.get_model('marketplace', 'StatsBucket')
+
+
+def bucket_start(moment=None, granularity=DAY):
+    """Start (in TIME_ZONE) of the hour or day a moment falls in"""
+    local = timezone.localtime(moment or timezone.now()).replace(minute=0, second=0, microsecond=0)
+    return local.replace(hour=0) if granularity == DAY else local
+
+
+def _naive_utc(moment):
+    # Bucket starts are compared as the naive UTC datetimes Mongo returns
+    if timezone.is_aware(moment):
+        return moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def _decimal128(value):
+    return Decimal128(Decimal(str(value)).quantize(Decimal('0.01')))
+
+
+def _to_decimal(value):
+    if value is None:
+        return Decimal('0.00')
+    if isinstance(value, Decimal128):
+        return value.to_decimal()
+    return Decimal(str(value))
+
+
+def _key(store_owner_id, product_id, granularity, start):
+    bucket = _bucket_model()
+    return {
+        column(bucket, 'store_owner'): store_owner_id,
+        column(bucket, 'product'): product_id,
+        'granularity': granularity,
+        'start': start,
+    }
+
+
+# Writing
+
+def bucket_updates(store_owner_id, counters, moment=None, product_id=None):
+    """
+    Upserts adding `counters` to the hour and day buckets of a store, or of
+    one of its products when product_id is given. Zero counters are skipped.
+    """
+    increments = {}
+    for name, value in counters.items():
+        if value:
+            increments[name] = _decimal128(value) if name == 'revenue' else value
+    if not increments:
+        return []
+    return [
+        UpdateOne(
+            _key(store_owner_id, product_id, granularity, bucket_start(moment, granularity)),
+            {'$inc': increments},
+            upsert=True,
+        )
+        for granularity in GRANULARITIES
+    ]
+
+
+def sale_bucket_updates(store_owner_id, orders, revenue, lines=(), moment=None):
+    """
+    Bucket upserts for `orders` orders (-1 to undo one) worth `revenue`.
+    `lines` are (product_id, units, revenue) of the order's items and also
+    count towards each product's buckets.
+    """
+    sign = 1 if orders >= 0 else -1
+    operations = []
+    units = 0
+    for product_id, quantity, total in lines:
+        units += quantity
+        operations += bucket_updates(
+            store_owner_id, {'orders': orders, 'units': sign * quantity, 'revenue': sign * total},
+            moment, product_id,
+        )
+    operations += bucket_updates(
+        store_owner_id, {'orders': orders, 'units': sign * units, 'revenue': revenue}, moment,
+    )
+    return operations
+
+
+def view_bucket_updates(views, moment=None):
+    """Bucket upserts for {(store_owner_id, product_id): views}, per product and per store"""
+    operations = []
+    per_store = defaultdict(int)
+    for (store_owner_id, product_id), count in views.items():
+        operations += bucket_updates(store_owner_id, {'views': count}, moment, product_id)
+        per_store[store_owner_id] += count
+    for store_owner_id, count in per_store.items():
+        operations += bucket_updates(store_owner_id, {'views': count}, moment)
+    return operations
+
+
+def write_bucket_updates(operations, session=None):
+    if operations:
+        get_collection(_bucket_model()).bulk_write(operations, ordered=False, session=session)
+
+
+# Reading
+
+def _row(doc, start=None):
+    views = doc.get('views', 0)
+    orders = doc.get('orders', 0)
+    row = {
+        'views': views,
+        'orders': orders,
+        'units': doc.get('units', 0),
+        'revenue': str(_to_decimal(doc.get('revenue')).quantize(Decimal('0.01'))),
+        'conversion': round(orders / views, 4) if views else 0,
+    }
+    if start is not None:
+        row = {'start': start.isoformat(), **row}
+    return row
+
+
+def series(store_owner_id, start, end, granularity=DAY, product_id=None):
+    """
+    Buckets of a store (or one of its products) from start to end inclusive,
+    oldest first, with empty periods as zeros. Reads at most one document per
+    period through the (store_owner, product, granularity, start) index.
+    """
+    bucket = _bucket_model()
+    first, last = bucket_start(start, granularity), bucket_start(end, granularity)
+    docs = {
+        _naive_utc(doc['start']): doc
+        for doc in get_collection(bucket).find(
+            {
+                **_key(store_owner_id, product_id, granularity, None),
+                'start': {'$gte': first, '$lte': last},
+            },
+            projection={'start': 1, **{name: 1 for name in COUNTERS}},
+        )
+    }
+    rows = []
+    moment = first
+    while moment <= last:
+        rows.append(_row(docs.get(_naive_utc(moment), {}), moment))
+        moment = timezone.localtime(moment + STEPS[granularity])
+    return rows
+
+
+def totals(rows):
+    """Sum a series into one row, conversion recomputed from the sums"""
+    summed = {
+        'views': sum(row['views'] for row in rows),
+        'orders': sum(row['orders'] for row in rows),
+        'units': sum(row['units'] for row in rows),
+        'revenue': sum((Decimal(row['revenue']) for row in rows), Decimal('0.00')),
+    }
+    return _row(summed)
+
+
+def top_products(store_owner_id, start, end, granularity=DAY, limit=10, order_by='revenue'):
+    """Products of a store with the highest `order_by` over a range, summed from their buckets"""
+    bucket = _bucket_model()
+    product_key = column(bucket, 'product')
+    rows = get_collection(bucket).aggregate([
+        {'$match': {
+            column(bucket, 'store_owner'): store_owner_id,
+            product_key: {'$ne': None},
+            'granularity': granularity,
+            'start': {'$gte': bucket_start(start, granularity), '$lte': bucket_start(end, granularity)},
+        }},
+        {'$group': {'_id': f'${product_key}', **{name: {'$sum': f'${name}'} for name in COUNTERS}}},
+        {'$sort': {order_by: -1, '_id': 1}},
+        {'$limit': limit},
+    ])
+    return [{'product_id': str(row['_id']), **_row(row)} for row in rows]
+
+
+# Rebuilding
+
+def rebuild_buckets(since=None, store_owner_ids=None, attempts=3):
+    """
+    Recompute orders, units and revenue of the hour and day buckets of stores
+    and products from orders placed since `since` (all history if None): one
+    aggregation reads the orders with their items and the totals are rolled
+    up per bucket. The current hour and day are left to the live counters.
+    Views are kept as counted. Returns the number of buckets written.
+
+    Every write is a compare-and-set on the counters read before the
+    aggregation, so a concurrent $inc (an old order being cancelled) is never
+    overwritten; stores whose buckets moved are rebuilt again, up to
+    `attempts` times.
+    """
+    written = 0
+    for _ in range(attempts):
+        count, conflicted = _rebuild_once(since, store_owner_ids)
+        written += count
+        if not conflicted:
+            break
+        store_owner_ids = conflicted
+    return written
+
+
+def _bucket_counters(doc):
+    return (doc.get('orders') or 0, doc.get('units') or 0, _to_decimal(doc.get('revenue')).quantize(Decimal('0.01')))
+
+
+def _rebuild_once(since, store_owner_ids):
+    order_model = apps.get_model('marketplace', 'Order')
+    item_model = apps.get_model('marketplace', 'OrderItem')
+    order_store, created_at = column(order_model, 'store'), column(order_model, 'created_at')
+    bucket = _bucket_model()
+    store_key, product_key = column(bucket, 'store_owner'), column(bucket, 'product')
+
+    # Buckets still being counted live are not rebuilt
+    cutoffs = {granularity: bucket_start(None, granularity) for granularity in GRANULARITIES}
+    match = {'status': {'$ne': CANCELLED}, created_at: {'$lt': cutoffs[HOUR]}}
+    scope = {'$or': [
+        {'granularity': granularity, 'start': {'$lt': cutoff}} for granularity, cutoff in cutoffs.items()
+    ]}
+    if since is not None:
+        since = bucket_start(since, DAY)
+        match[created_at]['$gte'] = since
+        scope['start'] = {'$gte': since}
+    if store_owner_ids is not None:
+        match[order_store] = {'$in': list(store_owner_ids)}
+        scope[store_key] = {'$in': list(store_owner_ids)}
+
+    def read_scope():
+        return {
+            (doc[store_key], doc.get(product_key), doc['granularity'], _naive_utc(doc['start'])): doc
+            for doc in get_collection(bucket).find(
+                scope, projection={store_key: 1, product_key: 1, 'granularity': 1, 'start': 1, **{
+                    name: 1 for name in ORDER_COUNTERS
+                }},
+            )
+        }
+
+    # Read before the orders: a write after this makes the compare-and-set miss
+    observed = read_scope()
+
+    item_product = column(item_model, 'product')
+    cursor = get_collection(order_model).aggregate([
+        {'$match': match},
+        {'$lookup': {
+            'from': item_model._meta.db_table,
+            'localField': column(order_model, 'pk'),
+            'foreignField': column(item_model, 'order'),
+            'as': 'items',
+        }},
+        {'$project': {
+            'store': f'${order_store}',
+            'created_at': f'${created_at}',
+            'total_amount': 1,
+            'items': {'$map': {'input': '$items', 'in': {
+                'product': f'$$this.{item_product}', 'quantity': '$$this.quantity', 'total': '$$this.total',
+            }}},
+        }},
+    ])
+
+    rolled = defaultdict(lambda: {'orders': 0, 'units': 0, 'revenue': Decimal('0')})
+    for order in cursor:
+        moment = timezone.make_aware(order['created_at'], timezone.utc) \
+            if timezone.is_naive(order['created_at']) else order['created_at']
+        starts = [
+            (granularity, bucket_start(moment, granularity)) for granularity in GRANULARITIES
+            if bucket_start(moment, granularity) < cutoffs[granularity]
+        ]
+        units = 0
+        for item in order['items']:
+            units += item['quantity']
+            for granularity, start in starts:
+                row = rolled[(order['store'], item['product'], granularity, _naive_utc(start))]
+                row['orders'] += 1
+                row['units'] += item['quantity']
+                row['revenue'] += _to_decimal(item['total'])
+        for granularity, start in starts:
+            row = rolled[(order['store'], None, granularity, _naive_utc(start))]
+            row['orders'] += 1
+            row['units'] += units
+            row['revenue'] += _to_decimal(order['total_amount'])
+
+    zero = {'orders': 0, 'units': 0, 'revenue': Decimal('0')}
+    targets = {}
+    operations = []
+    # Periods whose orders were all cancelled go back to zero
+    for key in set(rolled) | set(observed):
+        counters = rolled.get(key, zero)
+        target = (counters['orders'], counters['units'], Decimal(counters['revenue']).quantize(Decimal('0.01')))
+        doc = observed.get(key)
+        if doc is not None and _bucket_counters(doc) == target:
+            continue
+        targets[key] = target
+        # Expected current values: as observed, or absent for a new bucket
+        expected = {name: doc.get(name) if doc is not None else None for name in ORDER_COUNTERS}
+        operations.append(UpdateOne(
+            {**_key(*key), **expected},
+            {'$set': {'orders': target[0], 'units': target[1], 'revenue': _decimal128(target[2])}},
+            upsert=doc is None,
+        ))
+    if not operations:
+        return 0, []
+
+    try:
+        get_collection(bucket).bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # A bucket created concurrently makes the upsert hit the unique index
+        if any(error.get('code') != DUPLICATE_KEY for error in e.details.get('writeErrors', [])):
+            raise
+
+    current = read_scope()
+    conflicted = {
+        key[0] for key, target in targets.items()
+        if key not in current or _bucket_counters(current[key]) != target
+    }
+    written = sum(1 for key in targets if key[0] not in conflicted)
+    return written, list(conflicted)
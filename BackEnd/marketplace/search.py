@@ -0,0 +1,265 @@
+import math
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+
+from django.apps import apps
+from pymongo import DeleteOne, UpdateOne
+
+from .mongo import column, get_collection
+
+
+# Arabic code points unified to their Persian forms, plus Persian/Arabic digits.
+# Applied after NFKD, which turns presentation forms and hamza letters into these.
+CHARACTER_MAP = str.maketrans({
+    '\u064a': '\u06cc',  # ARABIC YEH -> FARSI YEH
+    '\u0649': '\u06cc',  # ALEF MAKSURA -> FARSI YEH
+    '\u0643': '\u06a9',  # ARABIC KAF -> KEHEH
+    '\u0629': '\u0647',  # TEH MARBUTA -> HEH
+    '\u06d5': '\u0647',  # AE (from HEH WITH YEH ABOVE) -> HEH
+    '\u0640': None,       # TATWEEL
+    '\u200c': None,       # ZERO WIDTH NON-JOINER
+    **{chr(0x06f0 + i): str(i) for i in range(10)},
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+})
+
+TOKEN_RE = re.compile(r'\w+')
+
+INDEXED_FIELDS = ('title', 'description', 'tags', 'colors', 'sizes', 'status')
+
+# Title terms count this many times towards term frequency
+TITLE_WEIGHT = 2
+
+
+def normalize(text):
+    """Fold Persian and Latin text to a canonical form for indexing and querying"""
+    # NFKD splits hamza/madda and Latin accents off their base letters and
+    # unfolds presentation forms, then the marks are dropped and letters mapped
+    text = unicodedata.normalize('NFKD', str(text))
+    text = ''.join(ch for ch in text if unicodedata.category(ch) != 'Mn')
+    return text.translate(CHARACTER_MAP).casefold()
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(normalize(text))
+
+
+def product_terms(product):
+    """Term frequencies of a product's searchable fields"""
+    terms = Counter()
+    for _ in range(TITLE_WEIGHT):
+        terms.update(tokenize(product.title))
+    terms.update(tokenize(product.description or ''))
+    for field in ('tags', 'colors', 'sizes'):
+        for value in getattr(product, field) or []:
+            terms.update(tokenize(value))
+    return terms
+
+
+class SearchIndex:
+    """
+    Inverted index over active products, ranked with BM25.
+    Each product has one ProductSearchDocument holding its distinct tokens
+    (multikey-indexed, so a term lookup is an index scan) and their
+    frequencies. Document frequencies live in SearchTerm, which also backs
+    prefix autocomplete.
+    """
+    k1 = 1.2
+    b = 0.75
+    stats_ttl = 300
+
+    def __init__(self):
+        self._stats = None
+        self._stats_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def document_model(self):
+        return apps.get_model('marketplace', 'ProductSearchDocument')
+
+    @property
+    def term_model(self):
+        return apps.get_model('marketplace', 'SearchTerm')
+
+    # Indexing
+
+    def _term_updates(self, added, removed):
+        deltas = Counter(added)
+        deltas.subtract(removed)
+        self._apply_term_deltas(deltas)
+
+    def _apply_term_deltas(self, deltas):
+        updates = [
+            UpdateOne({'term': term}, {'$inc': {'df': delta}}, upsert=delta > 0)
+            for term, delta in deltas.items() if delta
+        ]
+        if updates:
+            get_collection(self.term_model).bulk_write(updates, ordered=False)
+
+    @staticmethod
+    def _document(terms):
+        return {'tokens': list(terms), 'tf': dict(terms), 'length': sum(terms.values())}
+
+    def index_product(self, product):
+        """Add, refresh or drop a product's entry after it was saved"""
+        if product.status != 'active':
+            self.unindex_product(product.pk)
+            return
+
+        documents = get_collection(self.document_model)
+        key = column(self.document_model, 'product')
+        terms = product_terms(product)
+        previous = documents.find_one_and_update(
+            {key: product.pk},
+            {'$set': self._document(terms)},
+            projection={'tokens': 1},
+            upsert=True,
+        )
+        old_tokens = set(previous['tokens']) if previous else set()
+        self._term_updates(set(terms) - old_tokens, old_tokens - set(terms))
+
+    def unindex_product(self, product_id):
+        key = column(self.document_model, 'product')
+        previous = get_collection(self.document_model).find_one_and_delete(
+            {key: product_id}, projection={'tokens': 1},
+        )
+        if previous:
+            self._term_updates((), previous['tokens'])
+
+    def index_products(self, products):
+        """Batch index_product: one read of the previous entries and one bulk write per collection"""
+        products = list(products)
+        if not products:
+            return
+        documents = get_collection(self.document_model)
+        key = column(self.document_model, 'product')
+        previous = {
+            doc[key]: set(doc['tokens'])
+            for doc in documents.find(
+                {key: {'$in': [product.pk for product in products]}}, projection={key: 1, 'tokens': 1},
+            )
+        }
+
+        writes = []
+        deltas = Counter()
+        for product in products:
+            old_tokens = previous.get(product.pk, set())
+            if product.status != 'active':
+                if product.pk in previous:
+                    writes.append(DeleteOne({key: product.pk}))
+                    deltas.subtract(old_tokens)
+                continue
+            terms = product_terms(product)
+            writes.append(UpdateOne({key: product.pk}, {'$set': self._document(terms)}, upsert=True))
+            deltas.update(set(terms) - old_tokens)
+            deltas.subtract(old_tokens - set(terms))
+
+        if writes:
+            documents.bulk_write(writes, ordered=False)
+        self._apply_term_deltas(deltas)
+
+    def rebuild(self, chunk_size=500):
+        """Rebuild the whole index from active products, return products indexed"""
+        product_model = apps.get_model('marketplace', 'Product')
+        document_model = self.document_model
+        documents = get_collection(document_model)
+        key = column(document_model, 'product')
+        documents.delete_many({})
+        get_collection(self.term_model).delete_many({})
+
+        frequencies = Counter()
+        batch = []
+        indexed = 0
+        for product in product_model.objects.filter(status='active').iterator(chunk_size=chunk_size):
+            terms = product_terms(product)
+            frequencies.update(terms.keys())
+            batch.append({key: product.pk, **self._document(terms)})
+            if len(batch) >= chunk_size:
+                documents.insert_many(batch)
+                indexed += len(batch)
+                batch = []
+        if batch:
+            documents.insert_many(batch)
+            indexed += len(batch)
+
+        if frequencies:
+            get_collection(self.term_model).insert_many(
+                [{'term': term, 'df': df} for term, df in frequencies.items()]
+            )
+        self._stats = None
+        return indexed
+
+    # Querying
+
+    def corpus_stats(self):
+        """(document count, average document length), refreshed every stats_ttl seconds"""
+        with self._lock:
+            if self._stats is None or time.monotonic() - self._stats_at > self.stats_ttl:
+                documents = get_collection(self.document_model)
+                result = next(documents.aggregate([
+                    {'$group': {'_id': None, 'count': {'$sum': 1}, 'length': {'$avg': '$length'}}},
+                ]), None)
+                self._stats = (result['count'], result['length'] or 1) if result else (0, 1)
+                self._stats_at = time.monotonic()
+            return self._stats
+
+    def search(self, query, page=1, page_size=20):
+        """Return ([(product_id, score)], total) for the query, best match first"""
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return [], 0
+
+        frequencies = {
+            doc['term']: doc['df']
+            for doc in get_collection(self.term_model).find(
+                {'term': {'$in': terms}, 'df': {'$gt': 0}}, projection={'term': 1, 'df': 1},
+            )
+        }
+        if not frequencies:
+            return [], 0
+
+        count, average_length = self.corpus_stats()
+        # Length normalization shared by every term: k1 * (1 - b + b * length / avgdl)
+        norm = {'$multiply': [self.k1, {'$add': [
+            1 - self.b, {'$multiply': [self.b / average_length, '$length']},
+        ]}]}
+        term_scores = []
+        for term, df in frequencies.items():
+            # Corpus stats may lag a few seconds behind df, keep idf well-defined
+            idf = math.log(1 + (max(count, df) - df + 0.5) / (df + 0.5))
+            tf = {'$ifNull': [f'$tf.{term}', 0]}
+            term_scores.append({'$divide': [
+                {'$multiply': [idf * (self.k1 + 1), tf]},
+                {'$add': [tf, norm]},
+            ]})
+
+        key = column(self.document_model, 'product')
+        pipeline = [
+            {'$match': {'tokens': {'$in': list(frequencies)}}},
+            {'$project': {key: 1, 'score': {'$add': term_scores}}},
+            {'$sort': {'score': -1, key: 1}},
+            {'$facet': {
+                'results': [{'$skip': (page - 1) * page_size}, {'$limit': page_size}],
+                'total': [{'$count': 'count'}],
+            }},
+        ]
+        result = next(get_collection(self.document_model).aggregate(pipeline), {})
+        total = result['total'][0]['count'] if result.get('total') else 0
+        return [(row[key], row['score']) for row in result.get('results', [])], total
+
+    def suggest(self, prefix, limit=10):
+        """Complete the last word of `prefix` with the most frequent indexed terms"""
+        tokens = tokenize(prefix)
+        if not tokens:
+            return []
+        head, last = tokens[:-1], tokens[-1]
+        cursor = get_collection(self.term_model).find(
+            {'term': {'$regex': f'^{re.escape(last)}'}, 'df': {'$gt': 0}},
+            projection={'term': 1},
+        ).sort([('df', -1), ('term', 1)]).limit(limit)
+        return [' '.join(head + [doc['term']]) for doc in cursor]
+
+
+search_index = SearchIndex()
@@ -1,13 +1,21 @@
 from rest_framework import serializers
+from django.db import models
 from django.utils import timezone
 from decimal import Decimal
 from .models import Customer, StoreOwner, Product, ProductRating, ProductImage, Cart, Order, OrderItem, Wishlist, WishlistItem, Comment
+from .checkout import CheckoutPipeline, CheckoutError
+from .cache import product_cache
+from .loaders import ProductLoader, WishlistLoader
+from .pricing import CartPricer, load_products
+from .images import srcset, variant_urls
 
 
 class ProductImageSerializer(serializers.ModelSerializer):
     """Serializer for ProductImage model"""
     # Force ObjectId to string for DRF representation
     id = serializers.SerializerMethodField(read_only=True)
+    variants = serializers.SerializerMethodField(read_only=True)
+    srcset = serializers.SerializerMethodField(read_only=True)
 
     class Meta:
         model = ProductImage
@@ -15,6 +23,8 @@ class ProductImageSerializer(serializers.ModelSerializer):
             'id',
             'image',
             'is_primary',
+            'variants',
+            'srcset',
             'created_at',
         ]
         read_only_fields = ['id', 'created_at']
@@ -22,6 +32,13 @@ class ProductImageSerializer(serializers.ModelSerializer):
     def get_id(self, obj):
         return str(obj.id) if obj.id is not None else None
 
+    def get_variants(self, obj):
+        """Return resized WebP URLs by variant name (empty until processed)"""
+        return variant_urls(obj, self.context.get('request'))
+
+    def get_srcset(self, obj):
+        return srcset(obj, self.context.get('request'))
+
 class CustomerSerializer(serializers.ModelSerializer):
     # Force ObjectId to string for DRF representation
     id = serializers.SerializerMethodField(read_only=True)
@@ -111,6 +128,7 @@ class CommentSerializer(serializers.ModelSerializer):
     parent = serializers.CharField(write_only=True, required=False, allow_blank=True)
     parent_obj = serializers.SerializerMethodField(read_only=True)
     replies = serializers.SerializerMethodField(read_only=True)
+    root_id = serializers.SerializerMethodField(read_only=True)
 
     # Computed fields
     is_reply = serializers.ReadOnlyField()
@@ -126,6 +144,11 @@ class CommentSerializer(serializers.ModelSerializer):
             'parent',
             'parent_obj',
             'replies',
+            'root_id',
+            'reply_count',
+            'last_reply_at',
+            'thread_reply_count',
+            'thread_last_reply_at',
             'is_reply',
             'created_at',
             'updated_at',
@@ -135,15 +158,29 @@ class CommentSerializer(serializers.ModelSerializer):
             'author',
             'product',
             'replies',
+            'root_id',
+            'reply_count',
+            'last_reply_at',
+            'thread_reply_count',
+            'thread_last_reply_at',
             'is_reply',
             'created_at',
             'updated_at',
             'parent_obj',
         ]
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Collapsed listings show reply_count instead of the reply tree
+        if self.context.get('collapsed'):
+            self.fields.pop('replies', None)
+
     def get_id(self, obj):
         return str(obj.id) if obj.id is not None else None
 
+    def get_root_id(self, obj):
+        return str(obj.root_id) if obj.root_id is not None else None
+
     def get_author(self, obj):
         """Return author basic info"""
         return {
@@ -173,7 +210,8 @@ class CommentSerializer(serializers.ModelSerializer):
 
     def get_replies(self, obj):
         """Return replies to this comment"""
-        replies = obj.get_replies()
+        loader = self.context.get('thread_loader')
+        replies = loader.replies_for(obj) if loader is not None else obj.get_replies()
         return CommentSerializer(replies, many=True, context=self.context).data
 
     def validate_content(self, value):
@@ -283,27 +321,42 @@ class WishlistItemSerializer(serializers.ModelSerializer):
 
     def get_product(self, obj):
         """Return product details as specified in the populate"""
+        loader = self.context.get('wishlist_loader')
+        if loader is not None:
+            images = [image.image.url for image in loader.images_for(obj.product)]
+        else:
+            images = obj.product.get_all_image_urls()
         return {
             'id': str(obj.product.id),
             'title': obj.product.title,
             'price': obj.product.price,
             'compare_price': obj.product.compare_price,
-            'images': obj.product.get_all_image_urls(),
+            'images': images,
             'stock': obj.product.stock,
             'status': obj.product.status,
-            'store_id': str(obj.product.store_owner.id),
+            'store_id': str(obj.product.store_owner_id),
             'colors': obj.product.colors,
             'sizes': obj.product.sizes,
             'description': obj.product.description,
         }
 
 
+class WishlistListSerializer(serializers.ListSerializer):
+    """List serializer that batch-loads the items of every wishlist on the page"""
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.manager.BaseManager) else data
+        wishlists = list(iterable)
+        self.child.loader = WishlistLoader(wishlists)
+        return super().to_representation(wishlists)
+
+
 class WishlistSerializer(serializers.ModelSerializer):
     """Serializer for Wishlist model"""
     # Force ObjectId to string for DRF representation
     id = serializers.SerializerMethodField(read_only=True)
     user = serializers.SerializerMethodField(read_only=True)
-    items = WishlistItemSerializer(many=True, read_only=True)
+    items = serializers.SerializerMethodField(read_only=True)
 
     # Computed fields
     item_count = serializers.SerializerMethodField()
@@ -326,6 +379,15 @@ class WishlistSerializer(serializers.ModelSerializer):
             'created_at',
             'updated_at',
         ]
+        list_serializer_class = WishlistListSerializer
+
+    loader = None
+
+    def get_loader(self, obj):
+        """Return the batch loader covering obj, creating a single-wishlist one if needed"""
+        if self.loader is None or not self.loader.has(obj):
+            self.loader = WishlistLoader([obj])
+        return self.loader
 
     def get_id(self, obj):
         return str(obj.id) if obj.id is not None else None
@@ -338,9 +400,15 @@ class WishlistSerializer(serializers.ModelSerializer):
             'phone': obj.user.phone,
         }
 
+    def get_items(self, obj):
+        loader = self.get_loader(obj)
+        return WishlistItemSerializer(
+            loader.items_for(obj), many=True, context={**self.context, 'wishlist_loader': loader}
+        ).data
+
     def get_item_count(self, obj):
         """Return number of items in wishlist"""
-        return obj.item_count
+        return len(self.get_loader(obj).items_for(obj))
 
 
 class AddToWishlistSerializer(serializers.Serializer):
@@ -528,76 +596,18 @@ class OrderSerializer(serializers.ModelSerializer):
             except Exception as e:
                 raise serializers.ValidationError(f"خطا در ایجاد سفارش: {str(e)}")
 
-        # Validate cart items and group them by store
-        store_orders_data = {}
-        
-        for item in cart_items:
-            try:
-                product = Product.objects.get(id=item['product_id'], status='active')
-            except Product.DoesNotExist:
-                raise serializers.ValidationError(f"محصول با شناسه {item['product_id']} یافت نشد")
-
-            if not product.is_in_stock or product.stock < item['quantity']:
-                raise serializers.ValidationError(f"محصول {product.title} موجود نیست یا موجودی کافی ندارد")
-
-            store_id = str(product.store_owner.id)
-            if store_id not in store_orders_data:
-                store_orders_data[store_id] = {
-                    'items': [],
-                    'total_amount': 0,
-                    'store': product.store_owner
-                }
-
-            # Create order item data
-            price = product.price
-            quantity = item['quantity']
-            item_total = price * quantity
-
-            order_item_data = {
-                'product': product,
-                'title': product.title,
-                'price': price,
-                'quantity': quantity,
-                'total': item_total,
-            }
-            store_orders_data[store_id]['items'].append(order_item_data)
-            store_orders_data[store_id]['total_amount'] += item_total
-
-        created_orders = []
-
-        for store_id, data in store_orders_data.items():
-            store = data['store']
-            items_data = data['items']
-            total_amount = data['total_amount']
-
-            # Create order
-            order = Order.objects.create(
-                user=customer,
-                store=store,
-                total_amount=total_amount,
-                shipping_address=validated_data.get('shipping_address'),
-                payment_method=validated_data.get('payment_method'),
-                status=validated_data.get('status', Order.Status.PENDING),
-                tracking_number=validated_data.get('tracking_number'),
-            )
-
-            # Create order items and update stock
-            for item_data in items_data:
-                OrderItem.objects.create(
-                    order=order,
-                    **item_data
-                )
-                
-                # Update product stock and sales
-                product = item_data['product']
-                product.stock -= item_data['quantity']
-                product.sales_count += item_data['quantity']
-                product.save()
-
-            # Update store statistics
-            store.increment_sales(total_amount)
-            
-            created_orders.append(order)
+        # Check out every cart line in one transactional bulk pipeline
+        pipeline = CheckoutPipeline(
+            customer,
+            shipping_address=validated_data.get('shipping_address'),
+            payment_method=validated_data.get('payment_method'),
+            status=validated_data.get('status', Order.Status.PENDING),
+            tracking_number=validated_data.get('tracking_number'),
+        )
+        try:
+            created_orders = pipeline.run(cart_items)
+        except CheckoutError as e:
+            raise serializers.ValidationError(str(e))
 
         # Return the first created order for single store or last one
         return created_orders[0] if created_orders else None
@@ -622,20 +632,32 @@ class CartItemSerializer(serializers.Serializer):
     size = serializers.CharField(max_length=50, default="", required=False)
     owner_store_id = serializers.CharField(required=False, allow_blank=True)
 
+    product = None
+
+    def get_product(self, product_id):
+        """Product for the line, from the cart's preloaded batch when there is one"""
+        products = self.context.get('products')
+        if products is not None:
+            return products.get(str(product_id))
+        return load_products([product_id]).get(str(product_id))
+
     def validate_product_id(self, value):
         """Validate product exists and is active"""
-        try:
-            product = Product.objects.get(id=value, status='active')
-            if not product.is_in_stock:
-                raise serializers.ValidationError("محصول موجود نیست")
-        except Product.DoesNotExist:
+        product = self.get_product(value)
+        if product is None or product.status != 'active':
             raise serializers.ValidationError("محصول یافت نشد")
+        if not product.is_in_stock:
+            raise serializers.ValidationError("محصول موجود نیست")
+        # Reused by validate_owner_store_id and to_internal_value
+        self.product = product
         return value
 
     def validate_owner_store_id(self, value):
         """Validate store exists if provided"""
         if not value:
             return value
+        if self.product is not None and str(self.product.store_owner_id) == value:
+            return value
         try:
             StoreOwner.objects.get(id=value)
         except StoreOwner.DoesNotExist:
@@ -657,24 +679,16 @@ class CartItemSerializer(serializers.Serializer):
 
     def to_internal_value(self, data):
         """Convert Decimal to float for MongoDB compatibility and populate missing fields"""
+        self.product = None
         ret = super().to_internal_value(data)
-        
-        # If price_snapshot is not provided, get it from the product
-        if not ret.get('price_snapshot'):
-            try:
-                product = Product.objects.get(id=ret['product_id'])
-                ret['price_snapshot'] = float(product.price)
-            except (Product.DoesNotExist, ValueError):
-                pass
-        
-        # If owner_store_id is not provided, get it from the product
-        if not ret.get('owner_store_id'):
-            try:
-                product = Product.objects.get(id=ret['product_id'])
-                ret['owner_store_id'] = str(product.store_owner.id)
-            except (Product.DoesNotExist, AttributeError):
-                pass
-        
+
+        # Missing price_snapshot and owner_store_id come from the product loaded during validation
+        if self.product is not None:
+            if not ret.get('price_snapshot'):
+                ret['price_snapshot'] = float(self.product.price)
+            if not ret.get('owner_store_id'):
+                ret['owner_store_id'] = str(self.product.store_owner_id)
+
         # Convert price_snapshot to float
         if 'price_snapshot' in ret and ret['price_snapshot'] is not None:
             if hasattr(ret['price_snapshot'], '__float__'):
@@ -693,6 +707,7 @@ class CartSerializer(serializers.ModelSerializer):
     # Computed fields
     total_items = serializers.SerializerMethodField()
     total_price = serializers.SerializerMethodField()
+    pricing = serializers.SerializerMethodField()
 
     class Meta:
         model = Cart
@@ -702,6 +717,7 @@ class CartSerializer(serializers.ModelSerializer):
             'items',
             'total_items',
             'total_price',
+            'pricing',
             'created_at',
             'updated_at',
         ]
@@ -710,6 +726,7 @@ class CartSerializer(serializers.ModelSerializer):
             'user_id',
             'total_items',
             'total_price',
+            'pricing',
             'created_at',
             'updated_at',
         ]
@@ -729,12 +746,21 @@ class CartSerializer(serializers.ModelSerializer):
         """Calculate total number of items in cart"""
         return sum(item.get('quantity', 0) for item in obj.items)
 
+    def get_priced_cart(self, obj):
+        """Price the cart once per representation, against live product data"""
+        priced = getattr(self, '_priced_carts', {})
+        if obj.pk not in priced:
+            priced[obj.pk] = CartPricer(obj.items).price()
+            self._priced_carts = priced
+        return priced[obj.pk]
+
     def get_total_price(self, obj):
-        """Calculate total price of all items in cart"""
-        return sum(
-            item.get('price_snapshot', 0) * item.get('quantity', 0)
-            for item in obj.items
-        )
+        """Calculate total price of all items in cart at current prices"""
+        return self.get_priced_cart(obj)['total_price']
+
+    def get_pricing(self, obj):
+        """Per-line current prices, stock status and change since price_snapshot"""
+        return self.get_priced_cart(obj)
 
     def validate_items(self, value):
         """Validate cart items"""
@@ -749,9 +775,9 @@ class CartSerializer(serializers.ModelSerializer):
         if len(product_ids) != len(set(product_ids)):
             raise serializers.ValidationError("محصولات تکراری در سبد خرید مجاز نیستند")
 
-        # Validate each item
+        # Validate each item against the products loaded once in to_internal_value
         for item in value:
-            item_serializer = CartItemSerializer(data=item)
+            item_serializer = CartItemSerializer(data=item, context={'products': self.context.get('products')})
             if not item_serializer.is_valid():
                 raise serializers.ValidationError(item_serializer.errors)
 
@@ -759,6 +785,12 @@ class CartSerializer(serializers.ModelSerializer):
 
     def to_internal_value(self, data):
         """Convert all Decimal objects to float for MongoDB compatibility"""
+        # One $in query for every product in the cart, shared by the item serializers
+        items = data.get('items') if hasattr(data, 'get') else None
+        if isinstance(items, list):
+            self.context['products'] = load_products(
+                item.get('product_id') for item in items if isinstance(item, dict)
+            )
         ret = super().to_internal_value(data)
 
         # Convert Decimal objects in items to float
@@ -802,6 +834,16 @@ class CartSerializer(serializers.ModelSerializer):
         return instance
 
 
+class ProductListSerializer(serializers.ListSerializer):
+    """List serializer that batch-loads product relations for the whole page"""
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.manager.BaseManager) else data
+        products = list(iterable)
+        self.child.loader = ProductLoader(products)
+        return super().to_representation(products)
+
+
 class ProductSerializer(serializers.ModelSerializer):
     """Serializer for Product model"""
     # Force ObjectId to string for DRF representation
@@ -814,6 +856,8 @@ class ProductSerializer(serializers.ModelSerializer):
     discount_percentage = serializers.ReadOnlyField()
     images_count = serializers.SerializerMethodField()
     images = serializers.SerializerMethodField()
+    thumbnail = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
 
     class Meta:
         model = Product
@@ -834,6 +878,7 @@ class ProductSerializer(serializers.ModelSerializer):
             'views',
             'sales_count',
             'rating',
+            'rating_histogram',
             'created_at',
             'updated_at',
             'is_in_stock',
@@ -841,12 +886,15 @@ class ProductSerializer(serializers.ModelSerializer):
             'discount_percentage',
             'images_count',
             'images',
+            'thumbnail',
+            'image_variants',
         ]
         read_only_fields = [
             'id',
             'store_owner',
             'views',
             'sales_count',
+            'rating_histogram',
             'created_at',
             'updated_at',
             'is_in_stock',
@@ -854,24 +902,73 @@ class ProductSerializer(serializers.ModelSerializer):
             'discount_percentage',
             'images_count',
         ]
+        list_serializer_class = ProductListSerializer
+
+    loader = None
+
+    def get_cache_base_url(self):
+        """Image URLs are absolute, so cached payloads are scoped to the request host"""
+        request = self.context.get('request')
+        return request.build_absolute_uri('/') if request else ''
+
+    def to_representation(self, instance):
+        base_url = self.get_cache_base_url()
+        data = product_cache.get(instance.pk, instance.updated_at, base_url)
+        if data is None:
+            data = super().to_representation(instance)
+            product_cache.set(instance, data, base_url)
+        else:
+            # View counting does not bump updated_at, take the count from the row
+            data['views'] = instance.views
+        return data
+
+    def get_loader(self, obj):
+        """Return the batch loader covering obj, creating a single-item one if needed"""
+        if self.loader is None or not self.loader.has(obj):
+            self.loader = ProductLoader([obj])
+        return self.loader
 
     def get_id(self, obj):
         return str(obj.id) if obj.id is not None else None
     def get_images(self, obj):
-        images = obj.images.all().order_by('-is_primary', 'created_at')
+        images = self.get_loader(obj).images_for(obj)
         return ProductImageSerializer(images, many=True, context=self.context).data
 
     def get_store_owner(self, obj):
         """Return store owner basic info"""
+        store_owner = self.get_loader(obj).store_owner_for(obj)
         return {
-            'id': str(obj.store_owner.id),
-            'store_name': obj.store_owner.store_name,
-            'full_name': obj.store_owner.full_name,
+            'id': str(store_owner.id),
+            'store_name': store_owner.store_name,
+            'full_name': store_owner.full_name,
         }
 
     def get_images_count(self, obj):
         """Return number of images"""
-        return obj.images.count()
+        return len(self.get_loader(obj).images_for(obj))
+
+    def get_primary_image(self, obj):
+        images = self.get_loader(obj).images_for(obj)
+        return images[0] if images else None
+
+    def get_thumbnail(self, obj):
+        """Return the primary image's thumbnail URL, the original until variants exist"""
+        image = self.get_primary_image(obj)
+        if image is None:
+            return None
+        request = self.context.get('request')
+        thumbnail = variant_urls(image, request).get('thumb')
+        if thumbnail:
+            return thumbnail
+        return request.build_absolute_uri(image.image.url) if request else image.image.url
+
+    def get_image_variants(self, obj):
+        """Return the primary image's variant URLs and srcset"""
+        image = self.get_primary_image(obj)
+        if image is None:
+            return None
+        request = self.context.get('request')
+        return {**variant_urls(image, request), 'srcset': srcset(image, request)}
 
     def validate_sku(self, value):
         """Validate SKU uniqueness per store owner"""
@@ -995,6 +1092,22 @@ class ProductSerializer(serializers.ModelSerializer):
         return instance
 
 
+class ProductImportSerializer(ProductSerializer):
+    """
+    Validates one row of a bulk product import. SKU conflicts are resolved
+    per batch by ProductImporter instead of one query per row.
+    """
+
+    class Meta(ProductSerializer.Meta):
+        read_only_fields = ProductSerializer.Meta.read_only_fields + ['rating']
+
+    def validate_sku(self, value):
+        """Validate SKU is present"""
+        if not value or len(value.strip()) == 0:
+            raise serializers.ValidationError("کد محصول الزامی است")
+        return value.strip()
+
+
 class ProductRatingSerializer(serializers.ModelSerializer):
     """Serializer for ProductRating model"""
     # Force ObjectId to string for DRF representation
@@ -1084,22 +1197,23 @@ class ProductRatingSerializer(serializers.ModelSerializer):
         # Create rating - this will handle the unique constraint
         try:
             rating = ProductRating.objects.create(**validated_data)
-            # Update product's aggregate rating
-            product.update_rating()
-            return rating
         except Exception as e:
             if 'unique_customer_product_rating' in str(e):
                 raise serializers.ValidationError("شما قبلاً به این محصول امتیاز داده‌اید")
             raise serializers.ValidationError("خطا در ایجاد امتیاز")
+        # Fold the new rating into the product's aggregate
+        product.apply_rating(added=rating.rating)
+        return rating
 
     def update(self, instance, validated_data):
         """Update rating instance"""
         # Only allow updating rating value
         if 'rating' in validated_data:
+            previous = instance.rating
             instance.rating = validated_data['rating']
             instance.save()
-            # Update product's aggregate rating
-            instance.product.update_rating()
+            # Apply only the difference to the product's aggregate
+            instance.product.apply_rating(added=instance.rating, removed=previous)
         return instance
 
 
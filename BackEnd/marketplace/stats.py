@@ -0,0 +1,192 @@
+from decimal import Decimal
+
+from bson.decimal128 import Decimal128
+from django.apps import apps
+from pymongo import ReturnDocument, UpdateOne
+
+from .mongo import column, get_collection
+from .rollups import sale_bucket_updates
+
+
+ACTIVE = 'active'
+CANCELLED = 'cancelled'
+
+
+def _model(name):
+    return apps.get_model('marketplace', name)
+
+
+def _decimal(value):
+    return Decimal128(Decimal(str(value)).quantize(Decimal('0.01')))
+
+
+# Active product count
+
+def active_delta(old_status, new_status):
+    """How a status change moves the store's active product count"""
+    return int(new_status == ACTIVE) - int(old_status == ACTIVE)
+
+
+def adjust_active_products(store_owner_id, delta):
+    if delta:
+        store_owner = _model('StoreOwner')
+        get_collection(store_owner).update_one(
+            {column(store_owner, 'pk'): store_owner_id},
+            {'$inc': {column(store_owner, 'active_products_count'): delta}},
+        )
+
+
+def transition_status(model, pk, new_status):
+    """
+    Atomically set a row's status and return the status it had, or None if it
+    already had new_status. Only the write that actually changes the status
+    sees the old value, so concurrent saves count a transition once.
+    """
+    doc = get_collection(model).find_one_and_update(
+        {column(model, 'pk'): pk, 'status': {'$ne': new_status}},
+        {'$set': {'status': new_status}},
+        projection={'status': 1},
+        return_document=ReturnDocument.BEFORE,
+    )
+    return doc['status'] if doc else None
+
+
+def count_active_products(store_owner_id):
+    """Recount one store's active products and store the result"""
+    product = _model('Product')
+    count = get_collection(product).count_documents(
+        {column(product, 'store_owner'): store_owner_id, 'status': ACTIVE},
+    )
+    store_owner = _model('StoreOwner')
+    get_collection(store_owner).update_one(
+        {column(store_owner, 'pk'): store_owner_id},
+        {'$set': {column(store_owner, 'active_products_count'): count}},
+    )
+    return count
+
+
+# Sales
+
+def sales_updates(store_owner_id, orders, revenue, moment=None, lines=()):
+    """
+    Writes adding orders/revenue to a store: one UpdateOne for the StoreOwner
+    totals plus the rollup bucket upserts of the store and of the products in
+    `lines` ((product_id, units, revenue) tuples). Negative values undo a sale.
+    Returns {model: [UpdateOne]} so callers can run them in their own session.
+    """
+    store_owner = _model('StoreOwner')
+    return {
+        store_owner: [UpdateOne(
+            {column(store_owner, 'pk'): store_owner_id},
+            {'$inc': {
+                column(store_owner, 'total_sales'): orders,
+                column(store_owner, 'total_revenue'): _decimal(revenue),
+            }},
+        )],
+        _model('StatsBucket'): sale_bucket_updates(store_owner_id, orders, revenue, lines, moment),
+    }
+
+
+def merge_updates(*groups):
+    """Combine sales_updates results into one {model: [UpdateOne]} map"""
+    merged = {}
+    for group in groups:
+        for model, operations in group.items():
+            merged.setdefault(model, []).extend(operations)
+    return merged
+
+
+def write_updates(updates, session=None):
+    """Run a {model: [UpdateOne]} map with one bulk_write per collection"""
+    for model, operations in updates.items():
+        if operations:
+            get_collection(model).bulk_write(operations, ordered=False, session=session)
+
+
+def record_sale(store_owner_id, amount, moment=None):
+    write_updates(sales_updates(store_owner_id, 1, amount, moment))
+
+
+def order_status_changed(order, old_status):
+    """Take a cancelled order out of the store's sales, or put a restored one back"""
+    if old_status is None or old_status == order.status or CANCELLED not in (old_status, order.status):
+        return
+    sign = -1 if order.status == CANCELLED else 1
+    lines = order.items.values_list('product_id', 'quantity', 'total')
+    # The order counts in the buckets of the time it was placed
+    write_updates(sales_updates(order.store_id, sign, sign * order.total_amount, order.created_at, lines))
+
+
+# Reconciliation
+
+def reconcile(store_owner_ids=None, attempts=3):
+    """
+    Recompute active_products_count, total_sales and total_revenue from Product
+    and Order with one aggregation ($unionWith) and fix every store whose
+    numbers drifted. Each fix is a compare-and-set on the values read before
+    the aggregation, so a concurrent $inc is never overwritten: the store is
+    recounted on the next attempt instead. Returns the number of stores fixed.
+    """
+    fixed = 0
+    for _ in range(attempts):
+        count, conflicted = _reconcile_once(store_owner_ids)
+        fixed += count
+        if not conflicted:
+            break
+        store_owner_ids = conflicted
+    return fixed
+
+
+def _reconcile_once(store_owner_ids):
+    product, order, store_owner = _model('Product'), _model('Order'), _model('StoreOwner')
+    pk = column(store_owner, 'pk')
+    fields = {
+        'active': column(store_owner, 'active_products_count'),
+        'sales': column(store_owner, 'total_sales'),
+        'revenue': column(store_owner, 'total_revenue'),
+    }
+    # Observed first: a write after this read makes the compare-and-set miss
+    stores = {pk: {'$in': list(store_owner_ids)}} if store_owner_ids is not None else {}
+    observed = list(get_collection(store_owner).find(stores, projection={pk: 1, **{key: 1 for key in fields.values()}}))
+
+    product_owner, order_store = column(product, 'store_owner'), column(order, 'store')
+    products_match = {'status': ACTIVE}
+    orders_match = {'status': {'$ne': CANCELLED}}
+    if store_owner_ids is not None:
+        products_match[product_owner] = {'$in': list(store_owner_ids)}
+        orders_match[order_store] = {'$in': list(store_owner_ids)}
+
+    zero = Decimal128('0')
+    pipeline = [
+        {'$match': products_match},
+        {'$group': {'_id': f'${product_owner}', 'active': {'$sum': 1}, 'sales': {'$sum': 0}, 'revenue': {'$sum': zero}}},
+        {'$unionWith': {'coll': order._meta.db_table, 'pipeline': [
+            {'$match': orders_match},
+            {'$group': {'_id': f'${order_store}', 'active': {'$sum': 0}, 'sales': {'$sum': 1}, 'revenue': {'$sum': '$total_amount'}}},
+        ]}},
+        {'$group': {'_id': '$_id', 'active': {'$sum': '$active'}, 'sales': {'$sum': '$sales'}, 'revenue': {'$sum': '$revenue'}}},
+    ]
+    truth = {row['_id']: row for row in get_collection(product).aggregate(pipeline)}
+
+    fixed, conflicted = 0, []
+    for doc in observed:
+        row = truth.get(doc[pk], {})
+        values = {
+            fields['active']: row.get('active', 0),
+            fields['sales']: row.get('sales', 0),
+            fields['revenue']: _decimal(row['revenue'].to_decimal() if row.get('revenue') is not None else 0),
+        }
+        current = {key: doc.get(key) for key in values}
+        if isinstance(current[fields['revenue']], Decimal128):
+            current[fields['revenue']] = _decimal(current[fields['revenue']].to_decimal())
+        if current == values:
+            continue
+        result = get_collection(store_owner).update_one(
+            {pk: doc[pk], **{key: doc.get(key) for key in values}},
+            {'$set': values},
+        )
+        if result.matched_count:
+            fixed += 1
+        else:
+            conflicted.append(doc[pk])
+    return fixed, conflicted
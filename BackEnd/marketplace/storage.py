@@ -0,0 +1,112 @@
+import hashlib
+import os
+import uuid
+
+from django.apps import apps
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils import timezone
+from pymongo import ReturnDocument
+
+from .mongo import get_collection
+
+
+# Blobs live under this prefix, named after the sha256 of their content
+PREFIX = 'cas/'
+
+# Sent with blob responses: a blob URL never changes content
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def is_immutable(name):
+    """Check if a stored name is a content-addressed blob"""
+    return name.startswith(PREFIX)
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File storage that names every upload after the sha256 of its content,
+    so identical files are stored once whatever name or prefix they were
+    uploaded under. Each stored name has a MediaBlob row counting the
+    fields that point at it; delete() releases one reference and removes
+    the file with the last one, unless a concurrent save() took a new
+    reference meanwhile. Names outside cas/ (files stored before
+    this backend) are handled like plain FileSystemStorage files.
+    """
+
+    def __init__(self, **kwargs):
+        # The same content may be written twice concurrently, which is harmless
+        kwargs.setdefault('allow_overwrite', True)
+        super().__init__(**kwargs)
+
+    @property
+    def blobs(self):
+        return get_collection(apps.get_model('marketplace', 'MediaBlob'))
+
+    @staticmethod
+    def digest(content):
+        sha256 = hashlib.sha256()
+        size = 0
+        for chunk in content.chunks():
+            sha256.update(chunk)
+            size += len(chunk)
+        content.seek(0)
+        return sha256.hexdigest(), size
+
+    @staticmethod
+    def blob_name(digest, name):
+        extension = os.path.splitext(name or '')[1].lower()
+        return f"{PREFIX}{digest[:2]}/{digest[2:4]}/{digest}{extension}"
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+
+        digest, size = self.digest(content)
+        name = self.blob_name(digest, name)
+        blob = self.blobs.find_one_and_update(
+            {'name': name},
+            {'$inc': {'refs': 1}, '$setOnInsert': {'sha256': digest, 'size': size, 'created_at': timezone.now()}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        # A first reference always (re)writes, in case a concurrent delete just removed the file
+        if blob['refs'] == 1 or not self.exists(name):
+            self._save(name, content)
+        return name
+
+    def delete(self, name):
+        if not name:
+            return
+        if not is_immutable(name):
+            return super().delete(name)
+
+        blob = self.blobs.find_one_and_update(
+            {'name': name}, {'$inc': {'refs': -1}}, return_document=ReturnDocument.AFTER,
+        )
+        if blob is not None and blob['refs'] > 0:
+            return
+
+        # Move the file aside before dropping the row: a save() that takes a
+        # new reference in between makes the drop fail and the file comes back
+        path = self.path(name)
+        aside = f"{path}.{uuid.uuid4().hex}.deleting"
+        try:
+            os.rename(path, aside)
+        except FileNotFoundError:
+            aside = None
+        if blob is None:
+            released = self.blobs.count_documents({'name': name, 'refs': {'$gt': 0}}) == 0
+        else:
+            released = self.blobs.delete_one({'name': name, 'refs': {'$lte': 0}}).deleted_count == 1
+        if aside is None:
+            return
+        if released:
+            os.remove(aside)
+        elif os.path.exists(path):
+            # The concurrent save already wrote the same content again
+            os.remove(aside)
+        else:
+            os.replace(aside, path)
@@ -0,0 +1,84 @@
+import json
+
+from django.db.models import QuerySet
+from django.http import StreamingHttpResponse
+from rest_framework.exceptions import ParseError
+from rest_framework.utils.encoders import JSONEncoder
+
+
+STREAM_FORMATS = ('json', 'ndjson')
+
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+# Rows read from the cursor and serialized together
+CHUNK_SIZE = 200
+
+
+def get_stream_format(request):
+    """Return the format asked for with ?stream=, or None for a regular response"""
+    fmt = request.query_params.get('stream')
+    if not fmt:
+        return None
+    if fmt not in STREAM_FORMATS:
+        raise ParseError(f'stream must be one of: {", ".join(STREAM_FORMATS)}')
+    return fmt
+
+
+def queryset_batches(queryset, chunk_size=CHUNK_SIZE):
+    """Yield lists of at most chunk_size rows, reading a queryset's cursor in chunks"""
+    rows = queryset.iterator(chunk_size=chunk_size) if isinstance(queryset, QuerySet) else iter(queryset)
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= chunk_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def encode(data):
+    return json.dumps(data, cls=JSONEncoder, ensure_ascii=False)
+
+
+def stream_items(batches, serialize, fmt, envelope=None, list_key=None, count_key=None):
+    """
+    Yield the encoded response chunk by chunk, one chunk per serialized batch.
+    JSON mode writes a bare array, or when list_key is given an object holding
+    the envelope fields, the array under list_key and the row count under
+    count_key. NDJSON mode writes one row per line and no envelope.
+    """
+    if fmt == 'ndjson':
+        for batch in batches:
+            yield ''.join(encode(row) + '\n' for row in serialize(batch)).encode('utf-8')
+        return
+
+    if list_key is None:
+        yield b'['
+    else:
+        fields = ''.join(f'{encode(key)}: {encode(value)}, ' for key, value in (envelope or {}).items())
+        yield f'{{{fields}{encode(list_key)}: ['.encode('utf-8')
+
+    count = 0
+    for batch in batches:
+        rows = [encode(row) for row in serialize(batch)]
+        if rows:
+            yield ((', ' if count else '') + ', '.join(rows)).encode('utf-8')
+            count += len(rows)
+
+    if list_key is None:
+        yield b']'
+    elif count_key is None:
+        yield b']}'
+    else:
+        yield f'], {encode(count_key)}: {count}}}'.encode('utf-8')
+
+
+def streaming_response(fmt, batches, serialize, **layout):
+    """Wrap stream_items in a StreamingHttpResponse"""
+    return StreamingHttpResponse(
+        stream_items(batches, serialize, fmt, **layout), content_type=CONTENT_TYPES[fmt],
+    )
@@ -2,8 +2,26 @@ from django.test import TestCase
 
 from marketplace.models import (
     Customer, StoreOwner, Product, ProductImage, ProductRating,
-    Cart, Order, OrderItem, Comment, Wishlist, WishlistItem
+    Cart, Order, OrderItem, Comment, Wishlist, WishlistItem, MediaBlob, StoreRating, SearchTerm
 )
+from marketplace.cache import LocMemLRUBackend, ProductCache, product_cache
+from marketplace.counters import ViewCounter
+from marketplace.search import tokenize
+from marketplace.pricing import CartPricer, LineStatus
+from marketplace.loaders import ProductLoader
+from marketplace.images import ImageProcessor, srcset
+from marketplace.storage import ContentAddressedStorage
+from marketplace.media import media_response, parse_range
+from marketplace.stats import reconcile
+from marketplace.rollups import rebuild_buckets, series
+from PIL import Image
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, override_settings
+from django.core.files.storage import FileSystemStorage
+import tempfile
+from unittest import mock
+from django.utils import timezone
+from datetime import timedelta
 from decimal import Decimal
 
 
@@ -119,6 +137,16 @@ class StoreOwnerTestCase(TestCase):
         self.assertEqual(self.store_owner.seller_rating["average"], 4.0)
         self.assertEqual(self.store_owner.seller_rating["count"], 2)
 
+    def test_store_rating_is_one_per_rater(self):
+        """Test rating again replaces the rater's previous store rating"""
+        customer = Customer.objects.create_user(phone="09120000001", password="testpass123")
+        self.assertTrue(self.store_owner.rate(customer, "store", 5))
+        self.assertFalse(self.store_owner.rate(customer, "store", 3))
+        self.assertEqual(self.store_owner.store_rating["count"], 1)
+        self.assertEqual(self.store_owner.store_rating["average"], 3)
+        self.assertEqual(StoreRating.objects.filter(rater=customer, store_owner=self.store_owner).count(), 1)
+        customer.delete()
+
     def test_store_owner_sales_increment(self):
         """Test sales increment"""
         initial_sales = self.store_owner.total_sales
@@ -128,6 +156,32 @@ class StoreOwnerTestCase(TestCase):
         self.assertEqual(self.store_owner.total_sales, initial_sales + 1)
         self.assertEqual(self.store_owner.total_revenue, initial_revenue + Decimal("1000.00"))
 
+    def test_sales_fill_daily_bucket(self):
+        """Test a sale is counted in today's stats bucket"""
+        self.store_owner.increment_sales(Decimal("250.00"))
+        now = timezone.now()
+        for granularity in ("hour", "day"):
+            bucket = series(self.store_owner.pk, now, now, granularity)[0]
+            self.assertEqual(bucket["orders"], 1)
+            self.assertEqual(Decimal(bucket["revenue"]), Decimal("250.00"))
+
+    def test_rebuild_buckets_skips_live_periods(self):
+        """Test a rebuild fills past buckets from orders and leaves the current ones to live counts"""
+        customer = Customer.objects.create_user(phone="09120000002", password="testpass123")
+        order = Order.objects.create(
+            user=customer, store=self.store_owner, total_amount=Decimal("80.00"), payment_method="online"
+        )
+        placed = timezone.now() - timedelta(days=3)
+        Order.objects.filter(pk=order.pk).update(created_at=placed)
+
+        rebuild_buckets(store_owner_ids=[self.store_owner.pk])
+        now = timezone.now()
+        self.assertEqual(series(self.store_owner.pk, placed, placed)[0]["orders"], 1)
+        # Counted live when the order was saved, not rebuilt
+        self.assertEqual(series(self.store_owner.pk, now, now)[0]["orders"], 1)
+        order.delete()
+        customer.delete()
+
 
 class ProductTestCase(TestCase):
     """Test case for Product model"""
@@ -201,12 +255,54 @@ class ProductTestCase(TestCase):
         self.product.increment_views()
         self.assertEqual(self.product.views, initial_views + 1)
 
+    def test_product_buffered_view_counter(self):
+        """Test buffered views are coalesced and flushed in one write"""
+        counter = ViewCounter(buffered=True, flush_interval_ms=60000, flush_max_events=1000)
+        for _ in range(3):
+            counter.increment(self.product.pk)
+        self.assertEqual(counter.pending(self.product.pk), 3)
+        self.assertEqual(counter.flush(), 1)
+        self.assertEqual(counter.pending(self.product.pk), 0)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.views, 3)
+
+    def test_product_views_fill_buckets(self):
+        """Test product views are counted in the product and store buckets"""
+        self.product.increment_views()
+        now = timezone.now()
+        self.assertEqual(series(self.store_owner.pk, now, now, "hour", self.product.pk)[0]["views"], 1)
+        self.assertEqual(series(self.store_owner.pk, now, now, "day")[0]["views"], 1)
+
     def test_product_increment_sales(self):
         """Test sales increment"""
         initial_sales = self.product.sales_count
         self.product.increment_sales()
         self.assertEqual(self.product.sales_count, initial_sales + 1)
 
+    def test_status_changes_update_active_products_count(self):
+        """Test active_products_count follows product status changes"""
+        self.store_owner.refresh_from_db()
+        self.assertEqual(self.store_owner.active_products_count, 1)
+
+        product = Product.objects.get(pk=self.product.pk)
+        product.status = Product.Status.DRAFT
+        product.save()
+        product.save()
+        self.store_owner.refresh_from_db()
+        self.assertEqual(self.store_owner.active_products_count, 0)
+
+        StoreOwner.objects.filter(pk=self.store_owner.pk).update(active_products_count=5)
+        reconcile([self.store_owner.pk])
+        self.store_owner.refresh_from_db()
+        self.assertEqual(self.store_owner.active_products_count, 0)
+
+        # A stale copy deleted twice only counts the row it actually removed
+        product.status = Product.Status.ACTIVE
+        Product.objects.get(pk=self.product.pk).delete()
+        product.delete()
+        self.store_owner.refresh_from_db()
+        self.assertEqual(self.store_owner.active_products_count, 0)
+
 
 class ProductRatingTestCase(TestCase):
     """Test case for ProductRating model"""
@@ -277,6 +373,29 @@ class ProductRatingTestCase(TestCase):
                 rating=Decimal("3.0")
             )
 
+    def test_incremental_rating_aggregate(self):
+        """Test ratings are folded into the product aggregate and histogram"""
+        self.product.apply_rating(added=Decimal("4.5"))
+        self.product.apply_rating(added=Decimal("2.0"))
+        self.assertEqual(self.product.rating["count"], 2)
+        self.assertEqual(self.product.rating["average"], 3.25)
+        self.assertEqual(self.product.rating_histogram["5"], 1)
+        self.assertEqual(self.product.rating_histogram["2"], 1)
+
+        # An edit moves one rating between buckets without changing the count
+        self.product.apply_rating(added=Decimal("3.0"), removed=Decimal("2.0"))
+        self.assertEqual(self.product.rating["count"], 2)
+        self.assertEqual(self.product.rating["average"], 3.75)
+        self.assertEqual(self.product.rating_histogram["2"], 0)
+        self.assertEqual(self.product.rating_histogram["3"], 1)
+
+    def test_rebuild_product_rating(self):
+        """Test the aggregate can be recomputed from individual ratings"""
+        self.product.update_rating()
+        self.assertEqual(self.product.rating["count"], 1)
+        self.assertEqual(self.product.rating["average"], 4.5)
+        self.assertEqual(self.product.rating_histogram["5"], 1)
+
 
 class CartTestCase(TestCase):
     """Test case for Cart model"""
@@ -304,6 +423,36 @@ class CartTestCase(TestCase):
         with self.assertRaises(Exception):
             Cart.objects.create(user_id=self.customer)
 
+    def test_cart_pricer_revalidates_lines(self):
+        """Test cart lines are priced against live product data"""
+        store_owner = StoreOwner.objects.create_store_owner(
+            phone="09198765432",
+            password="storepass123",
+            store_name="Test Store"
+        )
+        product = Product.objects.create(
+            store_owner=store_owner,
+            title="Test Product",
+            sku="TEST-SKU-001",
+            price=Decimal("120.00"),
+            stock=3,
+            category="men"
+        )
+        priced = CartPricer([
+            {"product_id": str(product.id), "quantity": 2, "price_snapshot": 100.0},
+            {"product_id": "000000000000000000000000", "quantity": 1, "price_snapshot": 50.0},
+        ]).price()
+
+        line, missing = priced["items"]
+        self.assertEqual(line["status"], LineStatus.PRICE_CHANGED)
+        self.assertEqual(line["price_delta"], Decimal("20.00"))
+        self.assertEqual(missing["status"], LineStatus.UNAVAILABLE)
+        self.assertEqual(priced["total_price"], Decimal("240.00"))
+        self.assertEqual(priced["price_delta"], Decimal("40.00"))
+        self.assertFalse(priced["is_valid"])
+        product.delete()
+        store_owner.delete()
+
 
 class OrderTestCase(TestCase):
     """Test case for Order model"""
@@ -502,6 +651,44 @@ class CommentTestCase(TestCase):
         reply1.delete()
         reply2.delete()
 
+    def test_comment_thread_summary(self):
+        """Test reply counts and root pointers are maintained on create and delete"""
+        reply = Comment.objects.create(
+            product=self.product,
+            author=self.store_owner,
+            content="Reply",
+            parent=self.comment
+        )
+        nested = Comment.objects.create(
+            product=self.product,
+            author=self.customer,
+            content="Nested reply",
+            parent=reply
+        )
+        self.assertEqual(reply.root_id, self.comment.id)
+        self.assertEqual(nested.root_id, self.comment.id)
+
+        self.comment.refresh_from_db()
+        self.assertEqual(self.comment.reply_count, 1)
+        self.assertIsNotNone(self.comment.last_reply_at)
+        # The root counts nested replies and their activity too
+        self.assertEqual(self.comment.thread_reply_count, 2)
+        self.assertEqual(self.comment.thread_last_reply_at, nested.created_at)
+
+        nested.delete()
+        reply.refresh_from_db()
+        self.assertEqual(reply.reply_count, 0)
+        self.assertIsNone(reply.last_reply_at)
+        self.comment.refresh_from_db()
+        self.assertEqual(self.comment.thread_reply_count, 1)
+
+        Comment.objects.create(product=self.product, author=self.customer, content="Again", parent=reply)
+        # Deleting a reply takes its cascaded subtree out of the thread total
+        reply.delete()
+        self.comment.refresh_from_db()
+        self.assertEqual(self.comment.thread_reply_count, 0)
+        self.assertIsNone(self.comment.thread_last_reply_at)
+
 
 class WishlistTestCase(TestCase):
     """Test case for Wishlist and WishlistItem models"""
@@ -601,3 +788,270 @@ class WishlistTestCase(TestCase):
                 product=self.product1
             )
 
+
+class ProductLoaderTestCase(TestCase):
+    """Test case for batched product relation loading"""
+
+    def setUp(self):
+        self.store_owner = StoreOwner.objects.create_store_owner(
+            phone="09198765432",
+            password="storepass123",
+            store_name="Test Store",
+            first_name="Jane",
+            last_name="Smith"
+        )
+        self.product1 = Product.objects.create(
+            store_owner=self.store_owner,
+            title="Product 1",
+            description="Description 1",
+            sku="SKU-001",
+            price=Decimal("100.00"),
+            stock=50,
+            category="men"
+        )
+        self.product2 = Product.objects.create(
+            store_owner=self.store_owner,
+            title="Product 2",
+            description="Description 2",
+            sku="SKU-002",
+            price=Decimal("200.00"),
+            stock=30,
+            category="women"
+        )
+        self.image1 = ProductImage.objects.create(product=self.product1, image="products/a.jpg")
+        self.image2 = ProductImage.objects.create(product=self.product1, image="products/b.jpg", is_primary=True)
+
+    def tearDown(self):
+        self.product1.delete()
+        self.product2.delete()
+        self.store_owner.delete()
+
+    def test_loader_groups_images_primary_first(self):
+        """Test images are grouped per product with the primary image first"""
+        loader = ProductLoader([self.product1, self.product2])
+        images = loader.images_for(self.product1)
+        self.assertEqual([img.id for img in images], [self.image2.id, self.image1.id])
+        self.assertEqual(loader.images_for(self.product2), [])
+
+    def test_loader_resolves_store_owner(self):
+        """Test store owners are resolved from the batch"""
+        loader = ProductLoader([self.product1, self.product2])
+        self.assertEqual(loader.store_owner_for(self.product1).id, self.store_owner.id)
+        self.assertTrue(loader.has(self.product2))
+
+
+class ProductCacheTestCase(TestCase):
+    """Test case for the serialized product cache"""
+
+    def setUp(self):
+        self.store_owner = StoreOwner.objects.create_store_owner(
+            phone="09198765432",
+            password="storepass123",
+            store_name="Test Store",
+            first_name="Jane",
+            last_name="Smith"
+        )
+        self.product = Product.objects.create(
+            store_owner=self.store_owner,
+            title="Test Product",
+            description="Test Description",
+            sku="TEST-SKU-001",
+            price=Decimal("100.00"),
+            stock=50,
+            category="men"
+        )
+
+    def tearDown(self):
+        self.product.delete()
+        self.store_owner.delete()
+
+    def test_lru_backend_evicts_oldest(self):
+        """Test the LRU backend drops the least recently used entry"""
+        backend = LocMemLRUBackend(max_entries=2)
+        backend.set("a", 1)
+        backend.set("b", 2)
+        backend.get("a")
+        backend.set("c", 3)
+        self.assertEqual(backend.get("a"), 1)
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual(backend.get("c"), 3)
+
+    def test_lru_backend_returns_copies(self):
+        """Test editing a value read from the backend leaves the entry intact"""
+        backend = LocMemLRUBackend()
+        value = {"title": "Test Product"}
+        backend.set("a", value)
+        value["score"] = 1
+        backend.get("a")["score"] = 2
+        self.assertEqual(backend.get("a"), {"title": "Test Product"})
+
+    def test_cache_misses_on_newer_version(self):
+        """Test a payload cached for an older updated_at is not served"""
+        cache = ProductCache(LocMemLRUBackend())
+        cache.set(self.product, {"title": "Test Product"})
+        self.assertEqual(cache.get(self.product.pk, self.product.updated_at), {"title": "Test Product"})
+        self.product.title = "Renamed"
+        self.product.save()
+        self.assertIsNone(cache.get(self.product.pk, self.product.updated_at))
+
+    def test_product_save_invalidates_cache(self):
+        """Test saving a product drops its cached payload"""
+        product_cache.set(self.product, {"title": "Test Product"})
+        self.product.save()
+        self.assertIsNone(product_cache.get(self.product.pk))
+
+
+class SearchNormalizationTestCase(TestCase):
+    """Test case for search text normalization"""
+
+    def test_tokenize_unifies_persian_and_latin(self):
+        """Test letter variants, digits, diacritics and case are folded"""
+        self.assertEqual(tokenize("كيف"), tokenize("کیف"))
+        self.assertEqual(tokenize("سايز ۴۲"), ["سایز", "42"])
+        self.assertEqual(tokenize("كِتاب"), ["کتاب"])
+        self.assertEqual(tokenize("Café BLUE"), ["cafe", "blue"])
+
+    def test_tokenize_folds_decomposed_letters(self):
+        """Test hamza letters, heh with yeh and presentation forms fold like their plain letters"""
+        self.assertEqual(tokenize("پائیز"), tokenize("پاییز"))
+        self.assertEqual(tokenize("خانۀ"), tokenize("خانه"))
+        self.assertEqual(tokenize("\ufef3\ufed9"), tokenize("یک"))
+
+    def test_deleting_product_decrements_document_frequency(self):
+        """Test a deleted product's terms are taken out of the index statistics"""
+        store_owner = StoreOwner.objects.create_store_owner(
+            phone="09198765432", password="storepass123", store_name="Test Store"
+        )
+        product = Product.objects.create(
+            store_owner=store_owner, title="Zanzibar", description="Description",
+            sku="SEARCH-001", price=Decimal("10.00"), stock=1, category="men"
+        )
+        self.assertEqual(SearchTerm.objects.get(term="zanzibar").df, 1)
+        product.delete()
+        self.assertFalse(SearchTerm.objects.filter(term="zanzibar", df__gt=0).exists())
+        store_owner.delete()
+
+
+class ImageProcessorTestCase(TestCase):
+    """Test case for product image variants"""
+
+    def test_render_crops_and_scales(self):
+        """Test fixed sizes are cropped and width-only sizes keep the aspect ratio"""
+        processor = ImageProcessor()
+        source = Image.new("RGB", (2000, 1000), "white")
+        data, size = processor.render(source, (150, 150))
+        self.assertEqual(size, (150, 150))
+        self.assertEqual(data[8:12], b"WEBP")
+        _, size = processor.render(source, (640, None))
+        self.assertEqual(size, (640, 320))
+
+    def test_srcset_skips_cropped_variants(self):
+        """Test srcset lists only aspect-preserving variants, narrowest first"""
+        image = ProductImage(variants={
+            "thumb": {"name": "products/variants/1/thumb.webp", "width": 150, "height": 150, "cropped": True},
+            "medium": {"name": "products/variants/1/medium.webp", "width": 640, "height": 320, "cropped": False},
+            "small": {"name": "products/variants/1/small.webp", "width": 320, "height": 160, "cropped": False},
+        })
+        self.assertEqual(
+            srcset(image),
+            "/media/products/variants/1/small.webp 320w, /media/products/variants/1/medium.webp 640w",
+        )
+
+    def test_store_uploads_writes_every_file(self):
+        """Test concurrent upload writes point each image at its own stored file"""
+        processor = ImageProcessor(upload_workers=3)
+        field = ProductImage._meta.get_field("image")
+        files = [SimpleUploadedFile("photo.jpg", f"image {i}".encode()) for i in range(3)]
+        images = [ProductImage() for _ in files]
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            processor.store_uploads(field, images, files)
+            names = [image.image.name for image in images]
+            self.assertEqual(len(set(names)), 3)
+            self.assertTrue(all(name.startswith("cas/") for name in names))
+            self.assertEqual(sorted(image.image.read() for image in images), [b"image 0", b"image 1", b"image 2"])
+
+
+class ContentAddressedStorageTestCase(TestCase):
+    """Test case for the deduplicating media storage"""
+
+    def test_identical_uploads_share_one_blob(self):
+        """Test equal content is stored once and removed with its last reference"""
+        with tempfile.TemporaryDirectory() as media_root:
+            storage = ContentAddressedStorage(location=media_root)
+            first = storage.save("products/a.jpg", SimpleUploadedFile("a.jpg", b"same photo"))
+            second = storage.save("store_logos/b.JPG", SimpleUploadedFile("b.JPG", b"same photo"))
+            self.assertEqual(first, second)
+            self.assertTrue(first.startswith("cas/") and first.endswith(".jpg"))
+            self.assertEqual(MediaBlob.objects.get(name=first).refs, 2)
+
+            storage.delete(first)
+            self.assertTrue(storage.exists(first))
+            storage.delete(second)
+            self.assertFalse(storage.exists(first))
+            self.assertFalse(MediaBlob.objects.filter(name=first).exists())
+
+    def test_delete_keeps_file_referenced_meanwhile(self):
+        """Test a reference taken while the last one is released keeps the file"""
+        with tempfile.TemporaryDirectory() as media_root:
+            storage = ContentAddressedStorage(location=media_root)
+            name = storage.save("products/a.jpg", SimpleUploadedFile("a.jpg", b"photo"))
+            blobs = storage.blobs
+
+            def racing_delete_one(*args, **kwargs):
+                # A save() takes a reference between the release and the row drop
+                blobs.update_one({'name': name}, {'$inc': {'refs': 1}})
+                return blobs.delete_one(*args, **kwargs)
+
+            racing = mock.Mock(wraps=blobs)
+            racing.delete_one.side_effect = racing_delete_one
+            with mock.patch.object(ContentAddressedStorage, 'blobs', new=racing):
+                storage.delete(name)
+            self.assertTrue(storage.exists(name))
+            self.assertEqual(MediaBlob.objects.get(name=name).refs, 1)
+
+
+class MediaResponseTestCase(TestCase):
+    """Test case for conditional and range media responses"""
+
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.storage = FileSystemStorage(location=self.media_root.name)
+        self.name = self.storage.save("users/photo.jpg", SimpleUploadedFile("photo.jpg", b"0123456789"))
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        self.media_root.cleanup()
+
+    def get(self, **headers):
+        response = media_response(self.factory.get("/media/", headers=headers), self.name, self.storage)
+        body = b"".join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, body
+
+    def test_full_response_and_revalidation(self):
+        """Test a full response carries validators and a matching ETag gets 304"""
+        response, body = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, b"0123456789")
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+
+        response, _ = self.get(if_none_match=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_range_requests(self):
+        """Test byte ranges return 206 and unsatisfiable ones 416"""
+        response, body = self.get(range="bytes=2-5")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, b"2345")
+        self.assertEqual(response["Content-Range"], "bytes 2-5/10")
+
+        response, _ = self.get(range="bytes=20-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(parse_range("bytes=-3", 10), (7, 9))
+
+    @override_settings(MEDIA_SERVING={'OFFLOAD': 'x-accel-redirect', 'INTERNAL_PREFIX': '/protected/'})
+    def test_offload(self):
+        """Test the body is handed to the web server when offload is configured"""
+        response, body = self.get()
+        self.assertEqual(response["X-Accel-Redirect"], f"/protected/{self.name}")
+        self.assertEqual(body, b"")
@@ -1,12 +1,52 @@
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.exceptions import PermissionDenied
-from django.http import HttpResponse
+from rest_framework.exceptions import NotFound, ParseError, PermissionDenied
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from datetime import datetime, time, timedelta
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from bson import ObjectId
+from bson.errors import InvalidId
 from django.db.models import Q
 from .models import Customer, StoreOwner, Product, ProductRating, Cart, Order, OrderItem, Wishlist, WishlistItem, Comment
 from .serializers import CartItemSerializer, CustomerSerializer, StoreOwnerSerializer, ProductSerializer, ProductRatingSerializer, CartSerializer, OrderSerializer, OrderItemSerializer, WishlistSerializer, WishlistItemSerializer, AddToWishlistSerializer, CommentSerializer
 from .permissions import IsAdminRole, IsSelfOrAdmin, IsStoreOwner, IsStoreOwnerOrAdmin, IsCustomer, IsCustomerOrAdmin, IsStoreOwnerForOrders
+from .pagination import KeysetPaginationMixin
+from .cache import product_cache
+from .mongo import column
+from .catalog import STORE_ORDERINGS, stores_by_category
+from .search import search_index
+from .facets import ProductFilter
+from .cart_engine import EDITABLE_FIELDS, CartEngine, find_line
+from .loaders import CommentThreadLoader, WishlistLoader
+from .bulk import CONTENT_TYPES, FORMATS, ProductImporter, export_stream, format_for, read_rows
+from .streaming import get_stream_format, queryset_batches, streaming_response
+from .media import media_response
+from .recommendations import recommendations
+from .rankings import DEFAULT_ORDERING, KINDS, PRODUCT_ORDERINGS, mongo_sort, rankings, scope_key
+from .rollups import DAY, GRANULARITIES, MAX_POINTS, STEPS, bucket_start, series, top_products, totals
+
+
+def get_page_params(request, default_page_size=20, max_page_size=100):
+    """Read page/page_size query params for endpoints that page inside an aggregation"""
+    try:
+        page = max(int(request.query_params.get('page', 1)), 1)
+        page_size = int(request.query_params.get('page_size', default_page_size))
+    except ValueError:
+        raise ParseError('page and page_size must be integers')
+    return page, min(max(page_size, 1), max_page_size)
+
+
+def serialize_with(view, serializer_class=None):
+    """Serializer callback for streaming_response: renders one batch with many=True"""
+    serializer_class = serializer_class or view.get_serializer_class()
+    if hasattr(view, 'get_serializer_context'):
+        context = view.get_serializer_context()
+    else:
+        context = {'request': view.request}
+    return lambda batch: serializer_class(batch, many=True, context=context).data
 
 
 
@@ -71,10 +111,7 @@ class CustomerViewSet(viewsets.ModelViewSet):
         user = self.get_object()
         if not user.has_profile_image():
             return Response({'detail': 'no image'}, status=status.HTTP_404_NOT_FOUND)
-        response = HttpResponse(user.image_data, content_type=user.image_content_type or 'application/octet-stream')
-        if user.image_filename:
-            response['Content-Disposition'] = f'inline; filename="{user.image_filename}"'
-        return response
+        return media_response(request, user.image.name, user.image.storage)
 
 
 class StoreOwnerViewSet(viewsets.ModelViewSet):
@@ -111,13 +148,13 @@ class StoreOwnerViewSet(viewsets.ModelViewSet):
                           'upload_store_logo', 'remove_store_logo',
                           'profile_image_info', 'store_logo_info',
                           'download_profile_image', 'download_store_logo',
-                          'statistics']:
+                          'statistics', 'analytics']:
             # Store owner can manage their own data, admins can manage all
             return [IsSelfOrAdmin()]
         if self.action in ['test_upload_store_logo']:
             # Allow anyone for testing
             return [permissions.AllowAny()]
-        if self.action in ['rate-seller', 'rate-store']:
+        if self.action in ['rate_seller', 'rate_store']:
             # Only customers and admins can rate
             return [IsCustomerOrAdmin()]
         return [permissions.IsAuthenticated()]
@@ -179,13 +216,7 @@ class StoreOwnerViewSet(viewsets.ModelViewSet):
                 {'detail': 'No profile image found'}, 
                 status=status.HTTP_404_NOT_FOUND
             )
-        response = HttpResponse(
-            store_owner.image_data, 
-            content_type=store_owner.image_content_type or 'application/octet-stream'
-        )
-        if store_owner.image_filename:
-            response['Content-Disposition'] = f'inline; filename="{store_owner.image_filename}"'
-        return response
+        return media_response(request, store_owner.image.name, store_owner.image.storage)
 
     # Store Logo Actions
     @action(detail=True, methods=['post'], url_path='upload-store-logo')
@@ -237,35 +268,105 @@ class StoreOwnerViewSet(viewsets.ModelViewSet):
                 {'detail': 'No store logo found'}, 
                 status=status.HTTP_404_NOT_FOUND
             )
-        response = HttpResponse(
-            store_owner.store_logo_data, 
-            content_type=store_owner.store_logo_content_type or 'application/octet-stream'
-        )
-        if store_owner.store_logo_filename:
-            response['Content-Disposition'] = f'inline; filename="{store_owner.store_logo_filename}"'
-        return response
+        return media_response(request, store_owner.store_logo.name, store_owner.store_logo.storage)
 
     # Statistics Actions
     @action(detail=True, methods=['get'], url_path='statistics')
     def statistics(self, request, phone=None):
-        """Get store owner statistics"""
+        """Get store owner statistics with daily sales for the last ?days= days"""
         store_owner = self.get_object()
+        try:
+            days = min(max(int(request.query_params.get('days', 30)), 1), 366)
+        except ValueError:
+            raise ParseError('days must be an integer')
         return Response({
             'active_products_count': store_owner.active_products_count,
             'total_sales': store_owner.total_sales,
             'total_revenue': str(store_owner.total_revenue),
             'seller_rating': store_owner.seller_rating,
             'store_rating': store_owner.store_rating,
+            'daily': series(store_owner.pk, timezone.now() - timedelta(days=days - 1), timezone.now()),
         })
 
+    @action(detail=True, methods=['get'], url_path='analytics')
+    def analytics(self, request, phone=None):
+        """
+        Views, orders, units, revenue and conversion per hour or day, read from
+        the rollup buckets. ?granularity=hour|day, ?start= / ?end= (ISO dates or
+        datetimes, default the last 30 days or 48 hours), ?product=<id> for one
+        product's series, ?top=N for the best-selling products of the range.
+        """
+        store_owner = self.get_object()
+        granularity = request.query_params.get('granularity', DAY)
+        if granularity not in GRANULARITIES:
+            raise ParseError(f'granularity must be one of: {", ".join(GRANULARITIES)}')
+
+        end = self._parse_moment(request.query_params.get('end')) or timezone.now()
+        default_span = STEPS[granularity] * (30 if granularity == DAY else 48)
+        start = self._parse_moment(request.query_params.get('start')) or end - default_span + STEPS[granularity]
+        if start > end:
+            raise ParseError('start must not be after end')
+        points = (bucket_start(end, granularity) - bucket_start(start, granularity)) // STEPS[granularity] + 1
+        if points > MAX_POINTS[granularity]:
+            raise ParseError(f'At most {MAX_POINTS[granularity]} {granularity} buckets per request')
+
+        product_id = None
+        if request.query_params.get('product'):
+            try:
+                product_id = ObjectId(request.query_params['product'])
+            except InvalidId:
+                raise ParseError('Invalid product id')
+            if not Product.objects.filter(pk=product_id, store_owner=store_owner).exists():
+                raise NotFound('Product not found in this store')
+
+        rows = series(store_owner.pk, start, end, granularity, product_id)
+        data = {
+            'granularity': granularity,
+            'start': bucket_start(start, granularity).isoformat(),
+            'end': bucket_start(end, granularity).isoformat(),
+            'product': str(product_id) if product_id else None,
+            'totals': totals(rows),
+            'series': rows,
+        }
+        try:
+            top = min(max(int(request.query_params.get('top', 0)), 0), 50)
+        except ValueError:
+            raise ParseError('top must be an integer')
+        if top and product_id is None:
+            ranked = top_products(store_owner.pk, start, end, granularity, limit=top)
+            titles = dict(Product.objects.filter(
+                pk__in=[ObjectId(row['product_id']) for row in ranked]
+            ).values_list('id', 'title'))
+            for row in ranked:
+                row['title'] = titles.get(ObjectId(row['product_id']))
+            data['top_products'] = ranked
+        return Response(data)
+
+    @staticmethod
+    def _parse_moment(value):
+        """Parse an ISO date or datetime query param into an aware datetime"""
+        if not value:
+            return None
+        try:
+            moment = parse_datetime(value) or parse_date(value)
+        except ValueError:
+            # Well-formed but impossible, e.g. 2026-02-30
+            moment = None
+        if moment is None:
+            raise ParseError(f'Invalid date: {value}')
+        if not isinstance(moment, datetime):
+            moment = datetime.combine(moment, time.min)
+        if timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+        return moment
+
     # Rating Actions
-    @action(detail=True, methods=['post'], url_path='rate-seller')
-    def rate_seller(self, request, phone=None):
-        """Add a rating to the seller"""
+    def _rate(self, request, kind):
+        """Record the requesting user's seller or store rating (one per user)"""
         store_owner = self.get_object()
         rating = request.data.get('rating')
 
-        if not rating:
+        if rating is None or rating == '':
             return Response(
                 {'detail': 'rating is required'},
                 status=status.HTTP_400_BAD_REQUEST
@@ -284,48 +385,29 @@ class StoreOwnerViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        store_owner.update_seller_rating(rating)
+        created = store_owner.rate(request.user, kind, round(rating, 1))
         return Response({
-            'detail': 'Seller rating updated successfully',
-            'seller_rating': store_owner.seller_rating
-        })
+            'detail': f"{kind.capitalize()} rating {'added' if created else 'updated'} successfully",
+            f'{kind}_rating': getattr(store_owner, f'{kind}_rating'),
+            'your_rating': round(rating, 1),
+        }, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+    @action(detail=True, methods=['post'], url_path='rate-seller')
+    def rate_seller(self, request, phone=None):
+        """Rate the seller; rating again replaces the previous rating"""
+        return self._rate(request, 'seller')
 
     @action(detail=True, methods=['post'], url_path='rate-store')
     def rate_store(self, request, phone=None):
-        """Add a rating to the store"""
-        store_owner = self.get_object()
-        rating = request.data.get('rating')
-        
-        if not rating:
-            return Response(
-                {'detail': 'rating is required'}, 
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        try:
-            rating = float(rating)
-            if rating < 0 or rating > 5:
-                return Response(
-                    {'detail': 'Rating must be between 0 and 5'}, 
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-        except (ValueError, TypeError):
-            return Response(
-                {'detail': 'Invalid rating value'}, 
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        store_owner.update_store_rating(rating)
-        return Response({
-            'detail': 'Store rating updated successfully',
-            'store_rating': store_owner.store_rating
-        })
+        """Rate the store; rating again replaces the previous rating"""
+        return self._rate(request, 'store')
 
 
-class ProductViewSet(viewsets.ModelViewSet):
+class ProductViewSet(KeysetPaginationMixin, viewsets.ModelViewSet):
     """ViewSet for Product CRUD operations"""
     queryset = Product.objects.all().order_by('-created_at')
     serializer_class = ProductSerializer
+    keyset_actions = ('list',)
 
     def get_queryset(self):
         """Filter products based on user type"""
@@ -344,33 +426,110 @@ class ProductViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(status='active')
 
         # Apply ordering
-        queryset = queryset.order_by('-created_at')
+        queryset = queryset.order_by(*PRODUCT_ORDERINGS[self.get_ordering()])
 
         return queryset
 
+    def get_ordering(self):
+        """Listing order from ?ordering=, newest first by default"""
+        ordering = self.request.query_params.get('ordering') or DEFAULT_ORDERING
+        if ordering not in PRODUCT_ORDERINGS:
+            raise ParseError(f'ordering must be one of: {", ".join(PRODUCT_ORDERINGS)}')
+        return ordering
+
+    def use_keyset_pagination(self):
+        # Cursors encode (created_at, _id), so they only page the default order
+        return super().use_keyset_pagination() and self.get_ordering() == DEFAULT_ORDERING
+
     def get_permissions(self):
         """Set permissions based on action"""
         if self.action in ['list', 'retrieve']:
             # Anyone can list/retrieve products, but filtered appropriately
             return [permissions.AllowAny()]
-        if self.action in ['create']:
+        if self.action in ['create', 'bulk_import']:
             # Only store owners can create products
             return [IsStoreOwner()]
+        if self.action in ['bulk_export']:
+            # Store owners export their own catalog, admins export all products
+            return [IsStoreOwnerOrAdmin()]
         if self.action in ['update', 'partial_update', 'destroy',
                           'add_image', 'remove_image', 'set_primary_image']:
             # Store owners can manage their own products, admins can manage all
             return [IsStoreOwnerOrAdmin()]
-        if self.action in ['increment_views']:
-            # Anyone can view products (increment view count)
+        if self.action in ['increment_views', 'related']:
+            # Anyone can view products (increment view count) and their related products
             return [permissions.AllowAny()]
         if self.action in ['rate_product', 'get_my_rating', 'update_my_rating']:
             # Only customers and admins can rate products
             return [IsCustomerOrAdmin()]
-        if self.action in ['store_products']:
+        if self.action in ['store_products', 'search', 'search_suggest', 'ranking']:
             # Authenticated users can fetch products by store owner
             return [permissions.AllowAny()]
         return [permissions.IsAuthenticated()]
 
+    def can_view_cached(self, data):
+        """Apply get_queryset's visibility rules to a cached product payload"""
+        user = self.request.user
+        if user.is_authenticated and hasattr(user, 'user_type') and user.user_type == 'store_owner':
+            return data['store_owner']['id'] == str(user.id)
+        if user.is_authenticated and user.is_superuser:
+            return True
+        return data['status'] == 'active'
+
+    def visibility_match(self):
+        """Apply get_queryset's visibility rules as a raw Mongo filter"""
+        user = self.request.user
+        if user.is_authenticated and hasattr(user, 'user_type') and user.user_type == 'store_owner':
+            return {column(Product, 'store_owner'): user.pk}
+        if user.is_authenticated and user.is_superuser:
+            return {}
+        return {'status': 'active'}
+
+    def list(self, request, *args, **kwargs):
+        """List products; filter params switch to a single faceted aggregation"""
+        if not ProductFilter.is_requested(request.query_params):
+            return super().list(request, *args, **kwargs)
+
+        product_filter = ProductFilter(request.query_params)
+        page, page_size = get_page_params(request)
+        product_ids, total, facets = product_filter.aggregate(
+            self.visibility_match(), page, page_size, sort=mongo_sort(self.get_ordering()),
+        )
+
+        products = Product.objects.select_related('store_owner').in_bulk(product_ids)
+        serializer = self.get_serializer(
+            [products[product_id] for product_id in product_ids if product_id in products], many=True
+        )
+
+        url = request.build_absolute_uri()
+        return Response({
+            'count': total,
+            'next': replace_query_param(url, 'page', page + 1) if page * page_size < total else None,
+            'previous': (
+                None if page == 1
+                else remove_query_param(url, 'page') if page == 2
+                else replace_query_param(url, 'page', page - 1)
+            ),
+            'results': serializer.data,
+            'facets': facets,
+        })
+
+    def retrieve(self, request, *args, **kwargs):
+        """Serve hot products from the product cache when the row's updated_at still matches"""
+        try:
+            row = Product.objects.filter(pk=ObjectId(kwargs.get('pk'))).values_list('updated_at', 'views').first()
+        except (InvalidId, TypeError):
+            row = None
+        if row is not None:
+            updated_at, views = row
+            # The cache can be per process; the version stamp catches writes made by other workers
+            data = product_cache.get(kwargs.get('pk'), updated_at=updated_at, base_url=request.build_absolute_uri('/'))
+            if data is not None and self.can_view_cached(data):
+                # Views are counted without touching updated_at, read them live
+                data['views'] = views
+                return Response(data)
+        return super().retrieve(request, *args, **kwargs)
+
     def create(self, request, *args, **kwargs):
         product_data = request.data
         product_images = request.FILES.getlist('images')
@@ -551,6 +710,28 @@ class ProductViewSet(viewsets.ModelViewSet):
             'views': product.views
         })
 
+    @action(detail=True, methods=['get'], url_path='related')
+    def related(self, request, pk=None):
+        """Products bought or wishlisted together with this one, from the precomputed table"""
+        product = self.get_object()
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), recommendations.size)
+        except ValueError:
+            raise ParseError('limit must be an integer')
+
+        entries = recommendations.get(product.pk)
+        products = Product.objects.select_related('store_owner').filter(
+            status=Product.Status.ACTIVE
+        ).in_bulk([ObjectId(entry['product']) for entry in entries])
+        ranked = [
+            (products[ObjectId(entry['product'])], entry['score'])
+            for entry in entries if ObjectId(entry['product']) in products
+        ][:limit]
+        data = self.get_serializer([related for related, _ in ranked], many=True).data
+        # New rows: the serialized dicts may be the product cache's own entries
+        data = [{**row, 'score': score} for row, (_, score) in zip(data, ranked)]
+        return Response({'product': str(product.pk), 'results': data})
+
     # Bulk Actions
     @action(detail=False, methods=['get'], url_path='my-products')
     def my_products(self, request):
@@ -562,9 +743,43 @@ class ProductViewSet(viewsets.ModelViewSet):
             )
 
         queryset = self.get_queryset()
+        stream = get_stream_format(request)
+        if stream:
+            return streaming_response(stream, queryset_batches(queryset), serialize_with(self))
+
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
+    @action(detail=False, methods=['post'], url_path='import')
+    def bulk_import(self, request):
+        """Create or update the store owner's products from a CSV or NDJSON upload"""
+        file_obj = request.FILES.get('file')
+        if not file_obj:
+            return Response({'detail': 'file is required'}, status=status.HTTP_400_BAD_REQUEST)
+        fmt = request.query_params.get('format_type') or format_for(file_obj.name)
+        if fmt not in FORMATS:
+            raise ParseError(f'format_type must be one of: {", ".join(FORMATS)}')
+        update_existing = request.query_params.get('update_existing', 'true').lower() not in ('false', '0', 'no')
+
+        try:
+            store_owner = StoreOwner.objects.get(id=request.user.id)
+        except StoreOwner.DoesNotExist:
+            return Response({'detail': 'Store owner not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        importer = ProductImporter(store_owner, update_existing=update_existing)
+        report = importer.run(read_rows(file_obj.file, fmt))
+        return Response(report, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'], url_path='export')
+    def bulk_export(self, request):
+        """Stream the visible products as CSV or NDJSON"""
+        fmt = request.query_params.get('format_type', 'csv')
+        if fmt not in FORMATS:
+            raise ParseError(f'format_type must be one of: {", ".join(FORMATS)}')
+        response = StreamingHttpResponse(export_stream(self.get_queryset(), fmt), content_type=CONTENT_TYPES[fmt])
+        response['Content-Disposition'] = f'attachment; filename="products.{fmt}"'
+        return response
+
     @action(detail=False, methods=['get'], url_path=r'store/(?P<store_owner_id>[^/]+)')
     def store_products(self, request, store_owner_id=None):
         """Get active products of a specific store owner (accessible by customers)"""
@@ -588,6 +803,14 @@ class ProductViewSet(viewsets.ModelViewSet):
             status='active'
         ).order_by('-created_at')
 
+        stream = get_stream_format(request)
+        if stream:
+            return streaming_response(
+                stream, queryset_batches(products), serialize_with(self),
+                envelope={'store': StoreOwnerSerializer(store_owner).data},
+                list_key='products', count_key='total_products',
+            )
+
         # Serialize products
         serializer = self.get_serializer(products, many=True)
         return Response({
@@ -596,10 +819,95 @@ class ProductViewSet(viewsets.ModelViewSet):
             'total_products': len(serializer.data)
         })
 
-class CommentViewSet(viewsets.ModelViewSet):
+    @action(detail=False, methods=['get'], url_path=r'rankings/(?P<kind>[a-z_]+)')
+    def ranking(self, request, kind=None):
+        """
+        Precomputed ranking (bestsellers, trending, top_rated, most_viewed) of the
+        whole catalog, a ?category= or a ?store=<phone>, served from the cache
+        until the next refresh_rankings run changes it.
+        """
+        if kind not in KINDS:
+            raise NotFound(f'Unknown ranking. Valid rankings: {", ".join(KINDS)}')
+        try:
+            limit = min(max(int(request.query_params.get('limit', 20)), 1), rankings.size)
+        except ValueError:
+            raise ParseError('limit must be an integer')
+
+        store_owner_id = None
+        if request.query_params.get('store'):
+            store_owner_id = StoreOwner.objects.filter(
+                phone=request.query_params['store']
+            ).values_list('id', flat=True).first()
+            if store_owner_id is None:
+                raise NotFound('Store not found')
+        scope = scope_key(category=request.query_params.get('category'), store_owner_id=store_owner_id)
+
+        entries, computed_at = rankings.get(kind, scope)
+        base_url = request.build_absolute_uri('/')
+        data = rankings.cached_payload(kind, scope, computed_at, base_url) if computed_at else None
+        if data is None:
+            products = Product.objects.select_related('store_owner').filter(
+                status=Product.Status.ACTIVE
+            ).in_bulk([ObjectId(entry['product']) for entry in entries])
+            ranked = [
+                (products[ObjectId(entry['product'])], entry['score'])
+                for entry in entries if ObjectId(entry['product']) in products
+            ]
+            data = self.get_serializer([product for product, _ in ranked], many=True).data
+            # New rows: the serialized dicts may be the product cache's own entries
+            data = [{**row, 'score': score} for row, (_, score) in zip(data, ranked)]
+            if computed_at:
+                rankings.cache_payload(kind, scope, computed_at, data, base_url)
+
+        return Response({
+            'kind': kind,
+            'scope': scope,
+            'computed_at': computed_at,
+            'results': data[:limit],
+        })
+
+    @action(detail=False, methods=['get'], url_path='search')
+    def search(self, request):
+        """Full-text search over active products, ranked by BM25"""
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response(
+                {'detail': 'q is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        page, page_size = get_page_params(request)
+
+        hits, total = search_index.search(query, page, page_size)
+        products = Product.objects.select_related('store_owner').in_bulk([product_id for product_id, _ in hits])
+        ranked = [products[product_id] for product_id, _ in hits if product_id in products]
+
+        serializer = self.get_serializer(ranked, many=True)
+        return Response({
+            'query': query,
+            'results': serializer.data,
+            'total': total,
+            'page': page,
+            'page_size': page_size,
+        })
+
+    @action(detail=False, methods=['get'], url_path='search/suggest')
+    def search_suggest(self, request):
+        """Autocomplete the last word of a search query"""
+        query = request.query_params.get('q', '')
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), 50)
+        except ValueError:
+            raise ParseError('limit must be an integer')
+        return Response({
+            'query': query,
+            'suggestions': search_index.suggest(query, limit),
+        })
+
+class CommentViewSet(KeysetPaginationMixin, viewsets.ModelViewSet):
     """ViewSet for Comment operations"""
     queryset = Comment.objects.all().order_by('-created_at')
     serializer_class = CommentSerializer
+    keyset_actions = ('product_comments',)
 
     def get_queryset(self):
         """Filter comments - everyone can see comments, but filtered by product"""
@@ -618,7 +926,7 @@ class CommentViewSet(viewsets.ModelViewSet):
 
     def get_permissions(self):
         """Set permissions based on action"""
-        if self.action in ['list', 'retrieve']:
+        if self.action in ['list', 'retrieve', 'product_comments', 'thread']:
             # Anyone can view comments
             return [permissions.AllowAny()]
         if self.action in ['create']:
@@ -639,6 +947,29 @@ class CommentViewSet(viewsets.ModelViewSet):
             context['product_id'] = self.request.query_params['product_id']
         return context
 
+    def is_collapsed(self):
+        return self.request.query_params.get('collapsed', '').lower() in ('true', '1', 'yes')
+
+    def get_thread_serializer(self, roots, many=True):
+        """
+        Serialize top-level comments with their reply trees loaded in constant queries.
+        With ?collapsed=true only reply_count/last_reply_at are returned per thread.
+        """
+        roots = list(roots) if many else [roots]
+        collapsed = many and self.is_collapsed()
+        context = self.get_serializer_context()
+        context['collapsed'] = collapsed
+        context['thread_loader'] = CommentThreadLoader(roots, load_replies=not collapsed)
+        return self.get_serializer_class()(roots if many else roots[0], many=many, context=context)
+
+    def list(self, request, *args, **kwargs):
+        """List top-level comments with their reply trees"""
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.get_thread_serializer(page).data)
+        return Response(self.get_thread_serializer(queryset).data)
+
     def create(self, request, *args, **kwargs):
         """Create a new comment - must be associated with a product"""
         serializer = self.get_serializer(data=request.data)
@@ -694,13 +1025,39 @@ class CommentViewSet(viewsets.ModelViewSet):
             parent__isnull=True
         ).order_by('-created_at')
 
-        serializer = self.get_serializer(comments, many=True)
+        if self.use_keyset_pagination():
+            page = self.paginate_queryset(comments)
+            return Response({
+                'product_id': product_id,
+                'comments': self.get_thread_serializer(page).data,
+                'next': self.paginator.get_next_link(),
+            })
+
+        if 'page' in request.query_params or 'page_size' in request.query_params:
+            page, page_size = get_page_params(request)
+            total_comments = comments.count()
+            roots = list(comments[(page - 1) * page_size:page * page_size])
+            return Response({
+                'product_id': product_id,
+                'comments': self.get_thread_serializer(roots).data,
+                'total_comments': total_comments,
+                'page': page,
+                'page_size': page_size,
+            })
+
+        serializer = self.get_thread_serializer(list(comments))
         return Response({
             'product_id': product_id,
             'comments': serializer.data,
             'total_comments': len(serializer.data)
         })
 
+    @action(detail=True, methods=['get'], url_path='thread')
+    def thread(self, request, pk=None):
+        """Get a whole thread (the top-level comment and every reply) in one query"""
+        comment = self.get_object()
+        return Response(self.get_thread_serializer(comment, many=False).data)
+
     @action(detail=True, methods=['post'], url_path='reply')
     def reply_to_comment(self, request, pk=None):
         """Reply to a specific comment"""
@@ -733,6 +1090,7 @@ class WishlistViewSet(viewsets.GenericViewSet):
     serializer_class = WishlistSerializer
     lookup_field = 'pk'
     lookup_value_regex = r'[^/]+'  # Allow any characters including 'me'
+    check_many_limit = 100
 
     def get_queryset(self):
         """Filter wishlists - customers can only see their own wishlist, admins can see all"""
@@ -740,17 +1098,17 @@ class WishlistViewSet(viewsets.GenericViewSet):
 
         if user.is_authenticated and hasattr(user, 'user_type') and user.user_type == 'customer':
             # Customers can only see their own wishlist
-            return Wishlist.objects.filter(user=user)
+            return Wishlist.objects.filter(user=user).select_related('user')
         elif user.is_authenticated and user.is_superuser:
             # Admins can see all wishlists
-            return Wishlist.objects.all()
+            return Wishlist.objects.select_related('user').order_by('-created_at')
         else:
             # Anonymous users can't see wishlists
             return Wishlist.objects.none()
 
     def get_permissions(self):
         """Set permissions based on action"""
-        if self.action in ['list', 'retrieve', 'add_product', 'remove_product', 'clear', 'check_product']:
+        if self.action in ['list', 'retrieve', 'items', 'add_product', 'remove_product', 'clear', 'check_product', 'check_many']:
             # Customers can manage their own wishlist, admins can view all
             return [IsCustomerOrAdmin()]
         return [permissions.IsAuthenticated()]
@@ -779,6 +1137,10 @@ class WishlistViewSet(viewsets.GenericViewSet):
     def list(self, request, *args, **kwargs):
         """List user's wishlists (for customers, only their own)"""
         queryset = self.get_queryset()
+        stream = get_stream_format(request)
+        if stream:
+            return streaming_response(stream, queryset_batches(queryset), serialize_with(self))
+
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
@@ -788,6 +1150,17 @@ class WishlistViewSet(viewsets.GenericViewSet):
         serializer = self.get_serializer(instance)
         return Response(serializer.data)
 
+    @action(detail=True, methods=['get'], url_path='items')
+    def items(self, request, pk=None):
+        """Page through wishlist items, most recently added first"""
+        wishlist = self.get_object()
+        page = self.paginate_queryset(wishlist.items.order_by('-added_at', '-id'))
+        loader = WishlistLoader(items=page)
+        serializer = WishlistItemSerializer(
+            loader.items, many=True, context={**self.get_serializer_context(), 'wishlist_loader': loader}
+        )
+        return self.get_paginated_response(serializer.data)
+
     @action(detail=True, methods=['post'], url_path='add')
     def add_product(self, request, pk=None):
         """Add a product to the wishlist"""
@@ -885,6 +1258,38 @@ class WishlistViewSet(viewsets.GenericViewSet):
             'in_wishlist': is_in_wishlist
         }, status=status.HTTP_200_OK)
 
+    @action(detail=True, methods=['get', 'post'], url_path='check-many')
+    def check_many(self, request, pk=None):
+        """Check a whole page of products against the wishlist in one query"""
+        wishlist = self.get_object()
+
+        if request.method == 'POST':
+            product_ids = request.data.get('product_ids') or []
+            if not isinstance(product_ids, list):
+                raise ParseError('product_ids must be a list')
+        else:
+            product_ids = [
+                value.strip() for value in request.query_params.get('product_ids', '').split(',') if value.strip()
+            ]
+        if not product_ids:
+            return Response(
+                {'detail': 'product_ids is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(product_ids) > self.check_many_limit:
+            raise ParseError(f'At most {self.check_many_limit} product_ids can be checked at once')
+
+        keys = {}
+        for product_id in product_ids:
+            try:
+                keys[str(product_id)] = ObjectId(str(product_id))
+            except (InvalidId, TypeError):
+                continue
+        found = wishlist.products_in(keys.values()) if keys else set()
+        return Response({
+            'results': {str(product_id): keys.get(str(product_id)) in found for product_id in product_ids}
+        }, status=status.HTTP_200_OK)
+
     
 
 class CategoryViewSet(viewsets.ViewSet):
@@ -931,32 +1336,23 @@ class CategoryViewSet(viewsets.ViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Get stores that have active products in this category
-        stores = StoreOwner.objects.filter(
-            products__category=category,
-            products__status='active',
-            seller_status='approved'
-        ).distinct()
-
-        # Format response
-        store_list = []
-        for store in stores:
-            store_data = {
-                'id': str(store.id),
-                'store_name': store.store_name,
-                'store_rating': store.store_rating or {'average': 0, 'count': 0},
-                'store_logo': store.store_logo.url if store.store_logo else None,
-                'products_count': store.products.filter(
-                    category=category,
-                    status='active'
-                ).count()
-            }
-            store_list.append(store_data)
+        ordering = request.query_params.get('ordering', 'products_count')
+        if ordering not in STORE_ORDERINGS:
+            return Response(
+                {'detail': f'Invalid ordering. Valid orderings: {", ".join(STORE_ORDERINGS)}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        page, page_size = get_page_params(request)
+
+        # Group, join and page in a single aggregation
+        store_list, total_stores = stores_by_category(category, ordering, page, page_size)
 
         return Response({
             'category': category,
             'stores': store_list,
-            'total_stores': len(store_list)
+            'total_stores': total_stores,
+            'page': page,
+            'page_size': page_size,
         })
 
     @action(detail=True, methods=['get'], url_path=r'stores/(?P<store_id>[^/]+)/products')
@@ -982,23 +1378,84 @@ class CategoryViewSet(viewsets.ViewSet):
                 status=status.HTTP_404_NOT_FOUND
             )
 
-        # Get products
+        store_data = {
+            'id': str(store.id),
+            'store_name': store.store_name,
+            'store_rating': store.store_rating or {'average': 0, 'count': 0}
+        }
+        if not ProductFilter.is_requested(request.query_params):
+            return self._store_category_products(request, store, category, store_data)
+
+        # Filtered products and facet counts come back from one aggregation
+        product_filter = ProductFilter(request.query_params)
+        page_size = None
+        page = 1
+        if 'page' in request.query_params or 'page_size' in request.query_params:
+            page, page_size = get_page_params(request)
+        product_ids, total, facets = product_filter.aggregate({
+            column(Product, 'store_owner'): store.pk,
+            'category': category,
+            'status': 'active',
+        }, page, page_size)
+
+        stream = get_stream_format(request)
+        if stream:
+            def product_batches():
+                # Only the ids are held in memory, products are loaded a batch at a time
+                for batch in queryset_batches(product_ids):
+                    products = Product.objects.in_bulk(batch)
+                    for product in products.values():
+                        product.store_owner = store
+                    yield [products[product_id] for product_id in batch if product_id in products]
+
+            return streaming_response(
+                stream, product_batches(), serialize_with(self, ProductSerializer),
+                envelope={'category': category, 'store': store_data, 'total_products': total, 'facets': facets},
+                list_key='products',
+            )
+
+        products = Product.objects.in_bulk(product_ids)
+        for product in products.values():
+            # Already loaded above, spare the serializer a lookup per product
+            product.store_owner = store
+
+        # Serialize products
+        serializer = ProductSerializer(
+            [products[product_id] for product_id in product_ids if product_id in products],
+            many=True,
+            context={'request': request}
+        )
+
+        return Response({
+            'category': category,
+            'store': store_data,
+            'products': serializer.data,
+            'total_products': total,
+            'facets': facets,
+        })
+
+    def _store_category_products(self, request, store, category, store_data):
+        """Unfiltered listing: the store's active products in the category, newest first"""
         products = Product.objects.filter(
             store_owner=store,
             category=category,
             status='active'
         ).order_by('-created_at')
 
+        stream = get_stream_format(request)
+        if stream:
+            return streaming_response(
+                stream, queryset_batches(products), serialize_with(self, ProductSerializer),
+                envelope={'category': category, 'store': store_data},
+                list_key='products', count_key='total_products',
+            )
+
         # Serialize products
         serializer = ProductSerializer(products, many=True, context={'request': request})
 
         return Response({
             'category': category,
-            'store': {
-                'id': str(store.id),
-                'store_name': store.store_name,
-                'store_rating': store.store_rating or {'average': 0, 'count': 0}
-            },
+            'store': store_data,
             'products': serializer.data,
             'total_products': len(serializer.data)
         })
@@ -1063,12 +1520,21 @@ class CartViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(cart)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-    # Cart Item Management Actions
-    @action(detail=True, methods=['post'], url_path='add-item')
-    def add_item(self, request, pk=None):
-        """Add an item to the cart"""
-        cart = self.get_object()
+    def get_engine(self):
+        """Return a CartEngine for the URL's cart ('me', an id, or the caller's own cart)"""
+        user = self.request.user
+        if not user.is_authenticated or not hasattr(user, 'user_type') or user.user_type != 'customer':
+            raise PermissionDenied("Only customers can manage their cart")
+
+        lookup_value = self.kwargs.get(self.lookup_field)
+        if lookup_value in (None, 'me'):
+            return CartEngine(user.pk)
+        try:
+            return CartEngine(user.pk, ObjectId(lookup_value))
+        except InvalidId:
+            raise NotFound('Cart not found')
 
+    def _add_item(self, request):
         # Validate item data
         item_data = request.data
         if not item_data:
@@ -1081,196 +1547,101 @@ class CartViewSet(viewsets.ModelViewSet):
         if not item_serializer.is_valid():
             return Response(item_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-        validated_item = item_serializer.validated_data
-
-        # Check if item already exists in cart
-        existing_item = None
-        for item in cart.items:
-            if item['product_id'] == validated_item['product_id']:
-                existing_item = item
-                break
+        # Bump the quantity or push a new line in one atomic update
+        cart, created = self.get_engine().add_item(dict(item_serializer.validated_data))
+        if cart is None:
+            return Response(
+                {'detail': 'Cart not found'},
+                status=status.HTTP_404_NOT_FOUND
+            )
 
-        if existing_item:
-            # Update quantity
-            existing_item['quantity'] += validated_item['quantity']
-            cart.save()
-            return Response({
-                'detail': 'Item quantity updated successfully',
-            }, status=status.HTTP_200_OK)
-        else:
-            # Add new item
-            cart.items.append(validated_item)
-            cart.save()
+        if created:
             return Response({
                 'detail': 'Item added to cart successfully',
+                'items': cart.items,
             }, status=status.HTTP_201_CREATED)
+        return Response({
+            'detail': 'Item quantity updated successfully',
+            'items': cart.items,
+        }, status=status.HTTP_200_OK)
+
+    # Cart Item Management Actions
+    @action(detail=True, methods=['post'], url_path='add-item')
+    def add_item(self, request, pk=None):
+        """Add an item to the cart"""
+        return self._add_item(request)
 
     @action(detail=False, methods=['post'], url_path='add-item')
     def add_item_no_pk(self, request):
         """Add an item to the cart (for authenticated users - uses their cart)"""
-        # Get the authenticated user's cart
-        if not request.user.is_authenticated or not hasattr(request.user, 'user_type') or request.user.user_type != 'customer':
-            return Response(
-                {'detail': 'Only customers can manage their cart'},
-                status=status.HTTP_403_FORBIDDEN
-            )
-        
-        try:
-            customer = Customer.objects.get(id=request.user.id)
-            cart, created = Cart.objects.get_or_create(user_id=customer)
-        except Customer.DoesNotExist:
-            return Response(
-                {'detail': 'Customer not found'},
-                status=status.HTTP_404_NOT_FOUND
-            )
-
-        # Validate item data
-        item_data = request.data
-        if not item_data:
-            return Response(
-                {'detail': 'Item data is required'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
-        item_serializer = CartItemSerializer(data=item_data)
-        if not item_serializer.is_valid():
-            return Response(item_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-
-        validated_item = item_serializer.validated_data
-
-        # Check if item already exists in cart
-        existing_item = None
-        for item in cart.items:
-            if item['product_id'] == validated_item['product_id']:
-                existing_item = item
-                break
-
-        if existing_item:
-            # Update quantity
-            existing_item['quantity'] += validated_item['quantity']
-            cart.save()
-            return Response({
-                'detail': 'Item quantity updated successfully',
-            }, status=status.HTTP_200_OK)
-        else:
-            # Add new item
-            cart.items.append(validated_item)
-            cart.save()
-            return Response({
-                'detail': 'Item added to cart successfully',
-            }, status=status.HTTP_201_CREATED)
+        return self._add_item(request)
 
     @action(detail=True, methods=['put', 'patch'], url_path=r'update-item/(?P<product_id>[^/]+)')
     def update_item(self, request, pk=None, product_id=None):
         """Update an item in the cart"""
-        cart = self.get_object()
-
         if not product_id:
             return Response(
                 {'detail': 'Product ID is required'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Find the item
-        item_found = False
-        for item in cart.items:
-            if item['product_id'] == product_id:
-                # Update item fields
-                if 'quantity' in request.data:
-                    item['quantity'] = request.data['quantity']
-                if 'color' in request.data:
-                    item['color'] = request.data['color']
-                if 'size' in request.data:
-                    item['size'] = request.data['size']
-                item_found = True
-                break
-
-        if not item_found:
+        # Validate only the fields being changed
+        item_serializer = CartItemSerializer(
+            data={field: request.data[field] for field in EDITABLE_FIELDS if field in request.data},
+            partial=True
+        )
+        if not item_serializer.is_valid():
+            return Response(item_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        cart = self.get_engine().update_item(product_id, item_serializer.validated_data)
+        if cart is None:
             return Response(
                 {'detail': 'Item not found in cart'},
                 status=status.HTTP_404_NOT_FOUND
             )
 
-        # Validate updated item
-        item_serializer = CartItemSerializer(data=item)
-        if not item_serializer.is_valid():
-            return Response(item_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-
-        cart.save()
         return Response({
             'detail': 'Item updated successfully',
-            'item': item
+            'item': find_line(cart, product_id),
+            'items': cart.items,
         })
 
-    @action(detail=True, methods=['delete', 'post'], url_path=r'remove-item/(?P<product_id>[^/]+)')
-    def remove_item(self, request, pk=None, product_id=None):
-        """Remove an item from the cart"""
-        cart = self.get_object()
-
+    def _remove_item(self, product_id):
         if not product_id:
             return Response(
                 {'detail': 'Product ID is required'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Find and remove the item
-        original_length = len(cart.items)
-        cart.items = [item for item in cart.items if item['product_id'] != product_id]
-
-        if len(cart.items) == original_length:
+        cart = self.get_engine().remove_item(product_id)
+        if cart is None:
             return Response(
                 {'detail': 'Item not found in cart'},
                 status=status.HTTP_404_NOT_FOUND
             )
+        return Response({
+            'detail': 'Item removed from cart successfully',
+            'items': cart.items,
+        })
 
-        cart.save()
-        return Response({'detail': 'Item removed from cart successfully'})
+    @action(detail=True, methods=['delete', 'post'], url_path=r'remove-item/(?P<product_id>[^/]+)')
+    def remove_item(self, request, pk=None, product_id=None):
+        """Remove an item from the cart"""
+        return self._remove_item(product_id)
 
     @action(detail=False, methods=['post'], url_path='remove-item')
     def remove_item_no_pk(self, request):
         """Remove an item from the cart (for authenticated users - gets their cart)"""
-        # Get the authenticated user's cart
-        if not request.user.is_authenticated or not hasattr(request.user, 'user_type') or request.user.user_type != 'customer':
-            return Response(
-                {'detail': 'Only customers can manage their cart'},
-                status=status.HTTP_403_FORBIDDEN
-            )
-        
-        try:
-            customer = Customer.objects.get(id=request.user.id)
-            cart = Cart.objects.get(user_id=customer)
-        except (Customer.DoesNotExist, Cart.DoesNotExist):
-            return Response(
-                {'detail': 'Cart not found'},
-                status=status.HTTP_404_NOT_FOUND
-            )
-
-        product_id = request.data.get('product_id')
-        if not product_id:
-            return Response(
-                {'detail': 'Product ID is required'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
-        # Find and remove the item
-        original_length = len(cart.items)
-        cart.items = [item for item in cart.items if item['product_id'] != product_id]
-
-        if len(cart.items) == original_length:
-            return Response(
-                {'detail': 'Item not found in cart'},
-                status=status.HTTP_404_NOT_FOUND
-            )
-
-        cart.save()
-        return Response({'detail': 'Item removed from cart successfully'})
+        return self._remove_item(request.data.get('product_id'))
 
     @action(detail=True, methods=['post'], url_path='clear')
     def clear_cart(self, request, pk=None):
         """Clear all items from the cart"""
-        cart = self.get_object()
-        cart.items = []
-        cart.save()
+        if self.get_engine().clear() is None:
+            return Response(
+                {'detail': 'Cart not found'},
+                status=status.HTTP_404_NOT_FOUND
+            )
         return Response({'detail': 'Cart cleared successfully'})
 
     # Additional Cart Actions
@@ -1286,15 +1657,19 @@ class CartViewSet(viewsets.ModelViewSet):
             'summary': {
                 'total_items': data['total_items'],
                 'total_price': str(data['total_price']),
-                'item_count': len(data['items'])
+                'item_count': len(data['items']),
+                'price_delta': str(data['pricing']['price_delta']),
+                'has_changes': data['pricing']['has_changes'],
+                'is_valid': data['pricing']['is_valid'],
             }
         })
 
 
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(KeysetPaginationMixin, viewsets.ModelViewSet):
     """ViewSet for Order operations"""
     queryset = Order.objects.all().order_by('-created_at')
     serializer_class = OrderSerializer
+    keyset_actions = ('my_orders', 'store_orders')
 
     def get_queryset(self):
         """Filter orders based on user type"""
@@ -1434,6 +1809,15 @@ class OrderViewSet(viewsets.ModelViewSet):
             )
 
         queryset = self.get_queryset()
+        if self.use_keyset_pagination():
+            page = self.paginate_queryset(queryset)
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+        stream = get_stream_format(request)
+        if stream:
+            return streaming_response(stream, queryset_batches(queryset), serialize_with(self))
+
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
@@ -1447,5 +1831,14 @@ class OrderViewSet(viewsets.ModelViewSet):
             )
 
         queryset = self.get_queryset()
+        if self.use_keyset_pagination():
+            page = self.paginate_queryset(queryset)
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+        stream = get_stream_format(request)
+        if stream:
+            return streaming_response(stream, queryset_batches(queryset), serialize_with(self))
+
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)